@@ -1,20 +1,132 @@
-from flask import Flask, request, render_template, redirect, flash, jsonify, session, g
+from datetime import datetime
+from flask import Flask, request, render_template, Markup, redirect, flash, jsonify, session, g, abort, Response, json, stream_with_context
 from sqlalchemy.exc import IntegrityError
-from models import db, connect_db, Trail, User, Note
+from werkzeug.local import LocalProxy
+from models import db, connect_db, Trail, User, Note, UserStats
+from passwords import PasswordHasherBusy
+from purge import UserPurger
 from forms import UserAddForm, UserEditProfile, LoginForm, TrailAddForm, NoteAddForm
+from paging import PAGE_SIZE, decode_cursor, page_limit, split_page
+from caching import LRUCache
+from routing import read_only
+from instrumentation import RequestMetrics
+from geometry import simplify, zoom_tolerance, distance_to_point, bounding_box
+from werkzeug.http import is_resource_modified
+import payloads
+import elevation
+import similarity
+from spatial import GridIndex, radius_bbox, bbox_intersects
+import tiles
+import export
+import trail_import
+import matching
+import click
+import logging
+import math
+import os
+import time
 
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = 'A very very secret key'
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///urbanmaps_test_db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL',
+                                                   'postgresql:///urbanmaps_test_db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+app.config['SQLALCHEMY_ECHO'] = False
+# connections per worker: pool_size kept open, max_overflow more
+# under bursts, then waits pool_timeout seconds (see routing.py)
+app.config['DB_POOL_SIZE'] = 10
+app.config['DB_MAX_OVERFLOW'] = 10
+app.config['DB_POOL_TIMEOUT'] = 10
+app.config['DB_POOL_RECYCLE'] = 1800
+app.config['DB_POOL_PRE_PING'] = True
+app.config['DB_STATEMENT_TIMEOUT_MS'] = 10000
+# read only views read from these, comma separated in the env
+app.config['DB_REPLICA_URIS'] = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                                 if uri]
+app.config['DB_REPLICA_MAX_LAG'] = 5
+app.config['DB_REPLICA_LAG_CHECK'] = 2
+app.config['DB_REPLICA_CONNECT_TIMEOUT'] = 2
+app.config['DB_READ_AFTER_WRITE'] = 10
+
+# debug logging is off unless LOG_LEVEL is lowered
+app.config['LOG_LEVEL'] = logging.WARNING
+# share of requests logged with their timing and query counts,
+# requests slower than METRICS_SLOW_MS are always logged
+app.config['METRICS_SAMPLE_RATE'] = 0.01
+app.config['METRICS_SLOW_MS'] = 500
+
+# bcrypt work factor, existing hashes are upgraded at next login
+app.config['BCRYPT_LOG_ROUNDS'] = 12
+# threads hashing passwords, and logins allowed to queue for them
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 16
+
+# logged in user identities cached between requests
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 300
+# trails whose simplified (level of detail) geometry is kept
+app.config['LOD_CACHE_SIZE'] = 512
+app.config['LOD_MAX_ZOOM'] = 20
+# rendered trail list part of user pages, per user and page version
+app.config['PAGE_CACHE_SIZE'] = 1024
+# serialized, compressed get_maproute bodies
+app.config['PAYLOAD_CACHE_SIZE'] = 256
+# most trails one batch request may ask for
+app.config['MAX_BATCH_IDS'] = 500
+# trails inserted per transaction by bulk imports
+app.config['IMPORT_BATCH_SIZE'] = 500
+# accounts with more trails are deleted by a background purge,
+# PURGE_BATCH_SIZE trails per transaction
+app.config['PURGE_ASYNC_TRAILS'] = 5000
+app.config['PURGE_BATCH_SIZE'] = 1000
+
+# map matching proxy: "mapbox" for the live API, "stub" for offline
+app.config['MATCHING_BACKEND'] = 'mapbox'
+app.config['MAPBOX_TOKEN'] = 'pk.eyJ1IjoiZ2FkYW1zODg1IiwiYSI6ImNrcHZndzJrNjFhZmsycXFycnl2ejkxZmwifQ.TlHaR8imAHiVAfYR-sZ62A'
+app.config['MATCHING_TIMEOUT'] = 10
+app.config['MATCHING_CACHE_SIZE'] = 4096
+app.config['MATCHING_CACHE_TTL'] = 24 * 60 * 60
+# spatial index of trail bounding boxes, rebuilt from the db after TTL
+# seconds so trails added by other workers show up
+app.config['SPATIAL_CELL_SIZE'] = 0.05
+app.config['SPATIAL_INDEX_TTL'] = 300
+# trails spanning more cells than this are scanned on every search
+app.config['SPATIAL_MAX_CELLS'] = 1024
+# rendered vector tiles, dropped when a trail inside them changes
+app.config['TILE_CACHE_SIZE'] = 2048
+app.config['TILE_CACHE_TTL'] = 300
+# similar route search: default match distance (meters), and how many
+# fingerprint matches get the exact Frechet comparison
+app.config['SIMILAR_MAX_DISTANCE'] = 100
+app.config['SIMILAR_CANDIDATES'] = 50
+# SRTM .hgt tiles for trail elevation, None to skip elevation
+app.config['ELEVATION_DEM_DIR'] = None
+app.config['ELEVATION_OPEN_TILES'] = 64
 
 connect_db(app)
+app.logger.setLevel(app.config['LOG_LEVEL'])
+metrics = RequestMetrics(app)
+purger = UserPurger(app)
 CURR_USER_KEY = "curr_user"
 
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                      ttl=app.config['USER_CACHE_TTL'])
+# trail id -> {zoom: simplified coordinates}
+lod_cache = LRUCache(app.config['LOD_CACHE_SIZE'])
+trail_index = GridIndex(app.config['SPATIAL_CELL_SIZE'], app.config['SPATIAL_MAX_CELLS'])
+# (z, x, y, user_id) -> encoded tile bytes
+tile_cache = LRUCache(app.config['TILE_CACHE_SIZE'],
+                      ttl=app.config['TILE_CACHE_TTL'])
+# (user id, page_version) -> rendered user_trails.html
+page_cache = LRUCache(app.config['PAGE_CACHE_SIZE'])
+# (trail id, etag, content encoding) -> response body bytes
+payload_cache = LRUCache(app.config['PAYLOAD_CACHE_SIZE'])
+matching_proxy = matching.MatchingProxy(
+    LRUCache(app.config['MATCHING_CACHE_SIZE'], ttl=app.config['MATCHING_CACHE_TTL']))
+
 ##############################################################
 #              Home page route                               #
 ##############################################################
@@ -23,34 +135,76 @@ CURR_USER_KEY = "curr_user"
 def start_homepage():
     return render_template('home.html')
 
+
+####     Request metrics       ######
+@app.route('/metrics')
+def get_metrics():
+    '''Request count, timing and SQL statements per endpoint'''
+    caches = {"users": user_cache, "pages": page_cache, "payloads": payload_cache,
+              "lod": lod_cache, "tiles": tile_cache, "matching": matching_proxy.cache}
+    snapshot = metrics.snapshot()
+    snapshot["caches"] = {name: {"size": len(cache), "hits": cache.hits, "misses": cache.misses}
+                          for name, cache in caches.items()}
+    return jsonify(snapshot)
+
 #############################################################
 #             Setup Flask global user variable              #
 #############################################################
 
+def load_current_user():
+    """ Identity of the logged in user, or None.
+        Loaded at most once per request, from user_cache when possible.
+    """
+    if '_user' not in g:
+        user_id = session.get(CURR_USER_KEY)
+        identity = None
+        if user_id is not None:
+            identity = user_cache.get(user_id)
+            if identity is None:
+                user = User.query.get(user_id)
+                if user and user.deleted_at is None:
+                    identity = user.to_identity()
+                    user_cache.set(user_id, identity)
+        g._user = identity
+    return g._user
+
 @app.before_request
 def add_user_to_g():
-    """If user is logged in, add current user to Flask global."""
-    print(f'****** add_user_to_g() running')
-    print(f'SESSION: {session.get(CURR_USER_KEY)}')
-    if CURR_USER_KEY in session:
-        
-        g.user = User.query.get(session[CURR_USER_KEY])
-        print(f'***** g.user at loggin: ', g.user)
-    else:
-        g.user = None
+    """ Add current user to Flask global.
+        g.user is lazy, nothing is looked up until a view uses it.
+    """
+    g.user = LocalProxy(load_current_user)
 
 def do_login(user):
     """Log in user, by adding user tosession."""
     session[CURR_USER_KEY] = user.id
-    print(f'**** LOGGING IN ****  session[CURR_USER_KEY]: ', session.get(CURR_USER_KEY), '-- user.id: ', user.id)
+    app.logger.debug('Logged in user %s', user.id)
 
 
 def do_logout():
     """Logout user, by deleting user from session."""
-    print(f'**** LOGGING OUT ***** session[CURR_USER_KEY]: ', session.get(CURR_USER_KEY))
+    app.logger.debug('Logging out user %s', session.get(CURR_USER_KEY))
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+def get_page_args(parse_key):
+    ''' Read keyset cursor and page size query args, 400 if malformed
+        parse_key(*values) turns cursor values into a sort key
+    '''
+    try:
+        after = decode_cursor(request.args.get('after'))
+        if after is not None:
+            after = parse_key(*after)
+        limit = page_limit(request.args.get('limit'))
+    except (TypeError, ValueError):
+        abort(400)
+    return after, limit
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(err):
+    '''Too many logins queued for hashing, ask the client to retry'''
+    return ("Server busy, please try again shortly", 503, {'Retry-After': '1'})
+
 ##############################################################
 #              routes for users                              #
 ##############################################################
@@ -99,6 +253,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves a rehashed password if the work factor changed
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect(f'/users/{user.id}')
@@ -121,43 +277,51 @@ def logout():
 
 ###     User page              ######
 @app.route('/users/<int:user_id>', methods=['GET'])
+@read_only
 def get_user(user_id):
     '''Gets user page with trails'''
 
     # Add list of trails for user
     # name of trail, distance, duration
-    print(f'***** g.user at /users/{user_id}: ', g.user)
-    user = User.query.get_or_404(user_id)
-
-    trails = Trail.query.filter(Trail.user_id == user_id).all()
-    trailList = [{"id": trail.id, 
-                "name": trail.name,
-                "duration": trail.duration,
-                "distance": trail.distance} for trail in trails]
-    print('**** Trails: ', trailList)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+
+    # the trail list only changes with page_version, render it once
+    key = (user.id, user.page_version)
+    content = page_cache.get(key)
+    if content is None:
+        # first page of summary columns only, trail geometry is not loaded
+        # further pages are fetched by the "load more" button
+        trailList = Trail.summaries_for_user(user_id, limit=PAGE_SIZE + 1)
+        trailList, next_cursor = split_page(trailList, PAGE_SIZE,
+                                            lambda trail: [trail['id']])
+        app.logger.debug('User %s page with %d trails', user_id, len(trailList))
+        # totals are kept up to date, not aggregated here
+        stats = UserStats.for_user(user_id)
+        content = render_template('user_trails.html', user=user, trails=trailList,
+                                  next_cursor=next_cursor, stats=stats)
+        page_cache.set(key, content)
     
-    return render_template('userpage.html', user=user, trails=trailList)
+    return render_template('userpage.html', user=user, content=Markup(content))
 
 
 ####    User Profile UPDATE     ######
 @app.route('/users/profile', methods=['GET','POST'])
 def get_user_profile():
     '''Update profile for current user'''
-    print(f'***** g.user at /users/profile: ', g.user)
-    print(f'#### /users/profile #### session[CURR_USER_KEY]: {session.get(CURR_USER_KEY)}')
+    app.logger.debug('Profile for user %s', session.get(CURR_USER_KEY))
     user = User.query.get_or_404(session.get(CURR_USER_KEY))
     
     form = UserEditProfile(obj=user)
     
     if form.validate_on_submit():
-        user_check = User.authenticate(form.username.data,
-                                       form.password.data)
-
-        if user_check:
+        # check against the current user, the username may be changing
+        if user.check_password(form.password.data):
             user.username = form.username.data
             user.email = form.email.data
             user.address = form.address.data
+            user.page_version += 1
             db.session.commit()
+            user_cache.pop(user.id)
             flash(f'User {user.username} updated', "success")
             return redirect(f'/users/{g.user.id}')
         else:
@@ -176,26 +340,199 @@ def delete_user(id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = session[CURR_USER_KEY]
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    # set based, the database cascades to trails and notes; heavy
+    # accounts are hidden now and purged in the background
+    threshold = app.config['PURGE_ASYNC_TRAILS']
+    if threshold is not None and trail_count_exceeds(user_id, threshold):
+        if not User.mark_deleted(user_id):
+            abort(404)
+        db.session.commit()
+        # hidden from search and tiles now, not once purged
+        forget_user_trails()
+        purger.submit(user_id).add_done_callback(lambda future: forget_user_trails())
+    else:
+        if not User.delete_by_id(user_id):
+            abort(404)
+        db.session.commit()
+        forget_user_trails()
+    user_cache.pop(user_id)
 
     return redirect("/")
 
+
+def trail_count_exceeds(user_id, count):
+    '''True if user_id has more than count trails, counts no further'''
+    trails = db.session.query(Trail.id).filter_by(user_id=user_id).limit(count + 1)
+    return trails.count() > count
+
+
+def forget_user_trails():
+    """Drop shared trail caches after a user's trails are deleted."""
+    tile_cache.clear()
+    # rebuilt from the db on next use
+    trail_index.built_at = None
+
 ##############################################################
 #              routes for trails                             #
 ##############################################################
 
+####     Page of Trails for User  ######
+@app.route('/users/<int:user_id>/trails', methods=['GET'])
+def list_maproutes(user_id):
+    '''Get a page of trail summaries, ?after=<cursor>&limit=<n>'''
+    after, limit = get_page_args(int)
+    trails = Trail.summaries_for_user(user_id, after=after, limit=limit + 1)
+    trails, next_cursor = split_page(trails, limit,
+                                     lambda trail: [trail['id']])
+
+    return jsonify(trails=trails, next=next_cursor)
+
+
 ####     Trail Details            ######
 @app.route('/users/<int:user_id>/trails/<int:trail_id>/', methods=['GET'])
+@read_only
 def get_maproute(user_id, trail_id):
-    '''Get a map route and return details'''
-    user = User.query.get_or_404(user_id)
-    print('##### trail_id: ', trail_id)
-    trail = Trail.query.get_or_404(trail_id).to_coords_array()
-    
-    return (jsonify(maproute=trail))
+    ''' Get a map route and return details
+        ?zoom=<level> returns geometry simplified for that map zoom
+        ?tolerance=<degrees> returns geometry simplified to tolerance
+    '''
+    # one query, also checks the trail belongs to user_id
+    trail = Trail.query_for_user(user_id).filter_by(id=trail_id).first_or_404()
+
+    # conditional GET, answered before any geometry is loaded
+    etag = maproute_etag(trail, request.args.get('zoom'), request.args.get('tolerance'))
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=trail.updated_at):
+        return conditional_response(Response(status=304), etag, trail.updated_at)
+
+    encoding = payloads.best_encoding(request.accept_encodings)
+    key = (trail.id, etag, encoding)
+    body = payload_cache.get(key)
+    if body is None:
+        maproute = trail.to_coords_array(requested_coords(trail))
+        body = payloads.compress(json.dumps({"maproute": maproute}).encode('utf8'), encoding)
+        payload_cache.set(key, body)
+        # rows still stored as text were converted on read, save them
+        if trail in db.session.dirty:
+            db.session.commit()
+
+    response = Response(body, mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return conditional_response(response, etag, trail.updated_at)
+
+
+####     Trail Elevation          ######
+@app.route('/users/<int:user_id>/trails/<int:trail_id>/elevation', methods=['GET'])
+def get_trail_elevation(user_id, trail_id):
+    ''' Climb and elevation profile of a trail, computed when it was saved
+        profile - [distance_m, height_m] at equal steps along the trail
+    '''
+    trail = Trail.query_for_user(user_id).filter_by(id=trail_id).first_or_404()
+    etag = maproute_etag(trail)
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=trail.updated_at):
+        return conditional_response(Response(status=304), etag, trail.updated_at)
+
+    profile = []
+    if trail.elevation_profile is not None:
+        heights = elevation.unpack_profile(trail.elevation_profile)
+        step = (trail.length_m or 0) / max(len(heights) - 1, 1)
+        profile = [[round(n * step, 1), height] for n, height in enumerate(heights)]
+    response = jsonify(gain_m=trail.elevation_gain, loss_m=trail.elevation_loss,
+                       profile=profile)
+    return conditional_response(response, etag, trail.updated_at)
+
+
+def maproute_version(trail):
+    '''Changes whenever the trail row is updated'''
+    return f"{trail.id}-{trail.updated_at:%Y%m%d%H%M%S%f}"
+
+
+def maproute_etag(trail, zoom=None, tolerance=None):
+    '''ETag of a get_maproute response: trail version plus detail level'''
+    if zoom is None and tolerance is None:
+        return maproute_version(trail)
+    return f"{maproute_version(trail)}-z{zoom or ''}-t{tolerance or ''}"
+
+
+def conditional_response(response, etag, last_modified=None):
+    '''Add validators so clients revalidate instead of refetching'''
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+####     Several Trails at Once     ######
+@app.route('/users/<int:user_id>/trails/batch', methods=['GET'])
+def get_maproutes_batch(user_id):
+    ''' Get several map routes in one streamed response
+        ?ids=<id>,<id>,... up to MAX_BATCH_IDS
+        ?zoom= / ?tolerance= as for get_maproute
+    '''
+    try:
+        ids = [int(trail_id) for trail_id in request.args.get('ids', '').split(',') if trail_id]
+    except ValueError:
+        abort(400)
+    if len(ids) > app.config['MAX_BATCH_IDS']:
+        abort(400)
+
+    # single IN query, rows streamed from a server side cursor
+    query = (Trail.query_for_user(user_id).options(db.undefer_group('geometry'))
+             .filter(Trail.id.in_(ids))
+             .order_by(Trail.id)
+             .yield_per(50))
+
+    def generate():
+        yield '{"maproutes":['
+        for i, trail in enumerate(query):
+            maproute = trail.to_coords_array(requested_coords(trail))
+            yield (',' if i else '') + json.dumps(maproute)
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def requested_coords(trail):
+    ''' Coordinates for the ?zoom= or ?tolerance= a request asked for,
+        None for the full geometry
+    '''
+    return detail_coords(trail, request.args.get('zoom', type=int),
+                         request.args.get('tolerance', type=float))
+
+
+def detail_coords(trail, zoom=None, tolerance=None):
+    '''Coordinates simplified for zoom or tolerance, None for the full geometry'''
+    if zoom is not None and zoom < app.config['LOD_MAX_ZOOM']:
+        return lod_coords(trail, max(zoom, 0))
+    if tolerance is not None:
+        # arbitrary tolerances are not cached
+        return simplify(trail.coordinates, tolerance)
+    return None
+
+
+def lod_coords(trail, zoom):
+    ''' Trail coordinates simplified for a map zoom level, cached per
+        trail version so other workers never serve a line from before
+        an edit
+    '''
+    key = (trail.id, trail.updated_at)
+    levels = lod_cache.get(key)
+    if levels is None:
+        levels = {}
+        lod_cache.set(key, levels)
+
+    coords = levels.get(zoom)
+    if coords is None:
+        coords = simplify(trail.coordinates, zoom_tolerance(zoom))
+        levels[zoom] = coords
+    return coords
 
 
 ####     Add Trail for User       ######
@@ -203,22 +540,27 @@ def get_maproute(user_id, trail_id):
 def add_maproute(user_id):
     '''Store a user map route'''
     sessionid = session.get(CURR_USER_KEY);
-    print(f'***** sessionid: {sessionid}')
-    
-    name = request.json["name"]
-    coords = request.json["coordinates"]
-    distance = request.json["distance"]
-    duration = request.json["duration"]
-    
-    
+    app.logger.debug('Add trail for user %s, session user %s', user_id, sessionid)
     
+    try:
+        name = request.json["name"]
+        coords = coords_arg(request.json["coordinates"])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    # distance and duration are computed here, not trusted from the client
     newTrail = Trail(name=name,
-                    distance=distance,
-                    duration=duration,
                     coordinates=coords,
                     user_id=user_id)
+    newTrail.update_stats(coords)
     db.session.add(newTrail)
+    UserStats.apply(user_id, trails=1, distance=newTrail.distance,
+                    duration=newTrail.duration)
+    User.bump_version(user_id)
     db.session.commit()
+    if newTrail.bbox:
+        trail_index.insert(newTrail.id, newTrail.bbox)
+        invalidate_tiles(newTrail.bbox)
     response = jsonify(maproute=newTrail.to_coords_array())
 
     return (response, 201)
@@ -228,14 +570,327 @@ def add_maproute(user_id):
 @app.route('/users/<int:user_id>/trails/<int:trail_id>/delete', methods=['POST'])
 def delete_maproute(user_id, trail_id):
     '''Delete a maproute'''
-    trail = Trail.query.get_or_404(trail_id)
-    db.session.delete(trail)
+    # summary columns for the caches, then one DELETE, notes go
+    # with the trail through ON DELETE CASCADE
+    trail = Trail.query_for_user(user_id).filter_by(id=trail_id).first_or_404()
+    name, bbox = trail.name, trail.bbox
+    notes = Note.query.filter_by(trail_id=trail_id).count()
+    # a concurrent delete of the same trail already took the totals off
+    if not Trail.delete_for_user(trail_id, user_id):
+        abort(404)
+    UserStats.apply(user_id, trails=-1, notes=-notes,
+                    distance=-trail.distance, duration=-trail.duration)
+    User.bump_version(user_id)
     db.session.commit()
-    flash(f'{trail.name} is deleted', "warning")
+    forget_trail(trail_id, bbox)
+    flash(f'{name} is deleted', "warning")
 
     return redirect(f'/users/{user_id}')
 
 
+####     Edit Trail Geometry       ######
+@app.route('/users/<int:user_id>/trails/<int:trail_id>/coordinates', methods=['PATCH'])
+def patch_maproute(user_id, trail_id):
+    ''' Change part of a trail's coordinates, instead of resending all
+        {"append": [[lng, lat], ...]} - add vertices at the end
+        {"start": i, "end": j, "coordinates": [...]} - replace vertices
+            i..j-1 (i == j inserts, empty coordinates deletes)
+        If-Match with the trail's ETag refuses edits to a stale copy.
+    '''
+    # row locked until the commit, so a concurrent edit made from the
+    # same ETag waits here and then fails the If-Match check
+    trail = (Trail.query_for_user(user_id).filter_by(id=trail_id)
+             .options(db.undefer_group('geometry'))
+             .with_for_update()
+             .first_or_404())
+    if request.if_match and not request.if_match.contains(maproute_version(trail)):
+        abort(412)
+
+    edit = request.get_json(silent=True) or {}
+    try:
+        if 'append' in edit:
+            coords = coords_arg(edit['append'])
+        else:
+            coords = coords_arg(edit['coordinates'])
+            start, end = int(edit['start']), int(edit['end'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    old_bbox = trail.bbox
+    old_distance, old_duration = trail.distance, trail.duration
+    if 'append' in edit:
+        trail.append_coordinates(coords)
+    else:
+        try:
+            trail.replace_coordinates(start, end, coords)
+        except IndexError:
+            abort(400)
+    UserStats.apply(user_id, distance=trail.distance - old_distance,
+                    duration=trail.duration - old_duration)
+    User.bump_version(user_id)
+    db.session.commit()
+
+    forget_trail(trail_id, old_bbox)
+    if trail.bbox:
+        trail_index.insert(trail_id, trail.bbox)
+        invalidate_tiles(trail.bbox)
+    response = jsonify(maproute=dict(trail.to_summary(), vertex_count=trail.vertex_count))
+    response.set_etag(maproute_version(trail))
+    return response
+
+
+def coords_arg(value):
+    '''[[lng, lat], ...] from request JSON, ValueError if malformed'''
+    coords = [[float(lng), float(lat)] for lng, lat in value]
+    if not all(-180 <= lng <= 180 and -90 <= lat <= 90 for lng, lat in coords):
+        raise ValueError('Coordinates out of range')
+    return coords
+
+
+def forget_trail(trail_id, bbox):
+    """Drop everything cached or indexed for a changed or deleted trail."""
+    lod_cache.pop_where(lambda key: key[0] == trail_id)
+    payload_cache.pop_where(lambda key: key[0] == trail_id)
+    trail_index.remove(trail_id)
+    if bbox:
+        invalidate_tiles(bbox)
+
+
+def get_trail_index():
+    """Spatial index of trail bboxes, built from the db on first use."""
+    built_at = trail_index.built_at
+    if built_at is None or time.monotonic() - built_at > app.config['SPATIAL_INDEX_TTL']:
+        trail_index.rebuild(Trail.bbox_rows())
+    return trail_index
+
+
+####     Search Trails by Location  ######
+@app.route('/trails/search', methods=['GET'])
+def search_trails():
+    ''' Find trails by location, up to ?limit=<n>
+        ?bbox=min_lng,min_lat,max_lng,max_lat - trails whose bbox overlaps
+        ?lng=<lng>&lat=<lat>&radius=<meters> - trails passing within
+            radius of the point, nearest first
+    '''
+    try:
+        limit = page_limit(request.args.get('limit'))
+        bbox = request.args.get('bbox')
+        if bbox:
+            bbox = tuple(float(value) for value in bbox.split(','))
+            if len(bbox) != 4 or not all(map(math.isfinite, bbox)):
+                raise ValueError(bbox)
+        else:
+            lng = float(request.args['lng'])
+            lat = float(request.args['lat'])
+            radius = float(request.args['radius'])
+            if not all(map(math.isfinite, (lng, lat, radius))):
+                raise ValueError(radius)
+    except (KeyError, ValueError):
+        abort(400)
+
+    if bbox:
+        ids = sorted(get_trail_index().search(bbox))[:limit]
+        trails = (Trail.query.filter(Trail.id.in_(ids), Trail.owner_active())
+                  .order_by(Trail.id).all())
+        return jsonify(trails=[trail.to_summary() for trail in trails])
+
+    # index gives candidates, exact distance needs the geometry
+    ids = get_trail_index().search(radius_bbox(lng, lat, radius))
+    trails = (Trail.query.options(db.undefer_group('geometry'))
+              .filter(Trail.id.in_(ids), Trail.owner_active())
+              .all())
+    near = sorted((distance_to_point(trail.coordinates, lng, lat), trail.id, trail)
+                  for trail in trails)
+
+    return jsonify(trails=[dict(trail.to_summary(), distance_m=round(dist, 1))
+                           for dist, _, trail in near if dist <= radius][:limit])
+
+
+####     Similar Trails            ######
+@app.route('/trails/similar', methods=['POST'])
+def similar_trails():
+    ''' Stored trails that follow the same route as a drawn one
+        {"coordinates": [[lng, lat], ...], "max_distance": <meters>,
+         "limit": <n>, "exclude": <trail id>}
+        Matches are trails within max_distance by discrete Frechet
+        distance, in either direction, closest first. At most
+        SIMILAR_CANDIDATES trails whose ends are close enough are
+        scored, best fingerprint matches first, plus every trail edited
+        since its fingerprint was taken.
+    '''
+    query = request.get_json(silent=True) or {}
+    try:
+        coords = coords_arg(query['coordinates'])
+        max_distance = float(query.get('max_distance', app.config['SIMILAR_MAX_DISTANCE']))
+        limit = page_limit(query.get('limit'))
+        exclude = query.get('exclude')
+        exclude = int(exclude) if exclude is not None else None
+        if len(coords) < 2 or not 0 < max_distance < math.inf:
+            raise ValueError(max_distance)
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    # every vertex of a match is within max_distance of the query line
+    min_lng, min_lat, max_lng, max_lat = bounding_box(coords)
+    lo = radius_bbox(min_lng, min_lat, max_distance)
+    hi = radius_bbox(max_lng, max_lat, max_distance)
+    ids = [id for id in get_trail_index().search((lo[0], lo[1], hi[2], hi[3]))
+           if id != exclude]
+    rows = Trail.fingerprint_rows(ids) if ids else []
+    if not rows:
+        return jsonify(trails=[])
+
+    # prune with the stored fingerprints, only the best few are loaded
+    close = []
+    stale = [id for id, blob in rows if blob is None]
+    rows = [row for row in rows if row[1] is not None]
+    if rows:
+        ids, blobs = zip(*rows)
+        fingerprints = similarity.unpack_fingerprints(blobs)
+        bound = similarity.endpoint_distances(coords, fingerprints)
+        rough = similarity.fingerprint_distances(coords, fingerprints)
+        close = sorted((dist, id) for dist, low, id in zip(rough, bound, ids) if low <= max_distance)
+        close = [id for _, id in close[:app.config['SIMILAR_CANDIDATES']]]
+    close += stale
+    trails = (Trail.query.options(db.undefer_group('geometry'))
+              .filter(Trail.id.in_(close))
+              .all()) if close else []
+
+    matches = sorted((similarity.frechet_distance(coords, trail.coordinates), trail.id, trail)
+                     for trail in trails)
+    return jsonify(trails=[dict(trail.to_summary(), frechet_m=round(dist, 1))
+                           for dist, _, trail in matches if dist <= max_distance][:limit])
+
+
+def invalidate_tiles(bbox):
+    """Drop cached vector tiles that overlap a changed trail bbox."""
+    tile_cache.pop_where(
+        lambda key: bbox_intersects(tiles.tile_bbox(*key[:3], buffer=tiles.BUFFER), bbox))
+
+
+def render_tile(z, x, y, user_id=None):
+    """Encode the trails crossing tile z/x/y, optionally for one user."""
+    ids = get_trail_index().search(tiles.tile_bbox(z, x, y, buffer=tiles.BUFFER))
+    if not ids:
+        return b''
+
+    query = (Trail.query.options(db.undefer_group('geometry'))
+             .filter(Trail.id.in_(ids), Trail.owner_active()))
+    if user_id is not None:
+        query = query.filter(Trail.user_id == user_id)
+
+    features = []
+    for trail in query:
+        # simplified geometry for the zoom, shared with get_maproute
+        if z < app.config['LOD_MAX_ZOOM']:
+            coords = lod_coords(trail, z)
+        else:
+            coords = trail.coordinates
+        parts = tiles.tile_parts(coords, z, x, y)
+        if parts:
+            features.append((trail.id, {"name": trail.name,
+                                        "distance": trail.distance,
+                                        "duration": trail.duration,
+                                        "user_id": trail.user_id}, parts))
+    return tiles.encode_tile('trails', features)
+
+
+####     Trail Vector Tiles         ######
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt', methods=['GET'])
+def get_tile(z, x, y):
+    ''' Mapbox vector tile of stored trails, layer "trails"
+        ?user_id=<id> limits the tile to one user's trails
+    '''
+    if not tiles.valid_tile(z, x, y):
+        abort(404)
+    user_id = request.args.get('user_id', type=int)
+
+    key = (z, x, y, user_id)
+    tile = tile_cache.get(key)
+    if tile is None:
+        tile = render_tile(z, x, y, user_id)
+        tile_cache.set(key, tile)
+
+    return Response(tile, mimetype=tiles.MIME_TYPE)
+
+
+####     Import Trails from File    ######
+@app.route('/users/<int:user_id>/trails/import', methods=['POST'])
+def import_maproutes(user_id):
+    ''' Bulk import GPX, GeoJSON or NDJSON trails
+        multipart "file" upload, or the raw request body with ?format=
+        Returns counts plus per trail errors, bad trails are skipped
+    '''
+    User.query.get_or_404(user_id)
+    upload = request.files.get('file')
+    format = request.args.get('format') or trail_import.guess_format(upload and upload.filename)
+    if format not in trail_import.FORMATS:
+        abort(400)
+
+    stream = upload.stream if upload else request.stream
+    result = trail_import.import_trails(user_id, trail_import.read_items(stream, format),
+                                        batch_size=app.config['IMPORT_BATCH_SIZE'])
+    trails_bulk_changed()
+
+    return (jsonify(result), 201 if result['imported'] else 200)
+
+
+def trails_bulk_changed():
+    '''Drop derived trail data after many trails changed at once'''
+    trail_index.built_at = None
+    tile_cache.clear()
+
+
+####     Export User Trails         ######
+@app.route('/users/<int:user_id>/export', methods=['GET'])
+def export_trails(user_id):
+    ''' Download all of a user's trails as GeoJSON, streamed
+        ?format=ndjson|geojson (default geojson) ?notes=1 adds notes
+    '''
+    format = request.args.get('format', 'geojson')
+    if format not in export.FORMATS:
+        abort(400)
+    User.query.get_or_404(user_id)
+
+    chunks = export_chunks(user_id, format, request.args.get('notes') == '1')
+    response = Response(stream_with_context(chunks), mimetype=export.FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename=trails-{user_id}.{format}'
+    return response
+
+
+def export_chunks(user_id, format, with_notes):
+    '''Encoded export of a user's trails, see export.py'''
+    notes = Note.export_rows(user_id) if with_notes else None
+    return export.encode(export.trail_features(Trail.export_rows(user_id), notes), format)
+
+
+##############################################################
+#              map matching proxy                            #
+##############################################################
+
+####     Match a Drawn Route        ######
+@app.route('/matching/<profile>', methods=['GET'])
+def match_route(profile):
+    ''' Map Matching API proxy, same arguments and response as
+        api.mapbox.com/matching/v5/mapbox/<profile>
+        ?coordinates=lng,lat;lng,lat;... &radiuses=r;r;...
+    '''
+    try:
+        coords, radiuses = matching.parse_request(profile,
+                                                  request.args.get('coordinates', ''),
+                                                  request.args.get('radiuses'))
+    except ValueError as err:
+        return (jsonify(code="InvalidInput", message=str(err)), 422)
+
+    backend = matching.BACKENDS[app.config['MATCHING_BACKEND']](app.config)
+    try:
+        result = matching_proxy.match(backend, profile, coords, radiuses)
+    except matching.MatchingError as err:
+        return (jsonify(code="ProxyError", message=str(err)), 502)
+
+    return jsonify(result)
+
+
 # MAKE NOTES A LATER OPTION
 
 ##############################################################
@@ -244,25 +899,38 @@ def delete_maproute(user_id, trail_id):
 
 ####     All Trail Notes            ######
 @app.route('/users/<int:user_id>/trails/<int:trail_id>/notes', methods=['GET'])
-def get_trail_notes(trail_id):
-    '''Get all notes for a trail'''
-
-    notes = Note.query.filter(Note.trail_id==trail_id).all()
-    noteList = [{"id": note.id, 
-                "comment": note.comment,
-                "timestamp": note.timestamp,
-                "trail_id": trail_id} for note in notes]
-        
-    return jsonify(noteList)
+@read_only
+def get_trail_notes(user_id, trail_id):
+    '''Get a page of notes for a trail, ?after=<cursor>&limit=<n>'''
+    after, limit = get_page_args(note_cursor_key)
+    require_user_trail(user_id, trail_id)
+
+    notes = Note.page_for_trail(trail_id, after=after, limit=limit + 1)
+    notes, next_cursor = split_page(notes, limit,
+                                    lambda note: [note.timestamp.isoformat(), note.id])
+
+    # ETag from the body, repeat polls get a bodyless 304
+    response = jsonify(notes=[note.to_dict() for note in notes], next=next_cursor)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
     
 
+def note_cursor_key(timestamp, note_id):
+    '''Notes page cursor values back to a (timestamp, id) sort key'''
+    return datetime.fromisoformat(timestamp), int(note_id)
+
+
 ####     Add Note to Trail           ######
 @app.route('/users/<int:user_id>/trails/<int:trail_id>/notes', methods=['POST'])
-def add_trail_note(trail_id):
+def add_trail_note(user_id, trail_id):
     '''Add a note to a trail'''
+    require_user_trail(user_id, trail_id)
     comment = request.json['comment']
     note = Note(comment=comment, trail_id=trail_id)
     db.session.add(note)
+    UserStats.apply(user_id, notes=1)
+    User.bump_version(user_id)
     db.session.commit()
     response = jsonify(note={"id": note.id, "comment": note.comment,
                 "timestamp": note.timestamp, "trail_id": note.trail_id})
@@ -272,15 +940,98 @@ def add_trail_note(trail_id):
 
 ####     Delete Trail Note         ######
 @app.route('/users/<int:user_id>/trails/<int:trail_id>/notes/<int:note_id>', methods=['DELETE'])
-def delete_note(trail_id, note_id):
+def delete_note(user_id, trail_id, note_id):
     '''Delete a note'''
-    note = Note.query.filter(Note.id==note_id, Note.trail_id==trail_id).one_or_none()
-    db.session.delete(note)
+    require_user_trail(user_id, trail_id)
+    if not Note.query.filter_by(id=note_id, trail_id=trail_id).delete(synchronize_session=False):
+        abort(404)
+    UserStats.apply(user_id, notes=-1)
+    User.bump_version(user_id)
     db.session.commit()
 
     return jsonify(message="deleted")
 
 
+def require_user_trail(user_id, trail_id):
+    '''404 unless trail_id belongs to user_id, loads no trail columns'''
+    if not (db.session.query(Trail.id)
+            .filter(Trail.id == trail_id, Trail.user_id == user_id, Trail.owner_active())
+            .first()):
+        abort(404)
 
 
-    
+##############################################################
+#              command line tools                            #
+##############################################################
+
+@app.cli.command('backfill-trail-stats')
+def backfill_trail_stats():
+    """Recompute distance, duration and bbox for all stored trails."""
+    count = Trail.backfill_stats()
+    # distances may have changed, redo the per user totals
+    UserStats.rebuild()
+    db.session.commit()
+    click.echo(f'Updated {count} trails')
+
+
+@app.cli.command('backfill-fingerprints')
+def backfill_fingerprints():
+    """Refresh similarity fingerprints left stale by trail edits."""
+    count = Trail.backfill_fingerprints()
+    click.echo(f'Fingerprinted {count} trails')
+
+
+@app.cli.command('backfill-elevation')
+def backfill_elevation():
+    """Compute elevation for trails without it, from ELEVATION_DEM_DIR."""
+    if not app.config['ELEVATION_DEM_DIR']:
+        raise click.UsageError('ELEVATION_DEM_DIR is not set')
+    count = Trail.backfill_elevation()
+    click.echo(f'Added elevation to {count} trails')
+
+
+@app.cli.command('rebuild-user-stats')
+@click.argument('user_id', type=int, required=False)
+def rebuild_user_stats(user_id):
+    """Recompute per user trail and note totals, for one user or all."""
+    UserStats.rebuild(user_id)
+    db.session.commit()
+    click.echo('Rebuilt user stats')
+
+
+@app.cli.command('purge-users')
+def purge_users():
+    """Finish deleting users left marked for a background purge."""
+    for user_id in User.pending_purge_ids():
+        count = purger.purge(user_id)
+        click.echo(f'Purged user {user_id} ({count} trails)')
+
+
+@app.cli.command('export-trails')
+@click.argument('user_id', type=int)
+@click.option('--format', type=click.Choice(list(export.FORMATS)), default='geojson')
+@click.option('--notes', is_flag=True, help='Include trail notes.')
+@click.option('--output', type=click.File('w'), default='-')
+def export_trails_command(user_id, format, notes, output):
+    """Stream a user's trails as GeoJSON or NDJSON to a file or stdout."""
+    for chunk in export_chunks(user_id, format, notes):
+        output.write(chunk)
+
+
+@app.cli.command('import-trails')
+@click.argument('user_id', type=int)
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', type=click.Choice(trail_import.FORMATS),
+              help='File format, guessed from the file name if not given.')
+@click.option('--batch-size', type=int, default=500)
+def import_trails_command(user_id, file, format, batch_size):
+    """Bulk import trails for a user from a GPX/GeoJSON/NDJSON file."""
+    format = format or trail_import.guess_format(file.name)
+    if format is None:
+        raise click.UsageError('Cannot tell the file format, use --format')
+
+    result = trail_import.import_trails(user_id, trail_import.read_items(file, format),
+                                        batch_size=batch_size)
+    for error in result['errors']:
+        click.echo(f"item {error['item']} ({error['name']}): {error['error']}")
+    click.echo(f"Imported {result['imported']} trails")
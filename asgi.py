@@ -0,0 +1,362 @@
+''' Async serving of the JSON trail and notes APIs
+
+    uvicorn asgi:application --workers 4
+
+    The JSON endpoints below are answered by async views on an
+    asyncpg connection pool shared by the whole worker, so a request
+    waiting on the database holds no thread. Every other URL (pages,
+    forms, exports, tiles) falls through to the Flask app unchanged.
+    Caches, ETags and per user totals are the same as app.py's.
+
+    Replica routing matches routing.py: the GET views read from a
+    replica of DB_REPLICA_URIS, and writes set db_wrote_at in the
+    Flask session cookie, so for DB_READ_AFTER_WRITE seconds the
+    client reads from the primary here and in Flask's @read_only views.
+
+    Config (app.config):
+        ASYNC_DATABASE_URI - defaults to SQLALCHEMY_DATABASE_URI with an
+                             async driver (asyncpg, aiosqlite)
+        ASYNC_POOL_SIZE    - pooled connections per worker
+        ASYNC_MAX_OVERFLOW - extra connections allowed under bursts
+'''
+from hashlib import sha1
+import time
+from flask import json
+from itsdangerous import BadSignature
+from sqlalchemy import delete, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import http_date, is_resource_modified, parse_accept_header, quote_etag
+from app import (app, payload_cache, trail_index, coords_arg, detail_coords, invalidate_tiles,
+                 maproute_etag, note_cursor_key)
+from models import db, Trail, Note, User, UserStats
+from paging import decode_cursor, page_limit, split_page
+import payloads
+from routing import WROTE_AT_KEY
+
+app.config.setdefault('ASYNC_DATABASE_URI', None)
+app.config.setdefault('ASYNC_POOL_SIZE', 20)
+app.config.setdefault('ASYNC_MAX_OVERFLOW', 10)
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_uri(uri):
+    '''uri with its backend's async driver'''
+    url = make_url(uri)
+    return str(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]))
+
+
+def async_database_uri(config):
+    '''ASYNC_DATABASE_URI, or the Flask database with its async driver'''
+    if config['ASYNC_DATABASE_URI']:
+        return config['ASYNC_DATABASE_URI']
+    return async_uri(config['SQLALCHEMY_DATABASE_URI'])
+
+
+def session_factory(uri, connect_timeout=None):
+    '''AsyncSession factory on a new pooled engine for uri'''
+    options = {}
+    if not uri.startswith('sqlite'):
+        options = {'pool_size': app.config['ASYNC_POOL_SIZE'],
+                   'max_overflow': app.config['ASYNC_MAX_OVERFLOW'],
+                   'pool_timeout': app.config['DB_POOL_TIMEOUT'] or 30,
+                   'pool_recycle': app.config['DB_POOL_RECYCLE'] or -1,
+                   'pool_pre_ping': app.config['DB_POOL_PRE_PING']}
+        # these engines only serve requests, so the request timeout is engine wide
+        timeout = app.config['DB_STATEMENT_TIMEOUT_MS']
+        if timeout is not None and uri.startswith('postgresql'):
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(timeout)}}
+        if connect_timeout is not None and uri.startswith('postgresql'):
+            options.setdefault('connect_args', {})['timeout'] = connect_timeout
+    return sessionmaker(create_async_engine(uri, **options), class_=AsyncSession,
+                        expire_on_commit=False)
+
+
+_sessions = None
+# replica factories by the replica's Flask engine URL
+_replica_sessions = {}
+
+
+def sessions():
+    ''' AsyncSession factory on the shared engine, created on first use
+        so tests and scripts can set the database URI after import
+    '''
+    global _sessions
+    if _sessions is None:
+        _sessions = session_factory(async_database_uri(app.config))
+    return _sessions
+
+
+def pick_replica():
+    '''routing's choice of a fresh replica engine, None for the primary'''
+    with app.app_context():
+        return db.replica_engine()
+
+
+async def read_sessions(request):
+    ''' AsyncSession factory for a read only view: a fresh replica,
+        or the primary if there is none or the client just wrote
+    '''
+    wrote_at = load_cookie(request).get(WROTE_AT_KEY)
+    if not app.config['DB_REPLICA_URIS'] or (
+            wrote_at is not None and time.time() - wrote_at <= app.config['DB_READ_AFTER_WRITE']):
+        return sessions()
+    # lag checks block, keep them off the event loop
+    replica = await run_in_threadpool(pick_replica)
+    if replica is None:
+        return sessions()
+    uri = str(replica.url)
+    if uri not in _replica_sessions:
+        _replica_sessions[uri] = session_factory(async_uri(uri),
+                                                 app.config['DB_REPLICA_CONNECT_TIMEOUT'])
+    return _replica_sessions[uri]
+
+
+async def dispose():
+    global _sessions
+    factories = list(_replica_sessions.values())
+    if _sessions is not None:
+        factories.append(_sessions)
+    for factory in factories:
+        await factory.kw['bind'].dispose()
+    _sessions = None
+    _replica_sessions.clear()
+
+
+def load_cookie(request):
+    '''Contents of the Flask session cookie, {} if missing or not valid'''
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = request.cookies.get(app.session_cookie_name)
+    if serializer is None or not value:
+        return {}
+    try:
+        return serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def remember_write(request, response):
+    ''' Set db_wrote_at in the Flask session cookie, as routing.py does
+        after a Flask request that wrote
+    '''
+    interface = app.session_interface
+    serializer = interface.get_signing_serializer(app)
+    if serializer is None:
+        return response
+    session = interface.session_class(load_cookie(request))
+    session[WROTE_AT_KEY] = time.time()
+    max_age = None
+    if session.permanent:
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+    response.set_cookie(app.session_cookie_name, serializer.dumps(dict(session)),
+                        max_age=max_age, path=interface.get_cookie_path(app),
+                        domain=interface.get_cookie_domain(app),
+                        secure=interface.get_cookie_secure(app),
+                        httponly=interface.get_cookie_httponly(app),
+                        samesite=interface.get_cookie_samesite(app))
+    return response
+
+
+def error(status, message):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+def json_response(data, status=200):
+    # flask's encoder, so dates serialize as they do in app.py
+    return Response(json.dumps(data), status_code=status, media_type='application/json')
+
+
+def not_modified(request, etag, last_modified=None):
+    '''True if the client's validators still match'''
+    environ = {'REQUEST_METHOD': request.method}
+    for header in ('if-none-match', 'if-modified-since'):
+        if header in request.headers:
+            environ['HTTP_' + header.upper().replace('-', '_')] = request.headers[header]
+    return not is_resource_modified(environ, etag=etag, last_modified=last_modified)
+
+
+def validators(etag, last_modified=None):
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+async def user_trail(session, user_id, trail_id):
+    '''user_id's trail, None if missing or someone else's'''
+    stmt = select(Trail).filter_by(id=trail_id, user_id=user_id).where(Trail.owner_active())
+    return (await session.execute(stmt)).scalar_one_or_none()
+
+
+##############################################################
+#              async views                                   #
+##############################################################
+
+async def get_maproute(request):
+    '''Async app.get_maproute'''
+    user_id = request.path_params['user_id']
+    trail_id = request.path_params['trail_id']
+    zoom = request.query_params.get('zoom')
+    tolerance = request.query_params.get('tolerance')
+    try:
+        zoom_level = int(zoom) if zoom is not None else None
+        tolerance_value = float(tolerance) if tolerance is not None else None
+    except ValueError:
+        return error(400, 'Bad zoom or tolerance')
+
+    factory = await read_sessions(request)
+    async with factory() as session:
+        trail = await user_trail(session, user_id, trail_id)
+        if trail is None:
+            return error(404, 'Trail not found')
+
+        etag = maproute_etag(trail, zoom, tolerance)
+        if not_modified(request, etag, trail.updated_at):
+            return Response(status_code=304, headers=validators(etag, trail.updated_at))
+
+        encoding = payloads.best_encoding(parse_accept_header(
+            request.headers.get('accept-encoding')))
+        key = (trail.id, etag, encoding)
+        body = payload_cache.get(key)
+        if body is None:
+            await session.refresh(trail, ['geometry', 'legacy_coordinates'])
+            # simplify, serialize and compress off the event loop
+            body = await run_in_threadpool(render_maproute, trail, zoom_level,
+                                           tolerance_value, encoding)
+            payload_cache.set(key, body)
+            # rows still stored as text were converted on read, save them;
+            # a replica can't take the write, a later primary read will
+            if trail in session.dirty and factory is sessions():
+                await session.commit()
+
+    headers = validators(etag, trail.updated_at)
+    headers['Vary'] = 'Accept-Encoding'
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(body, media_type='application/json', headers=headers)
+
+
+def render_maproute(trail, zoom, tolerance, encoding):
+    maproute = trail.to_coords_array(detail_coords(trail, zoom, tolerance))
+    return payloads.compress(json.dumps({"maproute": maproute}).encode('utf8'), encoding)
+
+
+async def add_maproute(request):
+    '''Async app.add_maproute'''
+    user_id = request.path_params['user_id']
+    try:
+        data = await request.json()
+        name = data["name"]
+        coords = coords_arg(data["coordinates"])
+    except (KeyError, TypeError, ValueError):
+        return error(400, 'name and coordinates are required')
+
+    trail = Trail(name=name, coordinates=coords, user_id=user_id)
+    # distance and duration are computed here, not trusted from the client
+    await run_in_threadpool(trail.update_stats, coords)
+    async with sessions()() as session:
+        session.add(trail)
+        try:
+            await session.run_sync(lambda sync: (
+                UserStats.apply(user_id, trails=1, distance=trail.distance,
+                                duration=trail.duration, session=sync),
+                User.bump_version(user_id, sync)))
+            await session.commit()
+        except IntegrityError:
+            return error(409, 'Trail name already taken')
+
+    if trail.bbox:
+        trail_index.insert(trail.id, trail.bbox)
+        invalidate_tiles(trail.bbox)
+    return remember_write(request, json_response({"maproute": trail.to_coords_array()}, 201))
+
+
+async def get_trail_notes(request):
+    '''Async app.get_trail_notes'''
+    user_id = request.path_params['user_id']
+    trail_id = request.path_params['trail_id']
+    try:
+        after = decode_cursor(request.query_params.get('after'))
+        if after is not None:
+            after = note_cursor_key(*after)
+        limit = page_limit(request.query_params.get('limit'))
+    except (TypeError, ValueError):
+        return error(400, 'Bad cursor or limit')
+
+    factory = await read_sessions(request)
+    async with factory() as session:
+        if await user_trail(session, user_id, trail_id) is None:
+            return error(404, 'Trail not found')
+        notes = (await session.execute(Note.page_select(trail_id, after, limit + 1))).scalars().all()
+    notes, next_cursor = split_page(notes, limit,
+                                    lambda note: [note.timestamp.isoformat(), note.id])
+
+    # ETag from the body, repeat polls get a bodyless 304
+    body = json.dumps({"notes": [note.to_dict() for note in notes], "next": next_cursor})
+    etag = sha1(body.encode('utf8')).hexdigest()
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=validators(etag))
+    return Response(body, media_type='application/json', headers=validators(etag))
+
+
+async def add_trail_note(request):
+    '''Async app.add_trail_note'''
+    user_id = request.path_params['user_id']
+    trail_id = request.path_params['trail_id']
+    try:
+        comment = (await request.json())['comment']
+    except (KeyError, TypeError, ValueError):
+        return error(400, 'comment is required')
+
+    async with sessions()() as session:
+        if await user_trail(session, user_id, trail_id) is None:
+            return error(404, 'Trail not found')
+        note = Note(comment=comment, trail_id=trail_id)
+        session.add(note)
+        await session.run_sync(lambda sync: (UserStats.apply(user_id, notes=1, session=sync),
+                                             User.bump_version(user_id, sync)))
+        await session.commit()
+
+    return remember_write(request, json_response({"note": note.to_dict()}, 201))
+
+
+async def delete_note(request):
+    '''Async app.delete_note'''
+    user_id = request.path_params['user_id']
+    trail_id = request.path_params['trail_id']
+    note_id = request.path_params['note_id']
+
+    async with sessions()() as session:
+        if await user_trail(session, user_id, trail_id) is None:
+            return error(404, 'Trail not found')
+        deleted = await session.execute(
+            delete(Note).where(Note.id == note_id, Note.trail_id == trail_id))
+        if not deleted.rowcount:
+            return error(404, 'Note not found')
+        await session.run_sync(lambda sync: (UserStats.apply(user_id, notes=-1, session=sync),
+                                             User.bump_version(user_id, sync)))
+        await session.commit()
+
+    return remember_write(request, JSONResponse({"message": "deleted"}))
+
+
+routes = [
+    Route('/users/{user_id:int}/trails/{trail_id:int}/', get_maproute, methods=['GET']),
+    Route('/users/{user_id:int}/trails', add_maproute, methods=['POST']),
+    Route('/users/{user_id:int}/trails/{trail_id:int}/notes', get_trail_notes, methods=['GET']),
+    Route('/users/{user_id:int}/trails/{trail_id:int}/notes', add_trail_note, methods=['POST']),
+    Route('/users/{user_id:int}/trails/{trail_id:int}/notes/{note_id:int}', delete_note,
+          methods=['DELETE']),
+    # everything else is the Flask app, run on the threadpool
+    Mount('/', app=WSGIMiddleware(app)),
+]
+
+application = Starlette(routes=routes, on_shutdown=[dispose])
@@ -0,0 +1,273 @@
+''' Benchmarks for the hot paths, run against a local Postgres
+
+    python benchmark.py                          run and print results
+    python benchmark.py --save bench/base.json   keep a baseline
+    python benchmark.py --compare bench/base.json
+                                                 fail if p50 regressed
+
+    The benchmark database (BENCH_DATABASE_URI or --database) is
+    dropped and rebuilt from a fixed random seed on every run, so runs
+    on the same machine are comparable. Never point it at real data.
+'''
+from statistics import mean
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from seed import random_route
+
+DEFAULT_DATABASE = 'postgresql:///urbanmaps_bench_db'
+VERTEX_SIZES = (10, 1000, 10000, 100000)
+# a p50 slower than baseline by this factor counts as a regression
+REGRESSION_RATIO = 1.2
+
+
+def percentile(ordered, pct):
+    '''Nearest rank percentile of an already sorted list'''
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(timings, elapsed):
+    ''' Latency percentiles (ms) and throughput for one benchmark
+        elapsed - wall clock seconds the whole run took
+    '''
+    ordered = sorted(timings)
+    return {"n": len(ordered),
+            "mean_ms": round(mean(ordered) * 1000, 3),
+            "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+            "p90_ms": round(percentile(ordered, 90) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+            "ops_per_s": round(len(ordered) / elapsed, 1) if elapsed else None}
+
+
+def run(func, iterations, warmup, setup=None):
+    ''' Time func() iterations times after warmup calls
+        setup() runs before every call, e.g. to drop caches; it is left
+        out of the latencies but counts against ops_per_s, which is
+        calls per wall clock second over the whole run
+    '''
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+    timings = []
+    began = time.perf_counter()
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, time.perf_counter() - began)
+
+
+##############################################################
+#              fixture data                                  #
+##############################################################
+
+def build_fixtures(users, trails_per_user, vertex_sizes, seed):
+    ''' Fresh schema with users * trails_per_user trails, plus one
+        trail per vertex size for the size sensitive benchmarks.
+        Returns (user ids, {vertex size: trail id})
+    '''
+    from models import db, User, Trail
+
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    # stored hashes are irrelevant here, skip bcrypt
+    db.session.execute(User.__table__.insert(), [
+        {"username": f"bench{i}", "password": "x", "email": f"bench{i}@example.com",
+         "address": f"{i} Benchmark Way"}
+        for i in range(users)])
+    db.session.commit()
+    user_ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+
+    rows = [Trail.row_for_insert(f"bench {user_id}-{n}",
+                                 random_route(rng, rng.randint(50, 2000)), user_id)
+            for user_id in user_ids for n in range(trails_per_user)]
+    for start in range(0, len(rows), 1000):
+        Trail.insert_many(rows[start:start + 1000])
+    Trail.insert_many([Trail.row_for_insert(f"bench size {size}",
+                                            random_route(rng, size), user_ids[0])
+                       for size in vertex_sizes])
+    db.session.commit()
+
+    sized = dict(db.session.query(Trail.vertex_count, Trail.id)
+                 .filter(Trail.name.like('bench size %')))
+    return user_ids, sized
+
+
+##############################################################
+#              benchmarks                                    #
+##############################################################
+
+def model_benchmarks(sized, iterations, warmup, seed):
+    from models import Trail
+    from coords import pack_coords, unpack_coords
+
+    results = {}
+    rng = random.Random(seed)
+    for size, trail_id in sorted(sized.items()):
+        coords = random_route(rng, size)
+        packed = pack_coords(coords)
+        trail = Trail.query.get(trail_id)
+        trail.geometry  # load the deferred column once
+
+        results[f"Trail.to_coords_array[{size}]"] = run(
+            trail.to_coords_array, iterations, warmup)
+        results[f"Trail.stats_values[{size}]"] = run(
+            lambda: Trail.stats_values(coords), iterations, warmup)
+        results[f"pack_coords[{size}]"] = run(
+            lambda: pack_coords(coords), iterations, warmup)
+        results[f"unpack_coords[{size}]"] = run(
+            lambda: unpack_coords(packed), iterations, warmup)
+    return results
+
+
+def endpoint_benchmarks(user_ids, sized, iterations, warmup, seed):
+    import app as webapp
+    from models import db
+
+    def clear_caches():
+        webapp.lod_cache.clear()
+        webapp.payload_cache.clear()
+
+    def clear_user_caches():
+        webapp.user_cache.clear()
+        webapp.page_cache.clear()
+
+    results = {}
+    rng = random.Random(seed)
+    user_id = user_ids[0]
+    client = webapp.app.test_client()
+    with client.session_transaction() as session:
+        session[webapp.CURR_USER_KEY] = user_id
+
+    def get(url, **kwargs):
+        resp = client.get(url, **kwargs)
+        assert resp.status_code == 200, (url, resp.status_code)
+
+    # rendered pages are cached per user, time misses and hits apart
+    results["get_user"] = run(lambda: get(f'/users/{rng.choice(user_ids)}'),
+                              iterations, warmup, setup=clear_user_caches)
+    results["get_user cached"] = run(lambda: get(f'/users/{user_id}'), iterations, warmup)
+
+    for size, trail_id in sorted(sized.items()):
+        url = f'/users/{user_id}/trails/{trail_id}/'
+        results[f"get_maproute[{size}]"] = run(lambda: get(url), iterations, warmup,
+                                               setup=clear_caches)
+        results[f"get_maproute[{size}] cached"] = run(
+            lambda: get(url, headers={'Accept-Encoding': 'gzip'}), iterations, warmup)
+        results[f"get_maproute[{size}] zoom 12"] = run(
+            lambda: get(url + '?zoom=12'), iterations, warmup, setup=clear_caches)
+
+    counter = iter(range(10 ** 9))
+    for size in (10, 1000):
+        coords = random_route(rng, size)
+
+        def add():
+            resp = client.post(f'/users/{user_id}/trails',
+                               json={"name": f"bench add {next(counter)}",
+                                     "coordinates": coords})
+            assert resp.status_code == 201, resp.status_code
+        results[f"add_maproute[{size}]"] = run(add, iterations, warmup)
+
+    db.session.remove()
+    return results
+
+
+##############################################################
+#              baselines                                     #
+##############################################################
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    ''' (name, baseline p50, p50, ratio) for every benchmark in both
+        runs, and the names of those whose p50 grew by more than ratio
+    '''
+    rows = []
+    regressed = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = stats["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float('inf')
+        rows.append((name, before["p50_ms"], stats["p50_ms"], change))
+        if change > ratio:
+            regressed.append(name)
+    return rows, regressed
+
+
+def print_results(results, out=sys.stdout):
+    out.write(f"{'benchmark':<40}{'n':>6}{'p50 ms':>11}{'p90 ms':>11}"
+              f"{'p99 ms':>11}{'ops/s':>10}\n")
+    for name, stats in results.items():
+        out.write(f"{name:<40}{stats['n']:>6}{stats['p50_ms']:>11.3f}{stats['p90_ms']:>11.3f}"
+                  f"{stats['p99_ms']:>11.3f}{stats['ops_per_s'] or 0:>10.1f}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default=os.environ.get('BENCH_DATABASE_URI', DEFAULT_DATABASE))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--trails-per-user', type=int, default=40)
+    parser.add_argument('--vertices', type=int, nargs='+', default=list(VERTEX_SIZES),
+                        help='trail sizes for the per size benchmarks')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', choices=('model', 'endpoints'))
+    parser.add_argument('--save', metavar='FILE', help='write results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='baseline to check against')
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO)
+    args = parser.parse_args(argv)
+
+    from app import app
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    # fast hashing and no network calls, as in tests.py
+    app.config['BCRYPT_LOG_ROUNDS'] = 4
+    app.config['MATCHING_BACKEND'] = 'stub'
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        user_ids, sized = build_fixtures(args.users, args.trails_per_user,
+                                         args.vertices, args.seed)
+        results = {}
+        if args.only != 'endpoints':
+            results.update(model_benchmarks(sized, args.iterations, args.warmup, args.seed))
+        if args.only != 'model':
+            results.update(endpoint_benchmarks(user_ids, sized, args.iterations,
+                                               args.warmup, args.seed))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"meta": {"python": platform.python_version(),
+                                "machine": platform.machine(),
+                                "args": {k: v for k, v in vars(args).items()
+                                         if k not in ('save', 'compare', 'database')},
+                                "created": time.strftime('%Y-%m-%dT%H:%M:%S')},
+                       "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        rows, regressed = compare(results, baseline, args.ratio)
+        print(f"\n{'benchmark':<40}{'base p50':>11}{'p50':>11}{'change':>9}")
+        for name, before, after, change in rows:
+            flag = '  REGRESSED' if name in regressed else ''
+            print(f"{name:<40}{before:>11.3f}{after:>11.3f}{change:>8.2f}x{flag}")
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
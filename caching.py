@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache:
+    ''' Small thread safe in-process LRU cache
+
+        maxsize - entries kept before the least recently used is evicted
+        ttl     - seconds an entry stays valid, None for no expiry
+        hits/misses - lookup counters
+    '''
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        '''Return cached value for key, or default if missing/expired'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        '''Store value for key, evicting the oldest entries if full'''
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        '''Drop key from the cache if present'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_where(self, predicate):
+        '''Drop every entry whose key matches predicate(key)'''
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,90 @@
+import struct
+from array import array
+from itertools import accumulate
+import sys
+
+# Packed trail geometry
+#
+#   header : magic b'UTC1' + uint32 vertex count (little endian)
+#   body   : int32 pairs [lng, lat] in fixed point (1e-6 degrees),
+#            first vertex absolute, every following vertex as a delta
+#            from the one before it.
+#
+# 1e-6 degrees is ~0.1 m, the same precision Mapbox returns.
+
+MAGIC = b'UTC1'
+SCALE = 1000000
+_HEADER = struct.Struct('<4sI')
+_SWAP = sys.byteorder != 'little'
+
+
+def _deltas(coords, prev_lng=0, prev_lat=0):
+    '''Fixed point deltas of coords, starting from (prev_lng, prev_lat)'''
+    fixed = array('i')
+    for lng, lat in coords:
+        lng = round(lng * SCALE)
+        lat = round(lat * SCALE)
+        fixed.append(lng - prev_lng)
+        fixed.append(lat - prev_lat)
+        prev_lng, prev_lat = lng, lat
+
+    if _SWAP:
+        fixed.byteswap()
+    return fixed
+
+
+def pack_coords(coords):
+    '''Pack a list of [lng, lat] pairs into bytes for the geometry column'''
+    fixed = _deltas(coords)
+    return _HEADER.pack(MAGIC, len(fixed) // 2) + fixed.tobytes()
+
+
+def _body(blob):
+    magic, count = _HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError('Unknown trail geometry format')
+    fixed = array('i')
+    fixed.frombytes(bytes(blob[_HEADER.size:]))
+    if _SWAP:
+        fixed.byteswap()
+    if len(fixed) != count * 2:
+        raise ValueError('Truncated trail geometry')
+    return fixed
+
+
+def unpack_coords(blob):
+    '''Unpack geometry bytes back into a list of [lng, lat] pairs'''
+    fixed = _body(blob)
+    lngs = accumulate(fixed[0::2])
+    lats = accumulate(fixed[1::2])
+    return [[lng / SCALE, lat / SCALE] for lng, lat in zip(lngs, lats)]
+
+
+def last_coord(blob):
+    '''Last [lng, lat] of packed geometry, None if empty'''
+    fixed = _body(blob)
+    if not fixed:
+        return None
+    return [sum(fixed[0::2]) / SCALE, sum(fixed[1::2]) / SCALE]
+
+
+def append_coords(blob, coords):
+    ''' Packed geometry with coords added after the last vertex,
+        the stored vertices are not decoded or re-encoded
+    '''
+    fixed = _body(blob)
+    # the last vertex is the sum of all the deltas
+    tail = _deltas(coords, sum(fixed[0::2]), sum(fixed[1::2]))
+    count = (len(fixed) + len(tail)) // 2
+    return _HEADER.pack(MAGIC, count) + bytes(blob[_HEADER.size:]) + tail.tobytes()
+
+
+def parse_legacy_coords(text):
+    ''' Parse the old postgres array literal format
+        '{{-121.6,36.7},{-121.7,36.8}}' into a list of [lng, lat] pairs
+    '''
+    body = text.strip()[2:-2]
+    if not body:
+        return []
+    return [[float(lng), float(lat)]
+            for lng, lat in (pair.split(',') for pair in body.split('},{'))]
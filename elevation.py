@@ -0,0 +1,164 @@
+import math
+import os
+import numpy as np
+from caching import LRUCache
+from geometry import path_length
+from similarity import resample
+
+# Trail elevation from SRTM .hgt tiles on local disk
+#
+# A tile covers one degree square and is named after its south west
+# corner (N36W122.hgt): side x side big endian int16 heights in
+# meters, rows north to south, side 1201 (3") or 3601 (1"). Tiles
+# are memory mapped, so a lookup only pages in the rows it touches.
+# Trails are sampled every SAMPLE_SPACING_M along their length and
+# heights bilinearly interpolated, all points of a tile at once.
+
+SAMPLE_SPACING_M = 30
+MAX_SAMPLES = 20000
+# stored profile, heights at equal steps from start to end
+PROFILE_POINTS = 100
+# rises smaller than this are DEM noise, not climb
+CLIMB_THRESHOLD_M = 5
+VOID = -32768
+_PROFILE_DTYPE = np.dtype('<f4')
+
+
+def tile_name(lng, lat):
+    '''.hgt file name of the tile holding whole degrees lng, lat'''
+    return (f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}"
+            f"{'E' if lng >= 0 else 'W'}{abs(lng):03d}.hgt")
+
+
+class DemTiles:
+    ''' Memory mapped .hgt tiles from one directory, opened on first use
+
+        Config:
+            ELEVATION_DEM_DIR   - directory of .hgt files, None disables
+                                  elevation
+            ELEVATION_OPEN_TILES - tiles kept mapped at once
+    '''
+
+    def __init__(self, directory=None, open_tiles=64):
+        self.directory = directory
+        # missing tiles are cached too, as False
+        self._tiles = LRUCache(open_tiles)
+
+    def init_app(self, app):
+        app.config.setdefault('ELEVATION_DEM_DIR', None)
+        app.config.setdefault('ELEVATION_OPEN_TILES', 64)
+        self._tiles = LRUCache(app.config['ELEVATION_OPEN_TILES'])
+        self.set_directory(app.config['ELEVATION_DEM_DIR'])
+
+    def set_directory(self, directory):
+        self.directory = directory
+        self._tiles.clear()
+
+    def tile(self, lng, lat):
+        '''(side, side) int16 array of the tile at whole degrees, or None'''
+        tile = self._tiles.get((lng, lat))
+        if tile is None:
+            path = os.path.join(self.directory, tile_name(lng, lat))
+            tile = False
+            if os.path.exists(path):
+                side = math.isqrt(os.path.getsize(path) // 2)
+                tile = np.memmap(path, dtype='>i2', mode='r', shape=(side, side))
+            self._tiles.set((lng, lat), tile)
+        return tile if tile is not False else None
+
+    def heights(self, lngs, lats):
+        ''' Bilinear heights in meters at each lng, lat
+            nan outside the tiles on disk and next to voids
+        '''
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        result = np.full(len(lngs), np.nan)
+        if not self.directory or not len(lngs):
+            return result
+
+        corners = np.column_stack([np.floor(lngs), np.floor(lats)]).astype(int)
+        keys, which = np.unique(corners, axis=0, return_inverse=True)
+        for n, (lng0, lat0) in enumerate(keys):
+            tile = self.tile(int(lng0), int(lat0))
+            if tile is None:
+                continue
+            at = np.flatnonzero(which.ravel() == n)
+            last = tile.shape[0] - 1
+            row = (lat0 + 1 - lats[at]) * last
+            col = (lngs[at] - lng0) * last
+            r0 = np.minimum(row.astype(int), last - 1)
+            c0 = np.minimum(col.astype(int), last - 1)
+            fr, fc = row - r0, col - c0
+
+            cells = [tile[r0, c0], tile[r0, c0 + 1], tile[r0 + 1, c0], tile[r0 + 1, c0 + 1]]
+            h00, h01, h10, h11 = (np.where(cell == VOID, np.nan, cell) for cell in cells)
+            result[at] = ((h00 * (1 - fc) + h01 * fc) * (1 - fr)
+                          + (h10 * (1 - fc) + h11 * fc) * fr)
+        return result
+
+
+def climb(heights, threshold=CLIMB_THRESHOLD_M):
+    ''' Total (gain, loss) in meters along heights, nan skipped
+        Only turns of at least threshold count, from peak to trough
+    '''
+    heights = heights[~np.isnan(heights)]
+    if not len(heights):
+        return None, None
+    gain = loss = 0.0
+    # last counted turn, furthest point since then, and the direction;
+    # until the first turn, the lowest and highest points so far
+    low = high = heights[0]
+    rising = None
+    for height in heights[1:]:
+        if rising is None:
+            low, high = min(low, height), max(high, height)
+            if height - low >= threshold:
+                turn, extreme, rising = low, height, True
+            elif high - height >= threshold:
+                turn, extreme, rising = high, height, False
+        elif rising and height > extreme or not rising and height < extreme:
+            extreme = height
+        elif abs(height - extreme) >= threshold:
+            if rising:
+                gain += extreme - turn
+            else:
+                loss += turn - extreme
+            turn, extreme, rising = extreme, height, not rising
+    if rising:
+        gain += extreme - turn
+    elif rising is not None:
+        loss += turn - extreme
+    return gain, loss
+
+
+def pack_profile(heights):
+    return np.asarray(heights).astype(_PROFILE_DTYPE).tobytes()
+
+
+def unpack_profile(blob):
+    '''Heights from pack_profile(), None where there was no data'''
+    heights = np.frombuffer(blob, dtype=_PROFILE_DTYPE)
+    return [None if math.isnan(h) else round(float(h), 1) for h in heights]
+
+
+def trail_elevation(dem, coords):
+    ''' Elevation column values for a trail: gain and loss in meters
+        and the packed PROFILE_POINTS profile, None without DEM data
+    '''
+    values = {'elevation_gain': None, 'elevation_loss': None, 'elevation_profile': None}
+    if not dem.directory or len(coords) < 2:
+        return values
+
+    samples = int(path_length(coords) // SAMPLE_SPACING_M) + 2
+    points = resample(coords, min(samples, MAX_SAMPLES))
+    heights = dem.heights(points[:, 0], points[:, 1])
+    gain, loss = climb(heights)
+    if gain is None:
+        return values
+
+    # profile at PROFILE_POINTS equal steps of the fine samples
+    along = np.linspace(0, len(heights) - 1, PROFILE_POINTS)
+    profile = np.interp(along, np.arange(len(heights)), heights)
+    values.update(elevation_gain=round(gain, 1), elevation_loss=round(loss, 1),
+                  elevation_profile=pack_profile(profile))
+    return values
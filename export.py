@@ -0,0 +1,81 @@
+from flask import json
+from coords import unpack_coords, parse_legacy_coords
+
+# Streaming export of trails as GeoJSON
+#
+# Everything here is a generator over database rows, so only one
+# trail (and its notes) is in memory at a time however many are
+# exported.
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+}
+
+
+def row_coords(geometry, legacy_coordinates):
+    '''Coordinates from raw trail columns, packed or legacy text'''
+    if geometry is not None:
+        return unpack_coords(geometry)
+    if legacy_coordinates is not None:
+        return parse_legacy_coords(legacy_coordinates)
+    return []
+
+
+def trail_features(trail_rows, note_rows=None):
+    ''' GeoJSON Feature dicts for trail rows
+
+        trail_rows - rows with id, name, distance, duration, user_id,
+                     geometry, legacy_coordinates, ordered by id
+        note_rows  - optional rows with id, comment, timestamp,
+                     trail_id, ordered by trail_id; merged in as the
+                     "notes" property
+    '''
+    notes = iter(note_rows) if note_rows is not None else None
+    pending = next(notes, None) if notes is not None else None
+
+    for trail in trail_rows:
+        properties = {"name": trail.name,
+                      "distance": trail.distance,
+                      "duration": trail.duration,
+                      "user_id": trail.user_id}
+
+        if notes is not None:
+            trail_notes = []
+            # skip notes of trails not exported, collect this trail's
+            while pending is not None and pending.trail_id <= trail.id:
+                if pending.trail_id == trail.id:
+                    trail_notes.append({"id": pending.id,
+                                        "comment": pending.comment,
+                                        "timestamp": pending.timestamp.isoformat()
+                                                     if pending.timestamp else None})
+                pending = next(notes, None)
+            properties["notes"] = trail_notes
+
+        yield {"type": "Feature",
+               "id": trail.id,
+               "geometry": {"type": "LineString",
+                            "coordinates": row_coords(trail.geometry,
+                                                      trail.legacy_coordinates)},
+               "properties": properties}
+
+
+def ndjson(features):
+    '''One GeoJSON Feature per line'''
+    for feature in features:
+        yield json.dumps(feature) + '\n'
+
+
+def feature_collection(features):
+    '''A GeoJSON FeatureCollection, written a feature at a time'''
+    yield '{"type":"FeatureCollection","features":['
+    for i, feature in enumerate(features):
+        yield (',' if i else '') + json.dumps(feature)
+    yield ']}\n'
+
+
+def encode(features, format):
+    '''Chunks of features encoded as format ("ndjson" or "geojson")'''
+    if format == 'ndjson':
+        return ndjson(features)
+    return feature_collection(features)
@@ -0,0 +1,143 @@
+from collections import namedtuple
+import numpy as np
+
+# Server side trail geometry
+#
+# All stats for a trail come from one vectorized pass over its
+# coordinates, so distance/duration no longer depend on what the
+# browser sends.
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_MILE = 1609.344
+# average walking pace, close to the Mapbox walking profile
+WALKING_SPEED_MPS = 1.4
+
+TrailStats = namedtuple('TrailStats', ['length_m', 'bbox', 'vertex_count',
+                                       'segment_min_m', 'segment_max_m',
+                                       'segment_mean_m'])
+
+
+def as_array(coords):
+    '''coords as an (n, 2) float64 array of lng, lat'''
+    return np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+
+
+def haversine(lng1, lat1, lng2, lat2):
+    '''Great-circle distance in meters, arguments in radians (arrays ok)'''
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def segment_lengths(coords):
+    '''Great-circle (haversine) length in meters of each segment'''
+    pts = np.radians(as_array(coords))
+    lng, lat = pts[:, 0], pts[:, 1]
+    return haversine(lng[:-1], lat[:-1], lng[1:], lat[1:])
+
+
+def path_length(coords):
+    '''Length in meters of the line through coords'''
+    return float(segment_lengths(coords).sum()) if len(coords) > 1 else 0.0
+
+
+def distance_to_point(coords, lng, lat):
+    ''' Meters from lng, lat to the nearest point of the trail line,
+        inf for none. Planar around the point, fine within a city.
+    '''
+    pts = as_array(coords)
+    if not len(pts):
+        return float('inf')
+    # meters east/north of the point
+    scale = np.array([np.cos(np.radians(lat)), 1.0]) * np.radians(EARTH_RADIUS_M)
+    local = (pts - [lng, lat]) * scale
+    if len(local) == 1:
+        return float(np.hypot(*local[0]))
+    start, seg = local[:-1], np.diff(local, axis=0)
+    seg_len2 = (seg ** 2).sum(axis=1)
+    # closest point of each segment to the origin
+    t = np.clip(-(start * seg).sum(axis=1) / np.where(seg_len2 > 0, seg_len2, 1), 0, 1)
+    nearest = start + t[:, None] * seg
+    return float(np.hypot(nearest[:, 0], nearest[:, 1]).min())
+
+
+def bounding_box(coords):
+    '''(min_lng, min_lat, max_lng, max_lat), None for no coords'''
+    pts = as_array(coords)
+    if not len(pts):
+        return None
+    min_lng, min_lat = pts.min(axis=0)
+    max_lng, max_lat = pts.max(axis=0)
+    return (float(min_lng), float(min_lat), float(max_lng), float(max_lat))
+
+
+def trail_stats(coords):
+    '''Length, bounding box and segment stats for a list of [lng, lat]'''
+    pts = as_array(coords)
+    segments = segment_lengths(pts)
+    if not len(segments):
+        return TrailStats(0.0, bounding_box(pts), len(pts), 0.0, 0.0, 0.0)
+
+    return TrailStats(length_m=float(segments.sum()),
+                      bbox=bounding_box(pts),
+                      vertex_count=len(pts),
+                      segment_min_m=float(segments.min()),
+                      segment_max_m=float(segments.max()),
+                      segment_mean_m=float(segments.mean()))
+
+
+def to_miles(meters):
+    '''Meters to miles, rounded the way the map page shows them'''
+    return round(meters / METERS_PER_MILE, 2)
+
+
+def walking_minutes(meters, speed_mps=WALKING_SPEED_MPS):
+    '''Estimated walking time in minutes for a distance in meters'''
+    return round(meters / speed_mps / 60, 1)
+
+
+def zoom_tolerance(zoom):
+    ''' Simplification tolerance in degrees of longitude for a map zoom
+        level, about half a pixel on 512px Mapbox GL tiles
+    '''
+    return 360 / (512 * 2 ** zoom) / 2
+
+
+def simplify(coords, tolerance):
+    ''' Douglas-Peucker line simplification
+        tolerance is in degrees of longitude, returns list of [lng, lat]
+    '''
+    pts = as_array(coords)
+    n = len(pts)
+    if n < 3 or tolerance <= 0:
+        return pts.tolist()
+
+    # stretch latitude so both axes match web mercator pixels
+    work = pts.copy()
+    work[:, 1] /= np.cos(np.radians(pts[:, 1].mean()))
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        seg = work[end] - work[start]
+        rel = work[start + 1:end] - work[start]
+        seg_len2 = float(seg @ seg)
+        # distance from each vertex to the segment start..end
+        if seg_len2 == 0:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            t = np.clip(rel @ seg / seg_len2, 0, 1)
+            off = rel - np.outer(t, seg)
+            dist = np.hypot(off[:, 0], off[:, 1])
+        i = int(dist.argmax())
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            keep[mid] = True
+            stack.append((start, mid))
+            stack.append((mid, end))
+
+    return pts[keep].tolist()
@@ -0,0 +1,147 @@
+from threading import Lock
+import json
+import logging
+import random
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per request timing and SQL counting
+#
+# Every request records its wall time, the number of SQL statements
+# it ran and the time spent in them, aggregated by endpoint. A sample
+# of requests (and every slow one) is logged as one JSON line, and the
+# totals are served by the metrics view in app.py.
+
+logger = logging.getLogger('urbantrails.metrics')
+
+
+class EndpointStats:
+    '''Running totals for one endpoint'''
+
+    __slots__ = ('requests', 'errors', 'wall_ms', 'max_wall_ms', 'queries', 'db_ms')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wall_ms = 0.0
+        self.max_wall_ms = 0.0
+        self.queries = 0
+        self.db_ms = 0.0
+
+    def add(self, wall_ms, queries, db_ms, error):
+        self.requests += 1
+        self.errors += error
+        self.wall_ms += wall_ms
+        self.max_wall_ms = max(self.max_wall_ms, wall_ms)
+        self.queries += queries
+        self.db_ms += db_ms
+
+    def to_dict(self):
+        n = self.requests or 1
+        return {"requests": self.requests,
+                "errors": self.errors,
+                "avg_ms": round(self.wall_ms / n, 3),
+                "max_ms": round(self.max_wall_ms, 3),
+                "avg_queries": round(self.queries / n, 2),
+                "avg_db_ms": round(self.db_ms / n, 3)}
+
+
+class RequestMetrics:
+    ''' Flask extension collecting per endpoint request metrics
+
+        METRICS_SAMPLE_RATE - fraction of requests logged, 0 to 1
+        METRICS_SLOW_MS     - requests slower than this are always logged
+        METRICS_LOG_LEVEL   - level of the urbantrails.metrics logger, the
+                              lines are logged at INFO
+    '''
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        self._stats = {}
+        self.started_at = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_SAMPLE_RATE', 0.0)
+        app.config.setdefault('METRICS_SLOW_MS', 500)
+        app.config.setdefault('METRICS_LOG_LEVEL', logging.INFO)
+        self.sample_rate = app.config['METRICS_SAMPLE_RATE']
+        self.slow_ms = app.config['METRICS_SLOW_MS']
+
+        # the root logger drops INFO, give the JSON lines their own
+        # handler unless the deployment configured one
+        logger.setLevel(app.config['METRICS_LOG_LEVEL'])
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.propagate = False
+
+        app.before_request(self._start)
+        app.after_request(self._status)
+        app.teardown_request(self._finish)
+        # once per process, every engine the app opens is counted
+        if not event.contains(Engine, 'before_cursor_execute', _before_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_execute)
+
+    def _start(self):
+        g._metrics_start = time.perf_counter()
+        g._metrics_queries = 0
+        g._metrics_db = 0.0
+
+    def _status(self, response):
+        g._metrics_status = response.status_code
+        return response
+
+    def _finish(self, exc=None):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        wall_ms = (time.perf_counter() - start) * 1000
+        queries = g.pop('_metrics_queries', 0)
+        db_ms = g.pop('_metrics_db', 0.0) * 1000
+        # unhandled exceptions and 5xx responses both count as errors
+        error = exc is not None or g.pop('_metrics_status', 200) >= 500
+        endpoint = request.endpoint or 'unmatched'
+
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.add(wall_ms, queries, db_ms, error)
+
+        if wall_ms >= self.slow_ms or random.random() < self.sample_rate:
+            logger.info(json.dumps({"endpoint": endpoint,
+                                    "method": request.method,
+                                    "path": request.path,
+                                    "wall_ms": round(wall_ms, 3),
+                                    "queries": queries,
+                                    "db_ms": round(db_ms, 3),
+                                    "error": error}))
+
+    def snapshot(self):
+        '''Totals per endpoint, as a JSON ready dict'''
+        with self._lock:
+            endpoints = {name: stats.to_dict() for name, stats in sorted(self._stats.items())}
+        return {"uptime_s": round(time.time() - self.started_at, 1),
+                "endpoints": endpoints}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_metrics_start' in g:
+        conn.info.setdefault('_metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_metrics_query_start')
+    if starts and has_request_context() and '_metrics_start' in g:
+        g._metrics_queries += 1
+        g._metrics_db += time.perf_counter() - starts.pop()
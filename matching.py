@@ -0,0 +1,157 @@
+from concurrent.futures import Future
+from threading import Lock
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import hashlib
+import json
+from geometry import segment_lengths, WALKING_SPEED_MPS
+
+# Server side proxy for the Mapbox Map Matching API
+#
+# Requests are keyed by their quantized coordinates, radiuses and
+# profile, so redrawing the same route is answered from the cache,
+# and identical requests in flight at the same time share one
+# upstream call. The matcher backend is chosen by MATCHING_BACKEND,
+# "stub" gives tests and offline development a local matcher.
+
+PROFILES = ('walking', 'cycling', 'driving', 'driving-traffic')
+MAX_POINTS = 100
+# 1e-5 degrees is ~1 m, well inside any matching radius
+PRECISION = 5
+
+
+class MatchingError(Exception):
+    '''The matching backend could not be reached or failed'''
+
+
+def quantize(coords, precision=PRECISION):
+    return [[round(lng, precision), round(lat, precision)] for lng, lat in coords]
+
+
+def cache_key(backend, profile, coords, radiuses):
+    '''Content address of a matching request'''
+    raw = json.dumps([backend, profile, coords, radiuses], separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf8')).hexdigest()
+
+
+def parse_request(profile, coordinates, radiuses):
+    ''' Validate Mapbox style "lng,lat;lng,lat" and "r;r" arguments
+        Returns (coords, radiuses), raises ValueError if malformed
+    '''
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile {profile}')
+    coords = [[float(value) for value in pair.split(',')] for pair in coordinates.split(';')]
+    if not 2 <= len(coords) <= MAX_POINTS or any(len(pair) != 2 for pair in coords):
+        raise ValueError('Between 2 and 100 lng,lat pairs are needed')
+    if not all(-180 <= lng <= 180 and -90 <= lat <= 90 for lng, lat in coords):
+        raise ValueError('Coordinates out of range')
+    if radiuses:
+        radii = [float(value) for value in radiuses.split(';')]
+        if len(radii) != len(coords) or not all(0 <= r <= 50 for r in radii):
+            raise ValueError('One radius (0-50 m) is needed per coordinate')
+    else:
+        radii = [5.0] * len(coords)
+    return quantize(coords), radii
+
+
+##############################################################
+#              backends                                      #
+##############################################################
+
+class MapboxMatcher:
+    '''Live Mapbox Map Matching API'''
+
+    name = 'mapbox'
+    base_url = 'https://api.mapbox.com/matching/v5/mapbox'
+
+    def __init__(self, config):
+        self.token = config['MAPBOX_TOKEN']
+        self.timeout = config.get('MATCHING_TIMEOUT', 10)
+
+    def match(self, profile, coords, radiuses):
+        path = ';'.join(f'{lng},{lat}' for lng, lat in coords)
+        query = urlencode({'geometries': 'geojson',
+                           'radiuses': ';'.join(f'{r:g}' for r in radiuses),
+                           'steps': 'true',
+                           'access_token': self.token})
+        try:
+            with urlopen(f'{self.base_url}/{profile}/{path}?{query}',
+                         timeout=self.timeout) as resp:
+                return json.load(resp)
+        except (URLError, OSError, ValueError) as err:
+            raise MatchingError(str(err)) from err
+
+
+class StubMatcher:
+    ''' Offline matcher, "matches" the input line exactly
+        Distance and duration are real, at walking pace
+    '''
+
+    name = 'stub'
+
+    def __init__(self, config):
+        pass
+
+    def match(self, profile, coords, radiuses):
+        legs = segment_lengths(coords).tolist()
+        distance = sum(legs)
+        return {
+            "code": "Ok",
+            "matchings": [{
+                "confidence": 1,
+                "geometry": {"type": "LineString", "coordinates": coords},
+                "distance": distance,
+                "duration": distance / WALKING_SPEED_MPS,
+                "legs": [{"distance": leg,
+                          "duration": leg / WALKING_SPEED_MPS,
+                          "steps": [{"maneuver": {"instruction": f"Walk to point {i + 2}"}}]}
+                         for i, leg in enumerate(legs)],
+            }],
+        }
+
+
+BACKENDS = {backend.name: backend for backend in (MapboxMatcher, StubMatcher)}
+
+
+##############################################################
+#              cache and request coalescing                  #
+##############################################################
+
+class MatchingProxy:
+    ''' Cached, coalesced access to a matching backend
+
+        cache - LRUCache of responses by cache_key()
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = Lock()
+        self._in_flight = {}
+
+    def match(self, backend, profile, coords, radiuses):
+        key = cache_key(backend.name, profile, coords, radiuses)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            # same request already on its way upstream, share it
+            return future.result()
+
+        try:
+            result = backend.match(profile, coords, radiuses)
+            self.cache.set(key, result)
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
@@ -0,0 +1,4 @@
+-- Packed binary trail geometry (see coords.py)
+-- Existing text rows are converted the next time they are read.
+ALTER TABLE trails ADD COLUMN geometry BYTEA;
+ALTER TABLE trails ALTER COLUMN coordinates DROP NOT NULL;
@@ -0,0 +1,3 @@
+-- Composite indexes for keyset pagination of trails and notes
+CREATE INDEX ix_trails_user_id_id ON trails (user_id, id);
+CREATE INDEX ix_notes_trail_id_timestamp_id ON notes (trail_id, timestamp, id);
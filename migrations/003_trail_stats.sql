@@ -0,0 +1,7 @@
+-- Server computed trail bounding box and vertex count
+-- Fill existing rows with: flask backfill-trail-stats
+ALTER TABLE trails ADD COLUMN min_lng DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN min_lat DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN max_lng DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN max_lat DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN vertex_count INTEGER;
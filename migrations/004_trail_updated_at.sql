@@ -0,0 +1,2 @@
+-- Row version for trail ETag / Last-Modified headers
+ALTER TABLE trails ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT now();
@@ -0,0 +1,11 @@
+-- Deletes of users and trails rely on the database cascading them
+ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP;
+
+ALTER TABLE trails DROP CONSTRAINT IF EXISTS trails_user_id_fkey;
+ALTER TABLE trails ADD CONSTRAINT trails_user_id_fkey
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE;
+ALTER TABLE notes DROP CONSTRAINT IF EXISTS notes_trail_id_fkey;
+ALTER TABLE notes ADD CONSTRAINT notes_trail_id_fkey
+    FOREIGN KEY (trail_id) REFERENCES trails (id) ON DELETE CASCADE;
+-- the cascades find child rows through ix_trails_user_id_id and
+-- ix_notes_trail_id_timestamp_id (002_pagination_indexes.sql)
@@ -0,0 +1,20 @@
+-- Per user totals, kept current by the app (UserStats in models.py)
+CREATE TABLE user_stats (
+    user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+    trail_count INTEGER NOT NULL DEFAULT 0,
+    note_count INTEGER NOT NULL DEFAULT 0,
+    total_distance DOUBLE PRECISION NOT NULL DEFAULT 0,
+    total_duration DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+-- same as flask rebuild-user-stats
+INSERT INTO user_stats (user_id, trail_count, note_count, total_distance, total_duration)
+SELECT u.id, COALESCE(t.trails, 0), COALESCE(n.notes, 0),
+       COALESCE(t.distance, 0), COALESCE(t.duration, 0)
+FROM users u
+LEFT JOIN (SELECT user_id, count(*) AS trails, sum(distance) AS distance,
+                  sum(duration) AS duration
+           FROM trails GROUP BY user_id) t ON t.user_id = u.id
+LEFT JOIN (SELECT trails.user_id, count(*) AS notes
+           FROM notes JOIN trails ON trails.id = notes.trail_id
+           GROUP BY trails.user_id) n ON n.user_id = u.id;
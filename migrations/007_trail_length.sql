@@ -0,0 +1,3 @@
+-- Unrounded trail length in meters, for incremental geometry edits
+-- Fill existing rows with: flask backfill-trail-stats
+ALTER TABLE trails ADD COLUMN length_m DOUBLE PRECISION;
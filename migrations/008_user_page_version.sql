@@ -0,0 +1,2 @@
+-- Version stamp for cached user pages, bumped by every change they show
+ALTER TABLE users ADD COLUMN page_version INTEGER NOT NULL DEFAULT 0;
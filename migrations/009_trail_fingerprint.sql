@@ -0,0 +1,3 @@
+-- Resampled outline for similar route search (similarity.py)
+-- Fill existing rows with: flask backfill-trail-stats
+ALTER TABLE trails ADD COLUMN fingerprint BYTEA;
@@ -0,0 +1,5 @@
+-- Climb and elevation profile from local DEM tiles (elevation.py)
+-- Fill existing rows with: flask backfill-elevation
+ALTER TABLE trails ADD COLUMN elevation_gain DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN elevation_loss DOUBLE PRECISION;
+ALTER TABLE trails ADD COLUMN elevation_profile BYTEA;
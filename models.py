@@ -1,17 +1,35 @@
-from flask_sqlalchemy import SQLAlchemy
+# pool settings and read replica routing
+from routing import RoutingSQLAlchemy
 from flask_bcrypt import Bcrypt
 from datetime import datetime
-# import ast class for literal_eval() method convert stringdata
-import ast
+from collections import namedtuple
+from sqlalchemy.dialects import postgresql, sqlite
+# packed binary storage for trail coordinates
+from coords import pack_coords, unpack_coords, parse_legacy_coords, append_coords, last_coord
+# trail distance/duration/bbox computed server side
+from geometry import trail_stats, to_miles, walking_minutes, path_length, bounding_box
+# resampled outline for similar route search
+from similarity import fingerprint
+# climb from local DEM tiles
+from elevation import DemTiles, trail_elevation
+# bcrypt hashing off the request thread
+from passwords import PasswordHasher
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 bcrypt = Bcrypt()
+hasher = PasswordHasher(bcrypt)
+dem = DemTiles()
 
 def connect_db(app):
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
+    dem.init_app(app)
 
 
+# Lightweight, cacheable view of a user (no password hash)
+UserIdentity = namedtuple('UserIdentity', ['id', 'username', 'email', 'address'])
+
 
 class User(db.Model):
     """Site user."""
@@ -28,17 +46,24 @@ class User(db.Model):
                          nullable=False)
     address = db.Column(db.Text)
     email = db.Column(db.String(120))
-    
+    # set when a large account is handed to the background purge,
+    # the user is gone for the app from then on
+    deleted_at = db.Column(db.DateTime)
+    # bumped whenever the user page would render differently,
+    # rendered pages are cached against it
+    page_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
+    def to_identity(self):
+        '''Returns a detached UserIdentity record for caching'''
+        return UserIdentity(self.id, self.username, self.email, self.address)
+
     # class method to register user
     @classmethod
     def register(cls, username, password, email, address):
         """Register user w/hashed password & return user."""
 
-        hashed = bcrypt.generate_password_hash(password)
-        # turn bytestring into normal (unicode utf8) string
-        hashed_utf8 = hashed.decode("utf8")
+        hashed_utf8 = hasher.hash(password)
 
         user = User(
             username=username,
@@ -61,53 +86,439 @@ class User(db.Model):
         Return user if valid; else return False.
         """
 
-        u = User.query.filter_by(username=username).first()
+        u = User.query.filter_by(username=username, deleted_at=None).first()
 
-        if u and bcrypt.check_password_hash(u.password, pwd):
+        if u and u.check_password(pwd):
             # return user instance
             return u
         else:
             return False
 
+    @classmethod
+    def delete_by_id(cls, user_id):
+        """ Delete a user with one DELETE statement, trails and notes
+        go with it through ON DELETE CASCADE. Returns rows deleted,
+        caller commits.
+        """
+        return cls.query.filter_by(id=user_id).delete(synchronize_session=False)
+
+    @classmethod
+    def bump_version(cls, user_id, session=None):
+        """Invalidate cached pages of user_id. Caller commits."""
+        (session or db.session).query(cls).filter_by(id=user_id).update(
+            {cls.page_version: cls.page_version + 1}, synchronize_session=False)
+
+    @classmethod
+    def mark_deleted(cls, user_id):
+        """Hide a user until purge() removes it. Returns rows updated."""
+        return (cls.query.filter_by(id=user_id, deleted_at=None)
+                .update({"deleted_at": datetime.utcnow()}, synchronize_session=False))
+
+    @classmethod
+    def purge(cls, user_id, batch_size=1000):
+        """ Delete a user's trails batch_size at a time, committing
+        each batch so no transaction holds many locks, then the user.
+        Returns the number of trails deleted.
+        """
+        count = 0
+        while True:
+            deleted = Trail.delete_batch_for_user(user_id, batch_size)
+            db.session.commit()
+            count += deleted
+            if deleted < batch_size:
+                break
+        cls.delete_by_id(user_id)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def pending_purge_ids(cls):
+        """Ids of users marked deleted but not purged yet."""
+        return [id for id, in db.session.query(cls.id).filter(cls.deleted_at.isnot(None))]
+
+    def check_password(self, pwd):
+        """ Check pwd against this user's hash.
+
+        Rehashes at the current work factor when BCRYPT_LOG_ROUNDS
+        has changed, caller commits.
+        """
+
+        if not hasher.check(self.password, pwd):
+            return False
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(pwd)
+        return True
+
 
 # Map class to define db schema to store user maps
 class Trail(db.Model):
     '''
         Db schema to store user maps
-        map coordinate data is stored as a long string of text
+        map coordinate data is stored packed in the geometry column
+        (see coords.py). Rows saved before that keep their text in
+        the old coordinates column until they are next read.
+
+        Geometry is deferred, it is only loaded when coordinates
+        are used. List views should use summaries_for_user().
 
+        coordinates - list of [lng, lat] pairs, read/write
+        update_stats() - distance/duration/bbox from the coordinates
+        backfill_stats() - update_stats() for every stored trail
         to_coords_array() - converts db record to array format
+        summaries_for_user() - name/distance/duration rows, no geometry
     '''
     __tablename__ = 'trails'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
-    coordinates = db.Column(db.Text, nullable=False)
+    geometry = db.deferred(db.Column(db.LargeBinary), group='geometry')
+    # legacy postgres array literal text, emptied once converted
+    legacy_coordinates = db.deferred(db.Column('coordinates', db.Text),
+                                     group='geometry')
     distance = db.Column(db.Float, nullable=False)
     duration = db.Column(db.Float, nullable=False)
+    # bounding box and size, filled by update_stats()
+    min_lng = db.Column(db.Float)
+    min_lat = db.Column(db.Float)
+    max_lng = db.Column(db.Float)
+    max_lat = db.Column(db.Float)
+    vertex_count = db.Column(db.Integer)
+    # unrounded length, lets geometry edits adjust distance/duration
+    length_m = db.Column(db.Float)
+    # similarity.fingerprint() of the geometry, 128 bytes, None after
+    # an edit until backfill-fingerprints runs
+    fingerprint = db.Column(db.LargeBinary)
+    # meters, from the DEM tiles (elevation.py), None outside them and
+    # after an edit until backfill-elevation runs
+    elevation_gain = db.Column(db.Float)
+    elevation_loss = db.Column(db.Float)
+    elevation_profile = db.deferred(db.Column(db.LargeBinary))
+    # version of the row, for ETag/Last-Modified
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id',
                         ondelete='CASCADE'),
                         nullable=False)
     
-    user = db.relationship('User', backref="trails")
+    # the database cascades deletes, never load trails to delete them
+    user = db.relationship('User', backref=db.backref("trails", passive_deletes=True))
 
-    def to_coords_array(self):
-        ''' Converts mapdata from string to lists
+    # supports keyset pagination of a user's trails
+    __table_args__ = (db.Index('ix_trails_user_id_id', 'user_id', 'id'),)
+
+    @property
+    def coordinates(self):
+        '''Trail coordinates as a list of [lng, lat] pairs'''
+        if self.geometry is None and self.legacy_coordinates is not None:
+            self.migrate_legacy_coordinates()
+        if self.geometry is None:
+            return []
+        return unpack_coords(self.geometry)
+
+    @coordinates.setter
+    def coordinates(self, coords):
+        # accept the old text format as well as lists of pairs
+        if isinstance(coords, str):
+            coords = parse_legacy_coords(coords)
+        self.geometry = pack_coords(coords)
+        self.legacy_coordinates = None
+
+    def migrate_legacy_coordinates(self):
+        ''' Convert a row still stored as text to packed geometry.
+            Returns True if the row changed, caller commits.
+        '''
+        if self.legacy_coordinates is None:
+            return False
+        self.coordinates = self.legacy_coordinates
+        return True
+
+    @staticmethod
+    def stats_values(coords):
+        ''' Column values computed from coordinates: distance (miles),
+            duration (walking minutes), bounding box, vertex count,
+            similarity fingerprint and elevation
+        '''
+        stats = trail_stats(coords)
+        min_lng, min_lat, max_lng, max_lat = stats.bbox or (None, None, None, None)
+        return {'distance': to_miles(stats.length_m),
+                'duration': walking_minutes(stats.length_m),
+                'min_lng': min_lng,
+                'min_lat': min_lat,
+                'max_lng': max_lng,
+                'max_lat': max_lat,
+                'vertex_count': stats.vertex_count,
+                'length_m': stats.length_m,
+                'fingerprint': fingerprint(coords) if coords else None,
+                **trail_elevation(dem, coords)}
+
+    def update_stats(self, coords=None):
+        '''Set the stats_values() columns from the trail coordinates'''
+        values = self.stats_values(self.coordinates if coords is None else coords)
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    def _set_length(self, length_m):
+        self.length_m = length_m
+        self.distance = to_miles(length_m)
+        self.duration = walking_minutes(length_m)
+
+    def append_coordinates(self, coords):
+        ''' Add vertices after the last one. Distance/duration/bbox grow
+            by the new part only; the fingerprint and elevation are
+            marked stale.
+        '''
+        if not coords:
+            return
+        if self.geometry is None or self.length_m is None:
+            # legacy or never measured, start from the full line
+            self.coordinates = self.coordinates + coords
+            self.update_stats()
+            return
+
+        last = last_coord(self.geometry)
+        self.geometry = append_coords(self.geometry, coords)
+        self._set_length(self.length_m + path_length(([last] if last else []) + coords))
+        boxes = [box for box in (self.bbox, bounding_box(coords)) if box]
+        self.min_lng = min(box[0] for box in boxes)
+        self.min_lat = min(box[1] for box in boxes)
+        self.max_lng = max(box[2] for box in boxes)
+        self.max_lat = max(box[3] for box in boxes)
+        self.vertex_count = (self.vertex_count or 0) + len(coords)
+        self._outline_stale()
+
+    def replace_coordinates(self, start, end, coords):
+        ''' Replace vertices start..end-1 with coords (start == end
+            inserts). Distance/duration change by the segments around
+            the replaced range only. Raises IndexError for a bad range.
+        '''
+        current = self.coordinates
+        if not 0 <= start <= end <= len(current):
+            raise IndexError(f'Vertex range {start}:{end} outside 0:{len(current)}')
+        # the replaced vertices plus the neighbours joining them on
+        before = current[max(start - 1, 0):end + 1]
+        after = current[max(start - 1, 0):start] + coords + current[end:end + 1]
+        current[start:end] = coords
+
+        self.coordinates = current
+        if self.length_m is None:
+            self.update_stats(current)
+            return
+        self._set_length(max(self.length_m - path_length(before) + path_length(after), 0.0))
+        min_lng, min_lat, max_lng, max_lat = bounding_box(current) or (None,) * 4
+        self.min_lng, self.min_lat, self.max_lng, self.max_lat = min_lng, min_lat, max_lng, max_lat
+        self.vertex_count = len(current)
+        self._outline_stale()
+
+    def _outline_stale(self):
+        ''' Clear the columns resampled from the whole line, after an
+            edit. backfill_fingerprints() and backfill_elevation() fill
+            them in again, so edits stay proportional to the vertices
+            changed and read no DEM tiles.
+        '''
+        self.fingerprint = None
+        self.elevation_gain = self.elevation_loss = self.elevation_profile = None
+
+    @classmethod
+    def owner_active(cls):
+        ''' Filter hiding trails of users marked deleted but not purged
+            yet, a primary key lookup per trail
+        '''
+        return ~db.exists().where(db.and_(User.id == cls.user_id, User.deleted_at.isnot(None)))
+
+    @classmethod
+    def query_for_user(cls, user_id):
+        '''Trail query limited to user_id's trails, none if deleted'''
+        return cls.query.filter(cls.user_id == user_id, cls.owner_active())
+
+    @classmethod
+    def row_for_insert(cls, name, coords, user_id):
+        '''Column values for a new trail, for use with insert_many()'''
+        row = cls.stats_values(coords)
+        row.update(name=name, geometry=pack_coords(coords), user_id=user_id)
+        return row
+
+    @classmethod
+    def insert_many(cls, rows):
+        ''' Insert row_for_insert() dicts with a single executemany,
+            skipping the ORM unit of work. Caller commits.
+        '''
+        db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def existing_names(cls, names):
+        '''The subset of names already used by stored trails'''
+        rows = db.session.query(cls.name).filter(cls.name.in_(names)).all()
+        return {row.name for row in rows}
+
+    @classmethod
+    def delete_for_user(cls, trail_id, user_id):
+        ''' Delete one of user_id's trails with a single statement,
+            notes are removed by ON DELETE CASCADE. Returns rows
+            deleted, caller commits.
+        '''
+        return (cls.query.filter_by(id=trail_id, user_id=user_id)
+                .delete(synchronize_session=False))
+
+    @classmethod
+    def delete_batch_for_user(cls, user_id, limit):
+        '''Delete up to limit of a user's trails, returns rows deleted'''
+        ids = (db.session.query(cls.id).filter(cls.user_id == user_id)
+               .limit(limit).subquery())
+        return (cls.query.filter(cls.id.in_(db.select(ids.c.id)))
+                .delete(synchronize_session=False))
+
+    @classmethod
+    def backfill_stats(cls, batch_size=500):
+        ''' Recompute stats for every stored trail, batch_size at a time
+            Returns the number of trails updated
+        '''
+        count = 0
+        last_id = 0
+        while True:
+            trails = (cls.query.options(db.undefer_group('geometry'))
+                      .filter(cls.id > last_id)
+                      .order_by(cls.id)
+                      .limit(batch_size)
+                      .all())
+            if not trails:
+                return count
+            for trail in trails:
+                trail.update_stats()
+            db.session.commit()
+            count += len(trails)
+            last_id = trails[-1].id
+            db.session.expunge_all()
+
+    @classmethod
+    def backfill_fingerprints(cls, batch_size=500):
+        ''' Fingerprints for trails edited since theirs was taken
+            Returns the number of trails updated
+        '''
+        count = 0
+        last_id = 0
+        while True:
+            trails = (cls.query.options(db.undefer_group('geometry'))
+                      .filter(cls.id > last_id, cls.fingerprint.is_(None))
+                      .order_by(cls.id)
+                      .limit(batch_size)
+                      .all())
+            if not trails:
+                return count
+            for trail in trails:
+                coords = trail.coordinates
+                trail.fingerprint = fingerprint(coords) if coords else None
+                count += trail.fingerprint is not None
+            db.session.commit()
+            last_id = trails[-1].id
+            db.session.expunge_all()
+
+    @classmethod
+    def backfill_elevation(cls, batch_size=500):
+        ''' Elevation for trails that have none, e.g. after adding DEM
+            tiles. Returns the number of trails that got one.
+        '''
+        count = 0
+        last_id = 0
+        while True:
+            trails = (cls.query.options(db.undefer_group('geometry'))
+                      .filter(cls.id > last_id, cls.elevation_gain.is_(None))
+                      .order_by(cls.id)
+                      .limit(batch_size)
+                      .all())
+            if not trails:
+                return count
+            for trail in trails:
+                for key, value in trail_elevation(dem, trail.coordinates).items():
+                    setattr(trail, key, value)
+                count += trail.elevation_gain is not None
+            db.session.commit()
+            last_id = trails[-1].id
+            db.session.expunge_all()
+
+    @classmethod
+    def summaries_for_user(cls, user_id, after=None, limit=None):
+        ''' Lightweight listing of a user's trails
+            Selects only the summary columns, never the geometry
+
+            after - id of the last trail already seen (keyset cursor)
+            limit - max number of trails to return
+        '''
+        query = (db.session.query(cls.id, cls.name, cls.distance, cls.duration,
+                                  cls.elevation_gain, cls.elevation_loss)
+                 .filter(cls.user_id == user_id, cls.owner_active())
+                 .order_by(cls.id))
+        if after is not None:
+            query = query.filter(cls.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = query.all()
+
+        return [{"id": row.id,
+                 "name": row.name,
+                 "duration": row.duration,
+                 "distance": row.distance,
+                 "elevation_gain": row.elevation_gain,
+                 "elevation_loss": row.elevation_loss} for row in rows]
+
+    @classmethod
+    def bbox_rows(cls):
+        '''(id, bbox) for every trail with a bounding box, no geometry'''
+        rows = (db.session.query(cls.id, cls.min_lng, cls.min_lat,
+                                 cls.max_lng, cls.max_lat)
+                .filter(cls.min_lng.isnot(None), cls.owner_active())
+                .all())
+        return [(row[0], tuple(row[1:])) for row in rows]
+
+    @classmethod
+    def fingerprint_rows(cls, ids):
+        '''(id, fingerprint) of the trails in ids, None if stale'''
+        return (db.session.query(cls.id, cls.fingerprint)
+                .filter(cls.id.in_(ids), cls.owner_active())
+                .all())
+
+    @classmethod
+    def export_rows(cls, user_id, batch_size=100):
+        ''' Every trail of a user as raw rows ordered by id, streamed
+            from a server side cursor batch_size rows at a time
+        '''
+        return (db.session.query(cls.id, cls.name, cls.distance, cls.duration,
+                                 cls.user_id, cls.geometry, cls.legacy_coordinates)
+                .filter(cls.user_id == user_id, cls.owner_active())
+                .order_by(cls.id)
+                .yield_per(batch_size))
+
+    @property
+    def bbox(self):
+        '''(min_lng, min_lat, max_lng, max_lat) or None before update_stats()'''
+        if self.min_lng is None:
+            return None
+        return (self.min_lng, self.min_lat, self.max_lng, self.max_lat)
+
+    def to_summary(self):
+        '''Formats trail for listings, without coordinates'''
+        return {"id": self.id,
+                "name": self.name,
+                "duration": self.duration,
+                "distance": self.distance,
+                "elevation_gain": self.elevation_gain,
+                "elevation_loss": self.elevation_loss,
+                "user_id": self.user_id}
+
+    def to_coords_array(self, coords=None):
+        ''' Converts mapdata from packed geometry to lists
             Sets up data in dictionary format
             Facilitates JSON conversion
+
+            coords - send these (e.g. simplified) instead of the
+                     stored coordinates, geometry is then not loaded
         '''
-        # convert mapdata text string to list of coordinates
-        coords_text = self.coordinates.replace("{{", '[[').replace('},{', '],[').replace('}}', ']]')
-        # convert to arrays
-        coords_arr = ast.literal_eval(coords_text)
-        
         # compose and return dicationary
         return {
             'id'   : self.id,
             'name': self.name,
             'distance': self.distance,
             'duration': self.duration,
-            'coordinates' : coords_arr,
+            'coordinates' : self.coordinates if coords is None else coords,
             'user_id': self.user_id
         }
 
@@ -127,11 +538,151 @@ class Note(db.Model):
                    primary_key=True, 
                    autoincrement=True)
     comment = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     trail_id = db.Column(db.Integer,
                         db.ForeignKey('trails.id',
                         ondelete='CASCADE'),
                         nullable=False)
 
-    trail = db.relationship('Trail', backref="notes")
-    
\ No newline at end of file
+    trail = db.relationship('Trail', backref=db.backref("notes", passive_deletes=True))
+
+    # supports keyset pagination of a trail's notes
+    __table_args__ = (db.Index('ix_notes_trail_id_timestamp_id',
+                               'trail_id', 'timestamp', 'id'),)
+
+    @classmethod
+    def page_for_trail(cls, trail_id, after=None, limit=None):
+        ''' Notes for a trail, oldest first
+
+            after - (timestamp, id) of the last note already seen
+            limit - max number of notes to return
+        '''
+        return db.session.execute(cls.page_select(trail_id, after, limit)).scalars().all()
+
+    @classmethod
+    def page_select(cls, trail_id, after=None, limit=None):
+        '''The page_for_trail() SELECT, also run by asgi.py'''
+        stmt = (db.select(cls).where(cls.trail_id == trail_id)
+                .order_by(cls.timestamp, cls.id))
+        if after is not None:
+            stmt = stmt.where(db.tuple_(cls.timestamp, cls.id) > tuple(after))
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @classmethod
+    def export_rows(cls, user_id, batch_size=500):
+        ''' Notes on every trail of a user ordered by trail, streamed
+            from a server side cursor batch_size rows at a time
+        '''
+        return (db.session.query(cls.id, cls.comment, cls.timestamp, cls.trail_id)
+                .join(Trail, Trail.id == cls.trail_id)
+                .filter(Trail.user_id == user_id, Trail.owner_active())
+                .order_by(cls.trail_id, cls.timestamp, cls.id)
+                .yield_per(batch_size))
+
+    def to_dict(self):
+        '''Formats note for JSON conversion'''
+        return {"id": self.id,
+                "comment": self.comment,
+                "timestamp": self.timestamp,
+                "trail_id": self.trail_id}
+    
+
+class UserStats(db.Model):
+    '''
+        Running totals of a user's trails and notes, so pages can show
+        them without aggregating over every trail. Kept current by
+        apply() next to each change; rebuild() recomputes them.
+    '''
+
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='CASCADE'),
+                        primary_key=True)
+    trail_count = db.Column(db.Integer, nullable=False, default=0)
+    note_count = db.Column(db.Integer, nullable=False, default=0)
+    # miles and minutes, as Trail.distance and Trail.duration
+    total_distance = db.Column(db.Float, nullable=False, default=0)
+    total_duration = db.Column(db.Float, nullable=False, default=0)
+
+    @classmethod
+    def apply(cls, user_id, trails=0, notes=0, distance=0.0, duration=0.0, session=None):
+        ''' Add deltas to a user's totals with one UPDATE. A user with
+            no row yet gets one from rebuild(), which already counts
+            the change. Caller commits, with the change itself.
+
+            session - defaults to db.session (asgi.py passes its own)
+        '''
+        session = session or db.session
+        session.flush()
+        updated = (session.query(cls).filter_by(user_id=user_id)
+                   .update({cls.trail_count: cls.trail_count + trails,
+                            cls.note_count: cls.note_count + notes,
+                            cls.total_distance: cls.total_distance + (distance or 0),
+                            cls.total_duration: cls.total_duration + (duration or 0)},
+                           synchronize_session=False))
+        if not updated:
+            cls.rebuild(user_id, session)
+
+    @classmethod
+    def rebuild(cls, user_id=None, session=None):
+        ''' Recompute totals from trails and notes for one user, or for
+            everyone, as one INSERT ... SELECT ... ON CONFLICT UPDATE,
+            so concurrent rebuilds of one user don't collide. Caller
+            commits.
+        '''
+        func = db.func
+        trails = (db.select(Trail.user_id,
+                            func.count(Trail.id).label('trails'),
+                            func.sum(Trail.distance).label('distance'),
+                            func.sum(Trail.duration).label('duration'))
+                  .group_by(Trail.user_id))
+        notes = (db.select(Trail.user_id, func.count(Note.id).label('notes'))
+                 .join(Note, Note.trail_id == Trail.id)
+                 .group_by(Trail.user_id))
+        users = db.select(User.id)
+        session = session or db.session
+        if user_id is not None:
+            trails = trails.where(Trail.user_id == user_id)
+            notes = notes.where(Trail.user_id == user_id)
+            users = users.where(User.id == user_id)
+        trails = trails.subquery()
+        notes = notes.subquery()
+        users = users.subquery()
+
+        rows = (db.select(users.c.id,
+                          func.coalesce(trails.c.trails, 0),
+                          func.coalesce(notes.c.notes, 0),
+                          func.coalesce(trails.c.distance, 0),
+                          func.coalesce(trails.c.duration, 0))
+                .select_from(users
+                             .outerjoin(trails, trails.c.user_id == users.c.id)
+                             .outerjoin(notes, notes.c.user_id == users.c.id))
+                # sqlite needs a WHERE to parse INSERT ... SELECT ... ON CONFLICT
+                .where(db.true()))
+        dialect = sqlite if session.bind.dialect.name == 'sqlite' else postgresql
+        insert = dialect.insert(cls.__table__).from_select(
+            ['user_id', 'trail_count', 'note_count', 'total_distance', 'total_duration'],
+            rows)
+        session.execute(insert.on_conflict_do_update(
+            index_elements=['user_id'],
+            set_={column: insert.excluded[column] for column in
+                  ('trail_count', 'note_count', 'total_distance', 'total_duration')}))
+
+    @classmethod
+    def for_user(cls, user_id):
+        '''Totals for user_id, rebuilt and committed on first use'''
+        stats = cls.query.get(user_id)
+        if stats is None:
+            cls.rebuild(user_id)
+            db.session.commit()
+            stats = cls.query.get(user_id)
+        return stats
+
+    def to_dict(self):
+        return {"trail_count": self.trail_count,
+                "note_count": self.note_count,
+                "total_distance": round(self.total_distance, 2),
+                "total_duration": round(self.total_duration, 1)}
@@ -0,0 +1,51 @@
+import base64
+import json
+
+# Keyset (cursor) pagination helpers
+#
+# A cursor is the sort key of the last row a client has seen, packed
+# into an opaque url safe string. The next page is every row whose
+# key sorts after it, so no OFFSET scans are needed.
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(*values):
+    '''Pack sort key values into an opaque cursor string'''
+    raw = json.dumps(values, separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    ''' Unpack a cursor made by encode_cursor()
+        Returns None for no cursor, raises ValueError if malformed
+    '''
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError as err:
+        raise ValueError(f'Bad cursor: {cursor}') from err
+
+    if not isinstance(values, list):
+        raise ValueError(f'Bad cursor: {cursor}')
+    return values
+
+
+def page_limit(value):
+    '''Page size from a query arg, clamped to 1..MAX_PAGE_SIZE'''
+    if value is None:
+        return PAGE_SIZE
+    return max(1, min(int(value), MAX_PAGE_SIZE))
+
+
+def split_page(rows, limit, key):
+    ''' Split rows fetched with limit + 1 into (page, next cursor)
+        key(row) returns the sort key values of a row
+        next cursor is None on the last page
+    '''
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
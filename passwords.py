@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from flask import current_app
+import os
+
+
+class PasswordHasherBusy(Exception):
+    '''Raised when too many password hashes are already queued'''
+
+
+class PasswordHasher:
+    ''' Runs bcrypt hashing on a small dedicated thread pool
+
+        bcrypt releases the GIL, so hashing on a bounded pool caps the
+        CPU that login bursts can take from other requests. Work past
+        the queue limit is refused with PasswordHasherBusy instead of
+        piling up behind it.
+
+        Config:
+            BCRYPT_LOG_ROUNDS     - bcrypt work factor for new hashes
+            PASSWORD_HASH_WORKERS - pool threads (default cpu count)
+            PASSWORD_HASH_QUEUE   - hashes allowed to wait for a thread
+    '''
+
+    def __init__(self, bcrypt, app=None):
+        self.bcrypt = bcrypt
+        self._executor = None
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 32)
+
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+
+    def _run(self, fn, *args):
+        '''Run fn on the pool and wait for the result'''
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    @property
+    def rounds(self):
+        return current_app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash(self, password):
+        '''Hash password at the configured work factor, returns str'''
+        hashed = self._run(self.bcrypt.generate_password_hash,
+                           password, self.rounds)
+        # turn bytestring into normal (unicode utf8) string
+        return hashed.decode("utf8")
+
+    def check(self, hashed, password):
+        '''True if password matches hashed, False for bad/unknown hashes'''
+        try:
+            return self._run(self.bcrypt.check_password_hash, hashed, password)
+        except ValueError:
+            return False
+
+    def needs_rehash(self, hashed):
+        '''True if hashed was made with a different work factor'''
+        try:
+            # bcrypt hashes look like $2b$<rounds>$<salt+hash>
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
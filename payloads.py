@@ -0,0 +1,25 @@
+import gzip
+
+# brotli is optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response body compression for cached JSON payloads
+
+ENCODINGS = ('br', 'gzip', 'identity') if brotli else ('gzip', 'identity')
+
+
+def best_encoding(accept_encodings):
+    '''Pick a Content-Encoding from a request's Accept-Encoding'''
+    return accept_encodings.best_match(ENCODINGS, default='identity')
+
+
+def compress(data, encoding):
+    '''data (bytes) encoded for Content-Encoding encoding'''
+    if encoding == 'br':
+        return brotli.compress(data)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
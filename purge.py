@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from models import db, User
+
+
+class UserPurger:
+    ''' Deletes large accounts on a background thread
+
+        delete_user marks the user deleted (so it can no longer log in
+        or be seen) and returns, the trails are then removed here in
+        batches. Users left marked by a restart are finished by the
+        purge-users command.
+
+        Config:
+            PURGE_ASYNC_TRAILS - accounts with more trails than this are
+                                 purged in the background, None for never
+            PURGE_BATCH_SIZE   - trails deleted per transaction
+    '''
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURGE_ASYNC_TRAILS', 5000)
+        app.config.setdefault('PURGE_BATCH_SIZE', 1000)
+        self.app = app
+        # one purge at a time, they are rare and IO bound
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purge')
+
+    def submit(self, user_id):
+        '''Purge user_id in the background, returns a Future'''
+        return self._executor.submit(self.purge, user_id)
+
+    def wait(self):
+        '''Block until every purge submitted so far has finished'''
+        self._executor.submit(lambda: None).result()
+
+    def purge(self, user_id):
+        '''Purge user_id now, returns the number of trails deleted'''
+        with self.app.app_context():
+            try:
+                count = User.purge(user_id, self.app.config['PURGE_BATCH_SIZE'])
+                self.app.logger.info('Purged user %s with %d trails', user_id, count)
+                return count
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Purge of user %s failed', user_id)
+                raise
+            finally:
+                db.session.remove()
@@ -0,0 +1,186 @@
+''' Connection pool settings and read replica routing
+
+    db = RoutingSQLAlchemy() is a drop in Flask-SQLAlchemy. Views
+    marked @read_only send their SELECTs to a replica; flushes, DML
+    and everything outside those views use the primary. Within a
+    request, once anything was written, reads go to the primary too.
+    Replicas further behind than DB_REPLICA_MAX_LAG are skipped, and
+    with none left reads fall back to the primary.
+
+    The statement timeout applies to transactions begun while handling
+    a request. CLI commands, seeding and the background purger run
+    outside one and are not cut off.
+
+    Config (app.config):
+        DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT / DB_POOL_RECYCLE
+                                - per engine pool, None for the default
+        DB_POOL_PRE_PING        - test connections before use
+        DB_STATEMENT_TIMEOUT_MS - Postgres statement_timeout in requests,
+                                  None for none
+        DB_REPLICA_URIS         - read replica URIs, empty for none
+        DB_REPLICA_MAX_LAG      - seconds of replay lag a replica may have
+        DB_REPLICA_LAG_CHECK    - seconds between lag measurements
+        DB_REPLICA_CONNECT_TIMEOUT - seconds to wait for a replica
+                                  connection, so a dead replica holds
+                                  up a request at most this long
+        DB_READ_AFTER_WRITE     - seconds a client that wrote keeps
+                                  reading from the primary
+'''
+from functools import wraps
+from threading import Lock
+import random
+import time
+from flask import current_app, g, has_request_context, session as cookie
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+
+# 0 when the replica has replayed all it received, else seconds behind
+LAG_SQL = ('SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+           'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+WROTE_AT_KEY = 'db_wrote_at'
+
+
+def read_only(view):
+    '''Let view read from a replica, unless the client just wrote'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        wrote_at = cookie.get(WROTE_AT_KEY)
+        window = current_app.config['DB_READ_AFTER_WRITE']
+        g.db_read_only = wrote_at is None or time.time() - wrote_at > window
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaSet:
+    ''' Engines for the read replicas, with their lag measured at most
+        every check_interval seconds. Unreachable replicas count as
+        infinitely behind.
+    '''
+
+    def __init__(self, engines, max_lag, check_interval):
+        self.engines = engines
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag = {}
+        self._lock = Lock()
+
+    def measure(self, engine):
+        '''Seconds engine is behind the primary'''
+        try:
+            with engine.connect() as conn:
+                return float(conn.execute(LAG_SQL).scalar() or 0)
+        except Exception:
+            return float('inf')
+
+    def lag(self, engine):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._lag.get(engine, (None, None))
+            if checked_at is not None and now - checked_at < self.check_interval:
+                return lag
+        lag = self.measure(engine)
+        with self._lock:
+            self._lag[engine] = (now, lag)
+        return lag
+
+    def pick(self):
+        '''A random replica that is not too far behind, or None'''
+        fresh = [engine for engine in self.engines if self.lag(engine) <= self.max_lag]
+        return random.choice(fresh) if fresh else None
+
+
+class RoutingSession(SignallingSession):
+    '''Session that binds reads in @read_only views to a replica'''
+
+    def __init__(self, db, **options):
+        self.db = db
+        self._wrote = False
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._wrote and mapper is not None and not self._flushing
+                and getattr(clause, 'is_select', False)
+                and has_request_context() and g.get('db_read_only')):
+            replica = self.db.replica_engine()
+            if replica is not None:
+                return replica
+        elif self._flushing or getattr(clause, 'is_dml', False):
+            self._wrote = True
+            if has_request_context():
+                g.db_wrote = True
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy with configurable pools and RoutingSession'''
+
+    def init_app(self, app):
+        app.config.setdefault('DB_POOL_SIZE', None)
+        app.config.setdefault('DB_MAX_OVERFLOW', None)
+        app.config.setdefault('DB_POOL_TIMEOUT', None)
+        app.config.setdefault('DB_POOL_RECYCLE', None)
+        app.config.setdefault('DB_POOL_PRE_PING', True)
+        app.config.setdefault('DB_STATEMENT_TIMEOUT_MS', None)
+        app.config.setdefault('DB_REPLICA_URIS', [])
+        app.config.setdefault('DB_REPLICA_MAX_LAG', 5)
+        app.config.setdefault('DB_REPLICA_LAG_CHECK', 2)
+        app.config.setdefault('DB_REPLICA_CONNECT_TIMEOUT', 2)
+        app.config.setdefault('DB_READ_AFTER_WRITE', 10)
+        self._replicas = None
+        self._replicas_for = None
+        self._replicas_lock = Lock()
+        super().init_app(app)
+
+        @app.after_request
+        def remember_write(response):
+            # the client reads its own writes from the primary for a while
+            if g.get('db_wrote'):
+                cookie[WROTE_AT_KEY] = time.time()
+            return response
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_begin', self.limit_statements)
+        return factory
+
+    def limit_statements(self, session, transaction, connection):
+        '''SET LOCAL statement_timeout in transactions begun by a request'''
+        timeout = self.get_app().config['DB_STATEMENT_TIMEOUT_MS']
+        if (timeout is not None and has_request_context()
+                and connection.dialect.name == 'postgresql'):
+            connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        # sqlite has no server to pool connections to
+        if sa_url.get_backend_name() == 'sqlite':
+            return sa_url, options
+        for option in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+            value = app.config['DB_' + option.upper()]
+            if value is not None:
+                options[option] = value
+        options['pool_pre_ping'] = app.config['DB_POOL_PRE_PING']
+        return sa_url, options
+
+    def replica_engine(self):
+        '''Engine of a usable replica, None to read from the primary'''
+        app = self.get_app()
+        uris = tuple(app.config['DB_REPLICA_URIS'])
+        if not uris:
+            return None
+        with self._replicas_lock:
+            if self._replicas_for != uris:
+                engines = []
+                for uri in uris:
+                    sa_url, options = self.apply_driver_hacks(
+                        app, make_url(uri), self.apply_pool_defaults(app, {}))
+                    options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                    if sa_url.get_backend_name() == 'postgresql':
+                        connect_args = options.setdefault('connect_args', {})
+                        connect_args['connect_timeout'] = app.config['DB_REPLICA_CONNECT_TIMEOUT']
+                    engines.append(self.create_engine(sa_url, options))
+                self._replicas = ReplicaSet(engines, app.config['DB_REPLICA_MAX_LAG'],
+                                            app.config['DB_REPLICA_LAG_CHECK'])
+                self._replicas_for = uris
+        return self._replicas.pick()
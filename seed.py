@@ -1,25 +1,271 @@
-from models import db, connect_db, User, Trail, Note
-from app import app
+''' Seed the database
 
-db.drop_all()
-db.create_all()
+    python seed.py                   demo user, trail and note
+    python seed.py --users 1000000   synthetic users, trails and notes
 
-user1 = User(username='demoname', password='password', address = '29 Wellbeing circle, Carmel Valley, CA')
-db.session.add(user1)
-db.session.commit()
+    Synthetic data is written with Postgres COPY by parallel worker
+    processes. Users are split into chunks and every chunk is
+    generated from its own random stream derived from --seed, so the
+    same arguments give the same database whatever --workers is.
+    Both modes drop and recreate all tables.
+'''
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+import argparse
+import io
+import math
+import os
+import random
+import sys
+from sqlalchemy.engine.url import make_url
+from models import db, hasher, User, Trail, Note, UserStats
 
-map1 = Trail(name='Demo Map', distance=3.5,
-                                duration=35.4,
-                                coordinates=[[-121.603451,36.704384],
-                                            [-121.604256,36.704232],
-                                            [-121.605525,36.703853]],
-                                user_id=1)
+# walks start near one of these (lng, lat), trails cluster like real users
+CITIES = [(-121.894, 36.600), (-122.419, 37.775), (-118.243, 34.052),
+          (-122.676, 45.523), (-122.332, 47.606), (-104.990, 39.739),
+          (-87.630, 41.878), (-73.986, 40.748), (-71.059, 42.360),
+          (-77.037, 38.907), (-84.388, 33.749), (-97.743, 30.267)]
+STREETS = ['Oak', 'Pine', 'Main', 'Elm', 'Ocean', 'Park', 'Cedar', 'Hill',
+           'Lake', 'River', 'Mission', 'Church', 'Valley', 'Forest']
+ROUTE_WORDS = ['Loop', 'Walk', 'Stroll', 'Ramble', 'Trail', 'Circuit', 'Path']
+COMMENTS = ['Really awesome route', 'Muddy after rain', 'Great views at the top',
+            'Busy on weekends', 'Good for a morning walk', 'Steep in places',
+            'Shady most of the way', 'Dog friendly', 'Coffee stop halfway']
+EPOCH = datetime(2021, 1, 1)
+# median trail vertex count, log-normal spread, hard limits
+VERTEX_MEDIAN = 250
+VERTEX_SIGMA = 0.9
+VERTEX_RANGE = (2, 20000)
 
 
-db.session.add(map1)
-db.session.commit()
+def random_route(rng, vertices, start=None, step=0.0002):
+    ''' Random walk of vertices [lng, lat] points, about 20 m apart,
+        heading drifting slowly like a real walk
+    '''
+    lng, lat = start or (rng.uniform(-122.5, -71.0), rng.uniform(30.0, 47.0))
+    heading = rng.uniform(0, 2 * math.pi)
+    coords = []
+    for _ in range(vertices):
+        coords.append([round(lng, 6), round(lat, 6)])
+        heading += rng.gauss(0, 0.3)
+        lng += step * math.cos(heading) / math.cos(math.radians(lat))
+        lat += step * math.sin(heading)
+    return coords
 
-note1 = Note(comment='Really awesome route', trail_id=1)
 
-db.session.add(note1)
-db.session.commit()
\ No newline at end of file
+def seed_demo():
+    '''The original single user demo data'''
+    db.drop_all()
+    db.create_all()
+
+    user1 = User(username='demoname', password='password', address = '29 Wellbeing circle, Carmel Valley, CA')
+    db.session.add(user1)
+    db.session.commit()
+
+    map1 = Trail(name='Demo Map',
+                                    coordinates=[[-121.603451,36.704384],
+                                                [-121.604256,36.704232],
+                                                [-121.605525,36.703853]],
+                                    user_id=1)
+    # distance, duration, bbox, fingerprint and elevation
+    map1.update_stats()
+
+    db.session.add(map1)
+    db.session.commit()
+
+    note1 = Note(comment='Really awesome route', trail_id=1)
+
+    db.session.add(note1)
+    db.session.commit()
+
+
+##############################################################
+#              synthetic data                                #
+##############################################################
+
+def plan_chunk(seed, chunk, users, trails_per_user, notes_per_trail):
+    ''' Trail count of each user and note count of each trail in a
+        chunk, from the chunk's own stream so the parent can size id
+        ranges without generating any geometry
+    '''
+    rng = random.Random(f'{seed}:{chunk}:plan')
+    trails = [int(rng.expovariate(1 / trails_per_user)) if trails_per_user else 0
+              for _ in range(users)]
+    notes = [int(rng.expovariate(1 / notes_per_trail)) if notes_per_trail else 0
+             for _ in range(sum(trails))]
+    return trails, notes
+
+
+def _copy_value(value):
+    '''value in Postgres COPY text format'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value)
+
+
+class CopyWriter:
+    ''' Buffers rows for one table, COPYs them every flush_rows rows
+
+        The generated text never holds tabs, newlines or backslashes,
+        so values are not escaped beyond _copy_value().
+    '''
+
+    def __init__(self, cursor, table, columns, flush_rows=5000, parent=None):
+        self.cursor = cursor
+        # rows referenced by ours, flushed first for the foreign keys
+        self.parent = parent
+        self.sql = f'COPY {table} ({", ".join(columns)}) FROM STDIN'
+        self.flush_rows = flush_rows
+        self.rows = 0
+        self.buf = io.StringIO()
+
+    def write(self, values):
+        self.buf.write('\t'.join(_copy_value(value) for value in values))
+        self.buf.write('\n')
+        self.rows += 1
+        if self.rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.parent:
+            self.parent.flush()
+        if self.rows:
+            self.buf.seek(0)
+            self.cursor.copy_expert(self.sql, self.buf)
+        self.buf = io.StringIO()
+        self.rows = 0
+
+
+TRAIL_COLUMNS = ['id', 'name', 'distance', 'duration', 'geometry', 'min_lng', 'min_lat',
+                 'max_lng', 'max_lat', 'vertex_count', 'length_m', 'fingerprint', 'updated_at',
+                 'user_id']
+
+
+def write_chunk(job):
+    ''' Generate and COPY one chunk of users with their trails and notes,
+        in one transaction. Runs in a worker process.
+    '''
+    import psycopg2
+
+    (dsn, seed, chunk, first_user, first_trail, first_note, users,
+     trails_per_user, notes_per_trail, password) = job
+    trail_counts, note_counts = plan_chunk(seed, chunk, users, trails_per_user,
+                                           notes_per_trail)
+    rng = random.Random(f'{seed}:{chunk}:data')
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cursor:
+            user_rows = CopyWriter(cursor, 'users', ['id', 'username', 'password',
+                                                     'address', 'email'])
+            trail_rows = CopyWriter(cursor, 'trails', TRAIL_COLUMNS, flush_rows=1000,
+                                    parent=user_rows)
+            note_rows = CopyWriter(cursor, 'notes', ['id', 'comment', 'timestamp', 'trail_id'],
+                                   parent=trail_rows)
+
+            trail_id = first_trail
+            note_id = first_note
+            for user_id, count in enumerate(trail_counts, first_user):
+                city = rng.choice(CITIES)
+                user_rows.write((user_id, f'user{user_id}', password,
+                                 f'{rng.randint(1, 9999)} {rng.choice(STREETS)} St',
+                                 f'user{user_id}@example.com'))
+
+                for _ in range(count):
+                    start = (city[0] + rng.gauss(0, 0.05), city[1] + rng.gauss(0, 0.05))
+                    vertices = int(rng.lognormvariate(math.log(VERTEX_MEDIAN), VERTEX_SIGMA))
+                    vertices = min(max(vertices, VERTEX_RANGE[0]), VERTEX_RANGE[1])
+                    name = f'{rng.choice(STREETS)} {rng.choice(ROUTE_WORDS)} {trail_id}'
+                    created = EPOCH + timedelta(seconds=rng.randrange(3 * 365 * 86400))
+
+                    row = Trail.row_for_insert(name, random_route(rng, vertices, start), user_id)
+                    row.update(id=trail_id, updated_at=created)
+                    trail_rows.write([row[column] for column in TRAIL_COLUMNS])
+
+                    for _ in range(note_counts[trail_id - first_trail]):
+                        note_rows.write((note_id, rng.choice(COMMENTS),
+                                         created + timedelta(seconds=rng.randrange(90 * 86400)),
+                                         trail_id))
+                        note_id += 1
+                    trail_id += 1
+
+            note_rows.flush()
+    finally:
+        conn.close()
+    return users, trail_id - first_trail, note_id - first_note
+
+
+def seed_bulk(database, users, trails_per_user=8.0, notes_per_trail=0.5,
+              seed=1, workers=None, chunk_size=5000, password='password'):
+    ''' Fresh schema filled with synthetic data, returns
+        (users, trails, notes) written
+    '''
+    db.drop_all()
+    db.create_all()
+    # one hash for everyone, hashing millions of passwords takes days
+    password_hash = hasher.hash(password)
+    # worker processes make their own connections
+    db.engine.dispose()
+
+    dsn = make_url(database).set(drivername='postgresql').render_as_string(hide_password=False)
+    jobs = []
+    first_trail = first_note = 1
+    for chunk, first_user in enumerate(range(1, users + 1, chunk_size)):
+        size = min(chunk_size, users + 1 - first_user)
+        trail_counts, note_counts = plan_chunk(seed, chunk, size, trails_per_user,
+                                               notes_per_trail)
+        jobs.append((dsn, seed, chunk, first_user, first_trail, first_note, size,
+                     trails_per_user, notes_per_trail, password_hash))
+        first_trail += sum(trail_counts)
+        first_note += sum(note_counts)
+
+    totals = [0, 0, 0]
+    with Pool(workers or os.cpu_count()) as pool:
+        for done in pool.imap_unordered(write_chunk, jobs):
+            totals = [total + n for total, n in zip(totals, done)]
+            print(f'users {totals[0]}/{users}  trails {totals[1]}  notes {totals[2]}',
+                  file=sys.stderr)
+
+    # ids were given explicitly, move the sequences past them
+    for table in ('users', 'trails', 'notes'):
+        db.session.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                           f"COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)")
+    UserStats.rebuild()
+    db.session.commit()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute('ANALYZE users, trails, notes, user_stats')
+    return tuple(totals)
+
+
+def main(argv=None):
+    from app import app
+
+    parser = argparse.ArgumentParser(description='Seed the database.')
+    parser.add_argument('--users', type=int, default=0,
+                        help='synthetic users to create, 0 for the demo data')
+    parser.add_argument('--trails-per-user', type=float, default=8.0, help='mean')
+    parser.add_argument('--notes-per-trail', type=float, default=0.5, help='mean')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default one per CPU')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='users per worker task')
+    parser.add_argument('--database', default=app.config['SQLALCHEMY_DATABASE_URI'])
+    args = parser.parse_args(argv)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    with app.app_context():
+        if not args.users:
+            seed_demo()
+            return
+        users, trails, notes = seed_bulk(args.database, args.users, args.trails_per_user,
+                                         args.notes_per_trail, args.seed, args.workers,
+                                         args.chunk_size)
+    print(f'Seeded {users} users, {trails} trails, {notes} notes')
+
+
+if __name__ == '__main__':
+    main()
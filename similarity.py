@@ -0,0 +1,116 @@
+import numpy as np
+from geometry import as_array, EARTH_RADIUS_M
+
+# Similar route search
+#
+# Every trail stores a fingerprint: FINGERPRINT_POINTS vertices
+# resampled at equal spacing along the line. A query is matched in
+# two steps; the fingerprints of every trail near it are compared at
+# once (numpy), and only the closest few are loaded and scored with
+# the discrete Frechet distance. Routes drawn in the other direction
+# match as well.
+#
+# Candidates are dropped only on endpoint_distances(), a true lower
+# bound of the Frechet distance. The lockstep fingerprint_distances()
+# can exceed it (a stored trail that zigzags along the route) and is
+# only used to pick which candidates are scored first.
+
+FINGERPRINT_POINTS = 16
+# vertices per line for the exact comparison
+FRECHET_POINTS = 64
+_FINGERPRINT_DTYPE = np.dtype('<f4')
+# fingerprints are float32, endpoints may be off by this much
+_FINGERPRINT_SLACK_M = 1.0
+
+
+def resample(coords, n):
+    ''' n points spaced equally along the line through coords, as an
+        (n, 2) array of lng, lat. Fewer than 2 points are repeated.
+    '''
+    pts = as_array(coords)
+    if len(pts) == 0:
+        return np.zeros((0, 2))
+    local = local_meters(pts, pts[:, 1].mean())
+    along = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(local, axis=0).T))])
+    if along[-1] == 0:
+        return np.repeat(pts[:1], n, axis=0)
+    targets = np.linspace(0, along[-1], n)
+    return np.column_stack([np.interp(targets, along, pts[:, 0]),
+                            np.interp(targets, along, pts[:, 1])])
+
+
+def local_meters(pts, lat0):
+    ''' lng, lat degrees to planar meters around latitude lat0
+        (equirectangular, fine over the extent of a walk)
+    '''
+    pts = np.radians(np.asarray(pts, dtype=np.float64))
+    scale = np.array([np.cos(np.radians(lat0)), 1.0]) * EARTH_RADIUS_M
+    return pts * scale
+
+
+def fingerprint(coords):
+    '''Packed fingerprint bytes for the trails.fingerprint column'''
+    return resample(coords, FINGERPRINT_POINTS).astype(_FINGERPRINT_DTYPE).tobytes()
+
+
+def unpack_fingerprints(blobs):
+    '''(n, FINGERPRINT_POINTS, 2) array from fingerprint() bytes'''
+    data = np.frombuffer(b''.join(blobs), dtype=_FINGERPRINT_DTYPE)
+    return data.astype(np.float64).reshape(-1, FINGERPRINT_POINTS, 2)
+
+
+def fingerprint_distances(coords, fingerprints):
+    ''' Lockstep distance in meters from the line through coords to
+        each fingerprint, the smaller of both directions. Cheap and
+        close to the Frechet distance of resampled lines.
+    '''
+    query = resample(coords, FINGERPRINT_POINTS)
+    lat0 = query[:, 1].mean()
+    query = local_meters(query, lat0)
+    stored = local_meters(fingerprints, lat0)
+    forward = np.hypot(*(stored - query).transpose(2, 0, 1)).max(axis=1)
+    backward = np.hypot(*(stored - query[::-1]).transpose(2, 0, 1)).max(axis=1)
+    return np.minimum(forward, backward)
+
+
+def endpoint_distances(coords, fingerprints):
+    ''' Lower bound in meters of the Frechet distance from the line
+        through coords to each fingerprinted trail: both ends have to
+        be matched, in one direction or the other
+    '''
+    pts = as_array(coords)
+    lat0 = pts[:, 1].mean()
+    ends = local_meters(pts[[0, -1]], lat0)
+    stored = local_meters(fingerprints[:, [0, -1]], lat0)
+    forward = np.hypot(*(stored - ends).transpose(2, 0, 1)).max(axis=1)
+    backward = np.hypot(*(stored - ends[::-1]).transpose(2, 0, 1)).max(axis=1)
+    return np.maximum(np.minimum(forward, backward) - _FINGERPRINT_SLACK_M, 0)
+
+
+def discrete_frechet(a, b):
+    ''' Discrete Frechet distance between two (n, 2) point arrays
+        Cells on one anti-diagonal only depend on the two before it,
+        so each diagonal is filled in a single numpy step.
+    '''
+    dist = np.hypot(*(a[:, None, :] - b[None, :, :]).transpose(2, 0, 1))
+    n, m = dist.shape
+    # coupling costs, padded with a row and column of inf
+    cost = np.full((n + 1, m + 1), np.inf)
+    cost[0, 0] = -np.inf
+    for k in range(2, n + m + 1):
+        i = np.arange(max(1, k - m), min(n, k - 1) + 1)
+        j = k - i
+        best = np.minimum(np.minimum(cost[i - 1, j], cost[i - 1, j - 1]), cost[i, j - 1])
+        cost[i, j] = np.maximum(dist[i - 1, j - 1], best)
+    return float(cost[n, m])
+
+
+def frechet_distance(coords, other):
+    ''' Discrete Frechet distance in meters between two trails, both
+        resampled to FRECHET_POINTS, the smaller of both directions
+    '''
+    a = resample(coords, FRECHET_POINTS)
+    b = resample(other, FRECHET_POINTS)
+    lat0 = a[:, 1].mean()
+    a, b = local_meters(a, lat0), local_meters(b, lat0)
+    return min(discrete_frechet(a, b), discrete_frechet(a, b[::-1]))
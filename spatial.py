@@ -0,0 +1,109 @@
+from collections import defaultdict
+from threading import RLock
+import math
+import time
+
+
+def bbox_intersects(a, b):
+    '''True if bounding boxes (min_lng, min_lat, max_lng, max_lat) overlap'''
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def radius_bbox(lng, lat, radius_m):
+    '''Bounding box that contains a circle of radius_m around lng, lat'''
+    dlat = radius_m / 111320
+    dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return (lng - dlng, lat - dlat, lng + dlng, lat + dlat)
+
+
+class GridIndex:
+    ''' In-process spatial index of bounding boxes on a uniform grid
+
+        Each key is listed in every grid cell its bbox touches, so a
+        search only looks at keys in the cells the query touches. Keys
+        whose bbox touches more than max_cells cells are kept in a list
+        every search scans instead.
+
+        cell_size - grid cell size in degrees
+        max_cells - most cells one key is listed in
+        built_at  - time.monotonic() of the last rebuild(), or None
+    '''
+
+    def __init__(self, cell_size=0.05, max_cells=1024):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.built_at = None
+        self._cells = defaultdict(set)
+        self._large = set()
+        self._boxes = {}
+        self._lock = RLock()
+
+    def _cell_range(self, bbox):
+        size = self.cell_size
+        return (range(math.floor(bbox[0] / size), math.floor(bbox[2] / size) + 1),
+                range(math.floor(bbox[1] / size), math.floor(bbox[3] / size) + 1))
+
+    def insert(self, key, bbox):
+        '''Add or move key with bbox (min_lng, min_lat, max_lng, max_lat)'''
+        with self._lock:
+            self.remove(key)
+            self._boxes[key] = tuple(bbox)
+            xs, ys = self._cell_range(bbox)
+            if len(xs) * len(ys) > self.max_cells:
+                self._large.add(key)
+                return
+            for x in xs:
+                for y in ys:
+                    self._cells[(x, y)].add(key)
+
+    def remove(self, key):
+        with self._lock:
+            bbox = self._boxes.pop(key, None)
+            if bbox is None:
+                return
+            if key in self._large:
+                self._large.discard(key)
+                return
+            xs, ys = self._cell_range(bbox)
+            for x in xs:
+                for y in ys:
+                    cell = self._cells[(x, y)]
+                    cell.discard(key)
+                    if not cell:
+                        del self._cells[(x, y)]
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._large.clear()
+            self._boxes.clear()
+
+    def rebuild(self, items):
+        '''Replace the contents with (key, bbox) pairs'''
+        with self._lock:
+            self.clear()
+            for key, bbox in items:
+                self.insert(key, bbox)
+            self.built_at = time.monotonic()
+
+    def search(self, bbox):
+        '''Keys whose bbox intersects bbox'''
+        with self._lock:
+            xs, ys = self._cell_range(bbox)
+            # huge query boxes: scanning every box is cheaper
+            if len(xs) * len(ys) > len(self._boxes):
+                candidates = self._boxes.keys()
+            else:
+                candidates = set(self._large)
+                for x in xs:
+                    for y in ys:
+                        candidates |= self._cells.get((x, y), set())
+
+            return [key for key in candidates
+                    if bbox_intersects(self._boxes[key], bbox)]
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __contains__(self, key):
+        return key in self._boxes
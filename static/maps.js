@@ -91,6 +91,33 @@ const nav = new mapboxgl.NavigationControl();
 map.addControl(nav, 'top-right');
   
 
+// Overview of all the user's stored trails from the
+// server's vector tiles, only on the user page
+map.on('load', function() {
+    const form = document.querySelector('#new-trail');
+    if (!form) {
+        return;
+    }
+    map.addLayer({
+        "id": "trail-overview",
+        "type": "line",
+        "source": {
+            "type": "vector",
+            "tiles": [`${URL}/tiles/{z}/{x}/{y}.mvt?user_id=${form.dataset.userid}`]
+        },
+        "source-layer": "trails",
+        "layout": {
+          "line-join": "round",
+          "line-cap": "round"
+        },
+        "paint": {
+          "line-color": "#8A5CF6",
+          "line-width": 3,
+          "line-opacity": 0.6
+        }
+    });
+});
+
 /********************************************************/
 /*  ESTABLISH MAPBOX GL DRAWING OBJECT TO DESING ROUTES */
 /********************************************************/
@@ -199,17 +226,12 @@ function getMatch(coordinates, radius, profile) {
     // Separate radiuses with semicolon
     const radiuses = radius.join(';');
     localStorage.clear();
-    // Create query string for Map Matching API
-    const query = 'https://api.mapbox.com/matching/v5/mapbox/' +
-                    profile + '/' + 
-                    coordinates + 
-                    '?geometries=geojson&radiuses=' + 
-                    radiuses + '&steps=true&access_token=' + 
-                    mapboxgl.accessToken;
-
+    // Query the server's Map Matching proxy, it caches repeated
+    // routes and holds the API token
     $.ajax({
         method: 'GET',
-        url: query
+        url: `${URL}/matching/${profile}`,
+        data: { coordinates: coordinates, radiuses: radiuses }
     }).done(function(data) {
         // Get the coordinates from the response
         const coords = data.matchings[0].geometry;
@@ -334,18 +356,83 @@ $('#new-trail').on('submit', async function(e) {
   location.reload(true); 
 })
 
+// Stored trails already fetched, by `${trail id}:${zoom}`, since the
+// geometry comes simplified for the zoom it was asked at
+const trailCache = {};
+// ids per batch request, MAX_BATCH_IDS in app.py
+const BATCH_SIZE = 500;
+
+// True if the element is at least partly on screen
+function onScreen(element) {
+  const rect = element.getBoundingClientRect();
+  return rect.bottom > 0 && rect.top < window.innerHeight;
+}
+
 // Method to retrieve a Stored  User route 
 // and display on the Map if no errors
+// A click on a trail not fetched yet at this zoom fetches it together
+// with the other trails on screen, not the whole list
 $('#trail-list').on('click', '#view-btn' , async function(e) {
   
   const user_id = $(e.target).data('userid');
   const trail_id = $(e.target).data('trailid');
-  console.log(`REQUEST URL: ${URL}/users/${user_id}/trails/${trail_id}`);
-  
-  const response = await axios.get(`${URL}/users/${user_id}/trails/${trail_id}`);
+  const zoom = Math.floor(map.getZoom());
+
+  if (!trailCache[`${trail_id}:${zoom}`]) {
+      const others = $('#trail-list #view-btn').filter((i, btn) => onScreen(btn))
+                    .map((i, btn) => $(btn).data('trailid')).get()
+                    .filter(id => id !== trail_id && !trailCache[`${id}:${zoom}`]);
+      const ids = [trail_id].concat(others).slice(0, BATCH_SIZE);
+      console.log(`REQUEST URL: ${URL}/users/${user_id}/trails/batch`);
+      // ask for geometry simplified to the current map zoom
+      const response = await axios.get(`${URL}/users/${user_id}/trails/batch`,
+                                       { params: { ids: ids.join(','), zoom: zoom } });
+      response.data.maproutes.forEach(maproute => trailCache[`${maproute.id}:${zoom}`] = maproute);
+  }
+
+  drawStoredMap({ data: { maproute: trailCache[`${trail_id}:${zoom}`] } });
+})
+
+// Builds a trail card matching the ones rendered in user_trails.html
+function trailCard(user_id, trail) {
+  return `<div class="card mt-3" style="width: 18rem;">
+            <div class="card-body">
+              <h5 class="card-title">${$('<div>').text(trail.name).html()}</h5>
+              <h6 class="card-subtitle mb-2 text-muted">Distance: ${trail.distance} miles</h6>
+              <h6 class="card-subtitle mb-2 text-muted">Duration: ${trail.duration} minutes</h6>
+            </div>
+            <div class="card-footer">
+              <button class="btn btn-info btn-sm"
+                      data-userid="${user_id}"
+                      data-trailid="${trail.id}"
+                      id="view-btn">View</button>
+              <form method="POST"
+                    action="/users/${user_id}/trails/${trail.id}/delete" style="display: inline-block">
+                <button class="btn btn-secondary btn-sm">Delete</button>
+              </form>
+            </div>
+          </div>`;
+}
+
+// Method to fetch the next page of stored trails
+// and append them to the trail list
+$('#load-more').on('click', async function(e) {
+  const button = $(e.target);
+  const user_id = button.data('userid');
+
+  const response = await axios.get(`${URL}/users/${user_id}/trails`,
+                                   { params: { after: button.data('after') } });
 
-  console.log('RESPONSE: ', response);
-  drawStoredMap(response);
+  response.data.trails.forEach(trail =>
+      $('#trail-list').append(trailCard(user_id, trail)));
+
+  // hide the button once the last page is loaded
+  if (response.data.next) {
+      button.data('after', response.data.next);
+  }
+  else {
+      button.remove();
+  }
 })
 
 // Checks for errors on the reponse and preps coordinates for display
@@ -1,7 +1,33 @@
 from unittest import TestCase
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
 
-from app import app
-from models import db, User, Trail
+from app import app, user_cache, lod_cache, trail_index, tile_cache, matching_proxy, payload_cache, metrics, purger, page_cache
+from models import db, dem, User, Trail, Note, UserStats
+from coords import pack_coords, unpack_coords, append_coords, last_coord
+from geometry import trail_stats, simplify
+from similarity import resample, frechet_distance
+from elevation import DemTiles, climb
+import numpy as np
+from spatial import GridIndex
+from tiles import clip_line, tile_parts
+from matching import MatchingProxy, MatchingError
+from caching import LRUCache
+from benchmark import random_route, run, summarize, compare
+from seed import plan_chunk, CopyWriter
+import asgi
+from asgi import application
+from starlette.testclient import TestClient as AsgiClient
+from threading import Thread, Event
+from unittest.mock import Mock, patch
+from flask import g
+from routing import ReplicaSet, WROTE_AT_KEY
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///urbanmaps_test_db'
@@ -10,10 +36,21 @@ app.config['SQLALCHEMY_ECHO'] = False
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 app.config['WTF_CSRF_ENABLED'] = False
+# fast password hashing for tests
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+# offline map matching
+app.config['MATCHING_BACKEND'] = 'stub'
 
 db.drop_all()
 db.create_all()
 
+def write_hgt_tile(directory, name='N36W122.hgt', side=11):
+    '''Tiny .hgt tile, 1000 m per degree of latitude above lat 36'''
+    heights = np.repeat(np.linspace(1000, 0, side)[:, None], side, axis=1)
+    heights.astype('>i2').tofile(os.path.join(directory, name))
+    return heights
+
+
 NEW_USER2 = {
     "username": "testuser2",
     "password": "password",
@@ -28,8 +65,10 @@ class UrbanTrailsViewsTest(TestCase):
     def setUp(self):
         """Make demo data."""
 
+        Note.query.delete()
         User.query.delete()
         Trail.query.delete()
+        page_cache.clear()
 
         user1 = User(
             username="testuser",
@@ -93,6 +132,21 @@ class UrbanTrailsViewsTest(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('You have been logged out, Thanks for visiting!', html)
 
+    def testRehashOnLogin(self):
+        with app.test_client() as client:
+            resp = client.post("/users/register", data=NEW_USER2)
+
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            try:
+                resp = client.post("/users/login", data=
+                {"username":"testuser2", "password": "password"})
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+            user = User.query.filter_by(username='testuser2').first()
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(user.password.startswith('$2b$05$'))
+
     def testGetUserPage(self):
         with app.test_client() as client:
             resp = client.get(f"/users/{self.user1.id}")
@@ -120,6 +174,20 @@ class UrbanTrailsViewsTest(TestCase):
             self.assertIn(f'Welcome {user.username}', html)
             self.assertEqual('newmail@mail.com',user.email)
 
+    def testCurrentUserCache(self):
+        with app.test_client() as client:
+            resp = client.post("/users/register", data=NEW_USER2)
+            user2 = User.query.filter_by(username='testuser2').first()
+            user_cache.clear()
+
+            resp = client.get(f"/users/{user2.id}")
+            self.assertEqual(user_cache.get(user2.id).username, 'testuser2')
+
+            # profile update replaces the cached identity
+            resp = client.post(f"/users/profile",data=
+            {"username":"testuser2", "password": "password", "email": "newmail@mail.com", "address": "New Address"})
+            self.assertEqual(user_cache.get(user2.id).email, 'newmail@mail.com')
+
     def testDeleteUser(self):
         with app.test_client() as client:
             # Register a new user and login
@@ -137,6 +205,55 @@ class UrbanTrailsViewsTest(TestCase):
             self.assertEqual(User.query.count(), 1)
             self.assertEqual(resp.status_code, 200)
 
+    def testDeleteUserCascades(self):
+        user_id, trail_id = self.user1.id, self.trail1.id
+        db.session.add(Note(comment="cascade", trail_id=trail_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['curr_user'] = user_id
+            resp = client.delete(f"/users/{user_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.count(), 0)
+            self.assertEqual(Trail.query.count(), 0)
+            self.assertEqual(Note.query.count(), 0)
+
+    def testDeleteUserBackgroundPurge(self):
+        user_id = self.user1.id
+        app.config['PURGE_ASYNC_TRAILS'] = 0
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess['curr_user'] = user_id
+                client.delete(f"/users/{user_id}")
+            # hidden at once, removed by the purge thread
+            self.assertFalse(User.authenticate("testuser", "password"))
+            purger.wait()
+        finally:
+            app.config['PURGE_ASYNC_TRAILS'] = 5000
+
+        db.session.expire_all()
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Trail.query.count(), 0)
+
+    def testMarkedDeletedUserHidden(self):
+        user_id, trail_id = self.user1.id, self.trail1.id
+        User.mark_deleted(user_id)
+        db.session.commit()
+        trail_index.built_at = None
+
+        with app.test_client() as client:
+            self.assertEqual(client.get(f'/users/{user_id}/trails/{trail_id}/').status_code, 404)
+            self.assertEqual(client.get(f'/users/{user_id}/trails/{trail_id}/notes').status_code,
+                             404)
+            self.assertEqual(client.get(f'/users/{user_id}/trails').get_json()['trails'], [])
+            resp = client.get('/trails/search?bbox=-123,36,-120,38')
+            self.assertEqual(resp.get_json()['trails'], [])
+            resp = client.get(f'/users/{user_id}/export?format=ndjson')
+            self.assertEqual(resp.data, b'')
+
     def testAddDeleteTrail(self):
         with app.test_client() as client:
             # Register a new user and login
@@ -164,5 +281,932 @@ class UrbanTrailsViewsTest(TestCase):
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(Trail.query.count(), 1)
-            
 
+    def testUserPageCache(self):
+        user_id = self.user1.id
+        with app.test_client() as client:
+            client.get(f'/users/{user_id}')
+            hits = page_cache.hits
+            resp = client.get(f'/users/{user_id}')
+            self.assertEqual(page_cache.hits, hits + 1)
+
+            # a new trail bumps the page version, the list is rendered again
+            client.post(f'/users/{user_id}/trails', json={
+                "name": "cachedtrail", "coordinates": [[-121, 36.5], [-121.1, 36.6]]})
+            resp = client.get(f'/users/{user_id}')
+            self.assertEqual(page_cache.hits, hits + 1)
+            self.assertIn('cachedtrail', resp.get_data(as_text=True))
+
+    def testUserStatsIncremental(self):
+        user_id = self.user1.id
+        with app.test_client() as client:
+            client.get(f'/users/{user_id}')
+            self.assertEqual(UserStats.query.get(user_id).trail_count, 1)
+
+            resp = client.post(f'/users/{user_id}/trails', json={
+                "name": "statstrail", "coordinates": [[-121, 36.5], [-121.1, 36.6]]})
+            trail_id = resp.get_json()['maproute']['id']
+            resp = client.post(f'/users/{user_id}/trails/{trail_id}/notes',
+                               json={"comment": "one"})
+            note_id = resp.get_json()['note']['id']
+            client.post(f'/users/{user_id}/trails/{trail_id}/notes', json={"comment": "two"})
+            client.delete(f'/users/{user_id}/trails/{trail_id}/notes/{note_id}')
+
+            stats = UserStats.query.get(user_id).to_dict()
+            self.assertEqual((stats['trail_count'], stats['note_count']), (2, 1))
+            # a rebuild over an existing (here wrong) row updates it in place
+            UserStats.query.filter_by(user_id=user_id).update({"trail_count": 99})
+            UserStats.rebuild(user_id)
+            db.session.commit()
+            self.assertEqual(UserStats.query.get(user_id).to_dict(), stats)
+
+            # a second delete that lost the race to the first changes nothing
+            with patch.object(Trail, 'delete_for_user', return_value=0):
+                resp = client.post(f'/users/{user_id}/trails/{trail_id}/delete')
+            self.assertEqual(resp.status_code, 404)
+            db.session.expire_all()
+            self.assertEqual(UserStats.query.get(user_id).trail_count, 2)
+
+            client.post(f'/users/{user_id}/trails/{trail_id}/delete')
+            db.session.expire_all()
+            stats = UserStats.query.get(user_id)
+            self.assertEqual((stats.trail_count, stats.note_count), (1, 0))
+            self.assertAlmostEqual(stats.total_distance, 3.5)
+
+    def testNoteOtherUsersTrail(self):
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id + 1}/trails/{self.trail1.id}/notes',
+                               json={"comment": "not mine"})
+
+            self.assertEqual(resp.status_code, 404)
+
+    def testGetTrail(self):
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/trails/{self.trail1.id}/')
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(data['maproute']['coordinates'], [[-121, 36.5], [-122, 37]])
+
+    def testGetTrailConditional(self):
+        url = f'/users/{self.user1.id}/trails/{self.trail1.id}/'
+        with app.test_client() as client:
+            resp = client.get(url)
+            etag = resp.headers['ETag']
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+            # a different detail level is a different representation
+            resp = client.get(url + '?zoom=5', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def testGetTrailGzip(self):
+        trail_id = self.trail1.id
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/trails/{trail_id}/',
+                              headers={'Accept-Encoding': 'gzip'})
+            data = json.loads(gzip.decompress(resp.data))
+
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertEqual(data['maproute']['coordinates'], [[-121, 36.5], [-122, 37]])
+            self.assertTrue(any(key[0] == trail_id for key in payload_cache._data))
+
+    def testRequestMetrics(self):
+        metrics.reset()
+        with app.test_client() as client:
+            client.get(f'/users/{self.user1.id}/trails/{self.trail1.id}/')
+            resp = client.get('/metrics')
+            endpoints = resp.get_json()['endpoints']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(endpoints['get_maproute']['requests'], 1)
+            self.assertGreaterEqual(endpoints['get_maproute']['avg_queries'], 1)
+            self.assertNotIn('get_metrics', endpoints)
+
+    def testRequestMetricsLogsAndErrors(self):
+        metrics.reset()
+        self.addCleanup(setattr, metrics, 'sample_rate', metrics.sample_rate)
+        metrics.sample_rate = 1
+        # logged at teardown, when the client's context closes
+        with self.assertLogs('urbantrails.metrics', 'INFO') as logs, \
+                app.test_client() as client, \
+                patch.object(matching_proxy, 'match', side_effect=MatchingError('down')):
+            resp = client.get('/matching/walking?coordinates=-121,36;-121,36.01')
+            self.assertEqual(resp.status_code, 502)
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['endpoint'], line['error']), ('match_route', True))
+        self.assertEqual(metrics.snapshot()['endpoints']['match_route']['errors'], 1)
+
+    def testPatchTrailAppend(self):
+        url = f'/users/{self.user1.id}/trails/{self.trail1.id}'
+        with app.test_client() as client:
+            etag = client.get(url + '/').headers['ETag']
+            resp = client.patch(url + '/coordinates', json={"append": [[-122.5, 37.5]]},
+                                headers={'If-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json()['maproute']['vertex_count'], 3)
+
+            # the copy the client edited is stale now
+            resp = client.patch(url + '/coordinates', json={"append": [[-123, 38]]},
+                                headers={'If-Match': etag})
+            self.assertEqual(resp.status_code, 412)
+            client.patch(url + '/coordinates', json={"append": [[-123, 38]]})
+
+            coords = [[-121, 36.5], [-122, 37], [-122.5, 37.5], [-123, 38]]
+            data = client.get(url + '/').get_json()['maproute']
+            self.assertEqual(data['coordinates'], coords)
+            self.assertEqual(data['distance'], Trail.stats_values(coords)['distance'])
+
+    def testPatchTrailReplace(self):
+        url = f'/users/{self.user1.id}/trails/{self.trail1.id}'
+        coords = [[-121, 36.5], [-121.5, 36.7], [-121.8, 36.9], [-122, 37]]
+        with app.test_client() as client:
+            client.patch(url + '/coordinates', json={"start": 1, "end": 1,
+                                                     "coordinates": coords[1:3]})
+            resp = client.patch(url + '/coordinates', json={"start": 2, "end": 3,
+                                                            "coordinates": []})
+            data = client.get(url + '/').get_json()['maproute']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(data['coordinates'], [coords[0], coords[1], coords[3]])
+            self.assertEqual(data['distance'],
+                             Trail.stats_values([coords[0], coords[1], coords[3]])['distance'])
+            resp = client.patch(url + '/coordinates', json={"start": 2, "end": 9,
+                                                            "coordinates": []})
+            self.assertEqual(resp.status_code, 400)
+
+    def testGetTrailOtherUser(self):
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id + 1}/trails/{self.trail1.id}/')
+
+            self.assertEqual(resp.status_code, 404)
+
+    def testGetTrailsBatch(self):
+        trail2 = Trail(name="batchtrail", coordinates=[[-120, 35], [-120.5, 35.5]],
+                       user_id=self.user1.id)
+        trail2.update_stats()
+        db.session.add(trail2)
+        db.session.commit()
+        ids = [self.trail1.id, trail2.id]
+
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/trails/batch?ids={ids[0]},{ids[1]},99999')
+            maproutes = resp.get_json()['maproutes']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m['id'] for m in maproutes], ids)
+            self.assertEqual(maproutes[1]['coordinates'], [[-120, 35], [-120.5, 35.5]])
+
+            resp = client.get(f'/users/{self.user1.id}/trails/batch?ids=1,x')
+            self.assertEqual(resp.status_code, 400)
+
+    def testExportTrails(self):
+        db.session.add(Note(comment="nice", trail_id=self.trail1.id))
+        db.session.commit()
+        trail_id = self.trail1.id
+
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/export?notes=1')
+            collection = resp.get_json(force=True)
+
+            self.assertEqual(resp.mimetype, 'application/geo+json')
+            self.assertEqual(collection['type'], 'FeatureCollection')
+            feature = collection['features'][0]
+            self.assertEqual(feature['id'], trail_id)
+            self.assertEqual(feature['geometry']['coordinates'], [[-121, 36.5], [-122, 37]])
+            self.assertEqual([n['comment'] for n in feature['properties']['notes']], ['nice'])
+
+            resp = client.get(f'/users/{self.user1.id}/export?format=ndjson')
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertEqual(len(lines), 1)
+            self.assertNotIn('notes', lines[0])
+
+    def testImportGpx(self):
+        gpx = b"""<?xml version="1.0"?>
+        <gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+          <trk><name>Morning loop</name><trkseg>
+            <trkpt lat="36.5" lon="-121.5"/><trkpt lat="36.51" lon="-121.5"/>
+          </trkseg></trk>
+          <trk><name>Too short</name><trkseg><trkpt lat="36.5" lon="-121.5"/></trkseg></trk>
+        </gpx>"""
+
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id}/trails/import',
+                               data={"file": (io.BytesIO(gpx), "tracks.gpx")})
+            result = resp.get_json()
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(result['imported'], 1)
+            self.assertEqual([e['item'] for e in result['errors']], [1])
+
+        trail = Trail.query.filter_by(name='Morning loop').one()
+        self.assertEqual(trail.coordinates, [[-121.5, 36.5], [-121.5, 36.51]])
+        self.assertEqual(trail.distance, 0.69)
+
+    def testImportGeojson(self):
+        features = [{"type": "Feature", "properties": {"name": name},
+                     "geometry": {"type": "LineString", "coordinates": [[-120, 35], [-120.1, 35.1]]}}
+                    for name in ("testtrail", "geo1", "geo2")]
+        body = json.dumps({"type": "FeatureCollection", "features": features}).encode('utf8')
+
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id}/trails/import?format=geojson', data=body)
+            result = resp.get_json()
+
+            # "testtrail" already exists
+            self.assertEqual(result['imported'], 2)
+            self.assertEqual([e['name'] for e in result['errors']], ['testtrail'])
+            self.assertEqual(Trail.query.count(), 3)
+
+    def testImportBadLines(self):
+        line = {"type": "Feature", "properties": {"name": "nd1"},
+                "geometry": {"type": "LineString", "coordinates": [[-120, 35], [-120.1, 35.1]]}}
+        ndjson = '\n'.join([json.dumps(line), '{"type": "Feat',
+                            json.dumps(dict(line, properties={"name": "nd2"}))]).encode('utf8')
+        # "features" inside a property is not the features array
+        collection = {"type": "FeatureCollection", "name": 'a "features": [1] string',
+                      "features": [dict(line, properties={"name": "geo3"})]}
+
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id}/trails/import?format=ndjson', data=ndjson)
+            result = resp.get_json()
+
+            self.assertEqual(result['imported'], 2)
+            self.assertEqual(len(result['errors']), 1)
+            self.assertIn('Line 2', result['errors'][0]['error'])
+
+            resp = client.post(f'/users/{self.user1.id}/trails/import?format=geojson',
+                               data=json.dumps(collection).encode('utf8'))
+            self.assertEqual(resp.get_json(), {"imported": 1, "errors": []})
+
+    def testLegacyTrailConvertedOnRead(self):
+        # rows saved before packed geometry keep postgres array text
+        self.trail1.geometry = None
+        self.trail1.legacy_coordinates = '{{-121.603451,36.704384},{-121.604256,36.704232}}'
+        db.session.commit()
+        trail_id = self.trail1.id
+
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/trails/{trail_id}/')
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(data['maproute']['coordinates'],
+                             [[-121.603451, 36.704384], [-121.604256, 36.704232]])
+
+        trail = Trail.query.get(trail_id)
+        self.assertIsNone(trail.legacy_coordinates)
+        self.assertIsNotNone(trail.geometry)
+
+    def testTrailGeometryDeferred(self):
+        trail_id = self.trail1.id
+        db.session.expunge_all()
+
+        trail = Trail.query.get(trail_id)
+        self.assertNotIn('geometry', trail.__dict__)
+        self.assertEqual(Trail.summaries_for_user(self.user1.id),
+                         [{"id": trail_id, "name": "testtrail",
+                           "duration": 35.4, "distance": 3.5,
+                           "elevation_gain": None, "elevation_loss": None}])
+
+    def testTrailPages(self):
+        user_id = self.user1.id
+        for i in range(4):
+            db.session.add(Trail(name=f"pagetrail{i}", distance=1, duration=1,
+                                 coordinates=[[-121, 36.5]], user_id=user_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get(f'/users/{user_id}/trails?limit=3')
+            first = resp.get_json()
+            resp = client.get(f'/users/{user_id}/trails?limit=3&after={first["next"]}')
+            second = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(first['trails']), 3)
+            self.assertEqual(len(second['trails']), 2)
+            self.assertIsNone(second['next'])
+
+            resp = client.get(f'/users/{user_id}/trails?after=bogus')
+            self.assertEqual(resp.status_code, 400)
+
+    def testTrailNotePages(self):
+        trail_id = self.trail1.id
+        for i in range(3):
+            db.session.add(Note(comment=f"note{i}", trail_id=trail_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            url = f'/users/{self.user1.id}/trails/{trail_id}/notes'
+            first = client.get(f'{url}?limit=2').get_json()
+            second = client.get(f'{url}?limit=2&after={first["next"]}').get_json()
+
+            self.assertEqual([n['comment'] for n in first['notes']], ['note0', 'note1'])
+            self.assertEqual([n['comment'] for n in second['notes']], ['note2'])
+            self.assertIsNone(second['next'])
+
+    def testAddTrailComputesStats(self):
+        with app.test_client() as client:
+            # client supplied distance/duration are ignored
+            resp = client.post(f'/users/{self.user1.id}/trails', json = {
+                "name": "statstrail",
+                "distance": 999,
+                "duration": 999,
+                "coordinates": [[-121, 36], [-121, 36.01]]
+            })
+            maproute = resp.get_json()['maproute']
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(maproute['distance'], 0.69)
+            self.assertEqual(maproute['duration'], 13.2)
+
+    def testAddTrailBadCoordinates(self):
+        with app.test_client() as client:
+            url = f'/users/{self.user1.id}/trails'
+            for body in ({"name": "bad", "coordinates": [["a", "b"]]},
+                         {"name": "bad", "coordinates": [[-500, 36], [-121, 36.01]]},
+                         {"name": "bad"}):
+                self.assertEqual(client.post(url, json=body).status_code, 400)
+            self.assertEqual(client.post(url, data="not json").status_code, 400)
+
+    def testBackfillTrailStats(self):
+        trail_id = self.trail1.id
+
+        self.assertEqual(Trail.backfill_stats(), 1)
+        trail = Trail.query.get(trail_id)
+        self.assertEqual((trail.min_lng, trail.min_lat, trail.max_lng, trail.max_lat),
+                         (-122, 36.5, -121, 37))
+        self.assertEqual(trail.vertex_count, 2)
+
+    def testGetTrailAtZoom(self):
+        # a straight line with a midpoint off by ~1m
+        trail = Trail(name="zoomtrail", coordinates=[[-121, 36], [-121, 36.005], [-121.00001, 36.01]],
+                      user_id=self.user1.id)
+        trail.update_stats()
+        db.session.add(trail)
+        db.session.commit()
+        trail_id, key = trail.id, (trail.id, trail.updated_at)
+
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.user1.id}/trails/{trail_id}/?zoom=10')
+            coords = resp.get_json()['maproute']['coordinates']
+            self.assertEqual(coords, [[-121, 36], [-121.00001, 36.01]])
+            self.assertIn(10, lod_cache.get(key))
+
+            # an edit another worker made is a new version, not a cache hit
+            Trail.query.filter_by(id=trail_id).update(
+                {"updated_at": datetime(2030, 1, 1), "geometry": pack_coords([[-121, 36], [-121, 36.01]])})
+            db.session.commit()
+            resp = client.get(f'/users/{self.user1.id}/trails/{trail_id}/?zoom=10')
+            self.assertEqual(resp.get_json()['maproute']['coordinates'], [[-121, 36], [-121, 36.01]])
+
+            resp = client.post(f'/users/{self.user1.id}/trails/{trail_id}/delete')
+            self.assertIsNone(lod_cache.get(key))
+
+    def testSearchTrails(self):
+        trail_index.built_at = None
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id}/trails', json = {
+                "name": "neartrail",
+                "coordinates": [[-121.5, 36.5], [-121.5, 36.51]]
+            })
+            trail_id = resp.get_json()['maproute']['id']
+
+            resp = client.get('/trails/search?bbox=-121.6,36.4,-121.4,36.6')
+            self.assertEqual([t['id'] for t in resp.get_json()['trails']], [trail_id])
+
+            resp = client.get('/trails/search?lng=-121.5&lat=36.52&radius=1200')
+            trails = resp.get_json()['trails']
+            self.assertEqual([t['id'] for t in trails], [trail_id])
+            self.assertAlmostEqual(trails[0]['distance_m'], 1112, delta=1)
+
+            resp = client.get('/trails/search?lng=-121.5&lat=36.52&radius=1000')
+            self.assertEqual(resp.get_json()['trails'], [])
+
+            # between the two vertices, 500 m from both
+            resp = client.get('/trails/search?lng=-121.5&lat=36.505&radius=10')
+            trails = resp.get_json()['trails']
+            self.assertEqual([t['id'] for t in trails], [trail_id])
+            self.assertAlmostEqual(trails[0]['distance_m'], 0, delta=0.1)
+
+            resp = client.get('/trails/search?bbox=1,2,3')
+            self.assertEqual(resp.status_code, 400)
+
+    def testTrailTiles(self):
+        trail_index.built_at = None
+        tile_cache.clear()
+        # tile 12/665/1601 covers -121.55..-121.46, 36.46..36.53
+        url = '/tiles/12/665/1601.mvt'
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, b'')
+
+            # adding a trail inside the tile drops the cached empty tile
+            resp = client.post(f'/users/{self.user1.id}/trails', json = {
+                "name": "tiletrail",
+                "coordinates": [[-121.5, 36.5], [-121.49, 36.51]]
+            })
+            resp = client.get(url)
+            self.assertEqual(resp.mimetype, 'application/vnd.mapbox-vector-tile')
+            self.assertIn(b'tiletrail', resp.data)
+
+            resp = client.get(f'{url}?user_id={self.user1.id + 1}')
+            self.assertEqual(resp.data, b'')
+
+            resp = client.get('/tiles/1/5/0.mvt')
+            self.assertEqual(resp.status_code, 404)
+
+    def testMatchRoute(self):
+        matching_proxy.cache.clear()
+        with app.test_client() as client:
+            resp = client.get('/matching/walking?coordinates=-121,36;-121,36.01&radiuses=25;25')
+            matched = resp.get_json()['matchings'][0]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(matched['geometry']['coordinates'], [[-121, 36], [-121, 36.01]])
+            self.assertAlmostEqual(matched['distance'], 1112, delta=1)
+
+            # same route redrawn within a metre comes from the cache
+            resp = client.get('/matching/walking?coordinates=-121.000001,36;-121,36.01&radiuses=25;25')
+            self.assertEqual(matching_proxy.cache.hits, 1)
+
+            resp = client.get('/matching/flying?coordinates=-121,36;-121,36.01')
+            self.assertEqual(resp.status_code, 422)
+
+    def testTrailElevation(self):
+        user_id, plain_id = self.user1.id, self.trail1.id
+        with tempfile.TemporaryDirectory() as directory:
+            write_hgt_tile(directory)
+            dem.set_directory(directory)
+            self.addCleanup(dem.set_directory, None)
+            with app.test_client() as client:
+                resp = client.post(f'/users/{user_id}/trails', json = {
+                    "name": "hilltrail",
+                    "coordinates": [[-121.5, 36.5], [-121.5, 36.52], [-121.5, 36.51]]
+                })
+                url = f'/users/{user_id}/trails/{resp.get_json()["maproute"]["id"]}/elevation'
+                resp = client.get(url)
+                data = resp.get_json()
+
+                self.assertAlmostEqual(data['gain_m'], 20, delta=1)
+                self.assertAlmostEqual(data['loss_m'], 10, delta=1)
+                self.assertEqual(len(data['profile']), 100)
+                self.assertAlmostEqual(data['profile'][0][1], 500, delta=1)
+                self.assertAlmostEqual(data['profile'][-1][0], 3336, delta=2)
+
+                resp = client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+                self.assertEqual(resp.status_code, 304)
+
+                # saved before the DEM was there
+                resp = client.get(f'/users/{user_id}/trails/{plain_id}/elevation')
+                self.assertIsNone(resp.get_json()['gain_m'])
+                self.assertEqual(Trail.backfill_elevation(), 1)
+                resp = client.get(f'/users/{user_id}/trails/{plain_id}/elevation')
+                self.assertIsNotNone(resp.get_json()['gain_m'])
+
+                # edits read no tiles, the backfill catches up
+                client.patch(url.replace('/elevation', '/coordinates'),
+                             json={"append": [[-121.5, 36.5]]})
+                self.assertIsNone(client.get(url).get_json()['gain_m'])
+                self.assertEqual(Trail.backfill_elevation(), 1)
+                self.assertAlmostEqual(client.get(url).get_json()['loss_m'], 20, delta=1)
+
+    def testSimilarTrails(self):
+        trail_index.built_at = None
+        with app.test_client() as client:
+            for name, coords in (("sametrail", [[-121.5, 36.5], [-121.5, 36.51]]),
+                                 ("crosstrail", [[-121.505, 36.505], [-121.495, 36.505]])):
+                resp = client.post(f'/users/{self.user1.id}/trails',
+                                   json={"name": name, "coordinates": coords})
+            same_id = Trail.query.filter_by(name="sametrail").one().id
+
+            # drawn the other way round, about 30 m east
+            drawn = [[-121.49967, 36.51], [-121.49967, 36.505], [-121.49967, 36.5]]
+            resp = client.post('/trails/similar', json={"coordinates": drawn})
+            trails = resp.get_json()['trails']
+            self.assertEqual([t['id'] for t in trails], [same_id])
+            self.assertAlmostEqual(trails[0]['frechet_m'], 30, delta=1)
+
+            resp = client.post('/trails/similar', json={"coordinates": drawn,
+                                                        "max_distance": 20})
+            self.assertEqual(resp.get_json()['trails'], [])
+
+            resp = client.post('/trails/similar', json={"coordinates": drawn,
+                                                        "exclude": same_id})
+            self.assertEqual(resp.get_json()['trails'], [])
+
+            resp = client.post('/trails/similar', json={"coordinates": drawn,
+                                                        "exclude": str(same_id)})
+            self.assertEqual(resp.get_json()['trails'], [])
+
+            resp = client.post('/trails/similar', json={"coordinates": drawn,
+                                                        "exclude": "five"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.post('/trails/similar', json={"coordinates": [[-121.5, 36.5]]})
+            self.assertEqual(resp.status_code, 400)
+
+    def testSimilarAfterEdit(self):
+        trail_index.built_at = None
+        with app.test_client() as client:
+            resp = client.post(f'/users/{self.user1.id}/trails',
+                               json={"name": "edited", "coordinates": [[-121.5, 36.5], [-121.5, 36.505]]})
+            trail_id = resp.get_json()['maproute']['id']
+            client.patch(f'/users/{self.user1.id}/trails/{trail_id}/coordinates',
+                         json={"append": [[-121.5, 36.51]]})
+            self.assertIsNone(Trail.query.get(trail_id).fingerprint)
+
+            # a stale fingerprint is skipped, the trail itself is scored
+            drawn = {"coordinates": [[-121.5, 36.5], [-121.5, 36.51]]}
+            resp = client.post('/trails/similar', json=drawn)
+            self.assertEqual([t['id'] for t in resp.get_json()['trails']], [trail_id])
+
+            self.assertGreater(Trail.backfill_fingerprints(), 0)
+            self.assertIsNotNone(Trail.query.get(trail_id).fingerprint)
+            resp = client.post('/trails/similar', json=drawn)
+            self.assertEqual([t['id'] for t in resp.get_json()['trails']], [trail_id])
+
+    def testSimilarZigzag(self):
+        # 35 m teeth along the first half: its fingerprint is far from
+        # the straight line, its Frechet distance is not
+        trail_index.built_at = None
+        with app.test_client() as client:
+            zigzag = [[-121.5 + (0.0003916 if n % 2 else 0), 36.5 + n * 0.0002]
+                      for n in range(21)] + [[-121.5, 36.509]]
+            client.post(f'/users/{self.user1.id}/trails',
+                        json={"name": "zigzag", "coordinates": zigzag})
+            zigzag_id = Trail.query.filter_by(name="zigzag").one().id
+
+            resp = client.post('/trails/similar', json={"coordinates": [[-121.5, 36.5], [-121.5, 36.509]],
+                                                        "max_distance": 40})
+            self.assertEqual([t['id'] for t in resp.get_json()['trails']], [zigzag_id])
+
+
+class GeometryTest(TestCase):
+    '''Tests for server side trail geometry'''
+
+    def testTrailStats(self):
+        # one degree of latitude along a meridian
+        stats = trail_stats([[0, 0], [0, 0.5], [0, 1]])
+
+        self.assertAlmostEqual(stats.length_m, 111195, delta=1)
+        self.assertEqual(stats.bbox, (0, 0, 0, 1))
+        self.assertEqual(stats.vertex_count, 3)
+        self.assertAlmostEqual(stats.segment_mean_m, stats.length_m / 2)
+
+    def testSimplify(self):
+        coords = [[0, 0], [1, 0.001], [2, 0], [3, 1], [4, 0]]
+
+        self.assertEqual(simplify(coords, 0.01), [[0, 0], [2, 0], [3, 1], [4, 0]])
+        self.assertEqual(simplify(coords, 0), coords)
+
+    def testSinglePoint(self):
+        stats = trail_stats([[-121, 36.5]])
+
+        self.assertEqual(stats.length_m, 0)
+        self.assertEqual(stats.bbox, (-121, 36.5, -121, 36.5))
+
+    def testFrechetDistance(self):
+        line = [[-121.5, 36.5], [-121.5, 36.505], [-121.49, 36.505]]
+        points = resample(line, 5)
+
+        self.assertEqual(points.shape, (5, 2))
+        self.assertEqual(points[-1].tolist(), line[-1])
+        self.assertAlmostEqual(frechet_distance(line, line[::-1]), 0)
+        # same route, one degree of latitude north
+        moved = [[lng, lat + 1] for lng, lat in line]
+        self.assertAlmostEqual(frechet_distance(line, moved), 111195, delta=100)
+
+
+class ReadReplicaTest(TestCase):
+    '''Tests for read replica routing'''
+
+    def setUp(self):
+        # the test database stands in for its own replica
+        app.config['DB_REPLICA_URIS'] = [app.config['SQLALCHEMY_DATABASE_URI']]
+        app.config['DB_REPLICA_LAG_CHECK'] = 0
+        self.addCleanup(app.config.update, DB_REPLICA_URIS=[], DB_REPLICA_LAG_CHECK=2)
+        self.addCleanup(db.session.remove)
+
+    def testRouting(self):
+        select = db.session.query(Trail.id).statement
+        with app.test_request_context(), patch.object(ReplicaSet, 'measure', return_value=0):
+            replica = db.replica_engine()
+            self.assertIsNot(replica, db.engine)
+            self.assertIs(db.session().get_bind(Trail.__mapper__, select), db.engine)
+
+            g.db_read_only = True
+            self.assertIs(db.session().get_bind(Trail.__mapper__, select), replica)
+            # writes, and reads after them, use the primary
+            self.assertIs(db.session().get_bind(Trail.__mapper__, Trail.__table__.delete()),
+                          db.engine)
+            self.assertIs(db.session().get_bind(Trail.__mapper__, select), db.engine)
+            self.assertTrue(g.db_wrote)
+
+        db.session.remove()
+        with app.test_request_context(), patch.object(ReplicaSet, 'measure', return_value=60):
+            g.db_read_only = True
+            # too far behind, read from the primary
+            self.assertIs(db.session().get_bind(Trail.__mapper__, select), db.engine)
+
+    def testReplicaConnectTimeout(self):
+        app.config['DB_REPLICA_URIS'] = ['postgresql://replica/urbanmaps']
+        with app.app_context(), patch.object(db, 'create_engine') as create_engine, \
+                patch.object(ReplicaSet, 'measure', return_value=0):
+            db.replica_engine()
+        # an unreachable replica stalls a lag check for seconds, not minutes
+        options = create_engine.call_args[0][1]
+        self.assertEqual(options['connect_args']['connect_timeout'],
+                         app.config['DB_REPLICA_CONNECT_TIMEOUT'])
+
+    def testStatementTimeout(self):
+        connection = Mock()
+        connection.dialect.name = 'postgresql'
+        # CLI commands, seeding and the purger run outside a request
+        with app.app_context():
+            db.limit_statements(db.session(), None, connection)
+        connection.exec_driver_sql.assert_not_called()
+
+        with app.test_request_context():
+            db.limit_statements(db.session(), None, connection)
+        connection.exec_driver_sql.assert_called_once_with(
+            f"SET LOCAL statement_timeout = {app.config['DB_STATEMENT_TIMEOUT_MS']}")
+
+
+class ElevationTest(TestCase):
+    '''Tests for DEM lookups'''
+
+    def testHeights(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_hgt_tile(directory)
+            tiles = DemTiles(directory)
+            heights = tiles.heights([-121.5, -121.5, -121.9, 10], [36.25, 36.0, 36.75, 10])
+
+        self.assertAlmostEqual(heights[0], 250)
+        self.assertAlmostEqual(heights[1], 0)
+        self.assertAlmostEqual(heights[2], 750)
+        self.assertTrue(np.isnan(heights[3]))
+
+    def testClimb(self):
+        # wobbles under the threshold are not climb
+        self.assertEqual(climb(np.array([0, 3, 0, 3, 10, 8, np.nan, 2])), (10, 8))
+        # the first climb starts from the lowest point, not the first
+        self.assertEqual(climb(np.array([10, 8, 20, 17])), (12, 0))
+        self.assertEqual(climb(np.array([10, 12, 0])), (0, 12))
+        self.assertEqual(climb(np.array([np.nan])), (None, None))
+
+
+class GridIndexTest(TestCase):
+    '''Tests for the in-process spatial index'''
+
+    def testInsertSearchRemove(self):
+        index = GridIndex(cell_size=1)
+        index.insert(1, (0.5, 0.5, 2.5, 1.5))
+        index.insert(2, (10, 10, 11, 11))
+
+        self.assertEqual(index.search((2, 1, 3, 2)), [1])
+        self.assertEqual(sorted(index.search((-180, -90, 180, 90))), [1, 2])
+
+        index.remove(1)
+        self.assertEqual(index.search((2, 1, 3, 2)), [])
+        self.assertEqual(len(index), 1)
+
+    def testWorldSpanningBox(self):
+        index = GridIndex(cell_size=0.05)
+        start = time.monotonic()
+        index.insert(1, (-180, -90, 180, 90))
+        index.insert(2, (10, 10, 10.01, 10.01))
+
+        # listed once, not in 26M cells
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(index._cells), 1)
+        self.assertEqual(sorted(index.search((10, 10, 10.02, 10.02))), [1, 2])
+        self.assertEqual(index.search((-50, -50, -49.9, -49.9)), [1])
+
+        index.remove(1)
+        self.assertEqual(index.search((-50, -50, -49.9, -49.9)), [])
+
+
+class TilesTest(TestCase):
+    '''Tests for vector tile clipping'''
+
+    def testClipLine(self):
+        # leaves the square and comes back: two parts
+        parts = clip_line([(5, 5), (15, 5), (15, 8), (5, 8)], 0, 10)
+
+        self.assertEqual(parts, [[(5, 5), (10, 5)], [(10, 8), (5, 8)]])
+
+    def testTilePartsOutside(self):
+        self.assertEqual(tile_parts([[10, 10], [11, 11]], 12, 665, 1601), [])
+
+
+class MatchingProxyTest(TestCase):
+    '''Tests for map matching request coalescing'''
+
+    def testConcurrentRequestsShareOneCall(self):
+        release = Event()
+        calls = []
+
+        class SlowMatcher:
+            name = 'slow'
+            def match(self, profile, coords, radiuses):
+                calls.append(coords)
+                release.wait(5)
+                return {"code": "Ok"}
+
+        proxy = MatchingProxy(LRUCache(10))
+        results = []
+        threads = [Thread(target=lambda: results.append(
+                       proxy.match(SlowMatcher(), 'walking', [[0, 0], [1, 1]], [5, 5])))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"code": "Ok"}] * 3)
+
+
+class CoordsPackingTest(TestCase):
+    '''Tests for the packed trail coordinate format'''
+
+    def testRoundTrip(self):
+        coords = [[-121.603451, 36.704384],
+                  [-121.604256, 36.704232],
+                  [-121.605525, 36.703853]]
+
+        self.assertEqual(unpack_coords(pack_coords(coords)), coords)
+
+    def testEmpty(self):
+        self.assertEqual(unpack_coords(pack_coords([])), [])
+
+    def testAppend(self):
+        head = [[-121.5, 36.1], [-121.500001, 36.2]]
+        tail = [[-121.6, 36.3], [-121.7, 36.4]]
+
+        self.assertEqual(append_coords(pack_coords(head), tail), pack_coords(head + tail))
+        self.assertEqual(append_coords(pack_coords([]), tail), pack_coords(tail))
+        self.assertEqual(last_coord(pack_coords(head)), head[-1])
+
+    def testBadBlob(self):
+        with self.assertRaises(ValueError):
+            unpack_coords(b'nope' + bytes(4))
+
+
+class BenchmarkHelpersTest(TestCase):
+    '''Tests for the benchmark statistics and baseline comparison'''
+
+    def testRandomRouteDeterministic(self):
+        route = random_route(random.Random(3), 50)
+
+        self.assertEqual(len(route), 50)
+        self.assertEqual(route, random_route(random.Random(3), 50))
+
+    def testPercentiles(self):
+        stats = summarize([i / 1000 for i in range(1, 101)], 1.0)
+
+        self.assertEqual(stats['p50_ms'], 50)
+        self.assertEqual(stats['p99_ms'], 99)
+        self.assertEqual(stats['ops_per_s'], 100)
+
+    def testThroughputIsWallClock(self):
+        # setup is left out of latency but not out of throughput
+        stats = run(lambda: None, 5, 0, setup=lambda: time.sleep(0.01))
+
+        self.assertLess(stats['p50_ms'], 5)
+        self.assertLess(stats['ops_per_s'], 100)
+
+    def testCompareFlagsRegression(self):
+        baseline = {"a": {"p50_ms": 1.0}, "b": {"p50_ms": 2.0}}
+        results = {"a": {"p50_ms": 1.5}, "b": {"p50_ms": 2.1}, "c": {"p50_ms": 9}}
+        rows, regressed = compare(results, baseline, ratio=1.2)
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(regressed, ["a"])
+
+
+class SeedDataTest(TestCase):
+    '''Tests for the synthetic data generator'''
+
+    def testPlanDeterministic(self):
+        trails, notes = plan_chunk(7, 3, 100, 8.0, 0.5)
+
+        self.assertEqual(len(trails), 100)
+        self.assertEqual(len(notes), sum(trails))
+        self.assertEqual((trails, notes), plan_chunk(7, 3, 100, 8.0, 0.5))
+        self.assertNotEqual(trails, plan_chunk(7, 4, 100, 8.0, 0.5)[0])
+
+    def testCopyWriterFlushesParentsFirst(self):
+        class Cursor:
+            copied = []
+
+            def copy_expert(self, sql, buf):
+                self.copied.append((sql.split()[1], buf.read()))
+
+        cursor = Cursor()
+        users = CopyWriter(cursor, 'users', ['id'])
+        trails = CopyWriter(cursor, 'trails', ['id', 'geometry', 'user_id'],
+                            flush_rows=1, parent=users)
+        users.write((1,))
+        trails.write((5, b'\x01\xff', None))
+
+        self.assertEqual(cursor.copied, [('users', '1\n'),
+                                         ('trails', '5\t\\\\x01ff\t\\N\n')])
+
+
+class AsyncApiTest(TestCase):
+    '''Tests for the async JSON endpoints in asgi.py'''
+
+    def setUp(self):
+        Note.query.delete()
+        User.query.delete()
+        Trail.query.delete()
+        user = User(username="asyncuser", password="password")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        self.client = AsgiClient(application)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def testAddGetTrail(self):
+        resp = self.client.post(f'/users/{self.user_id}/trails', json={
+            "name": "asynctrail", "coordinates": [[-121, 36.5], [-122, 37]]})
+        self.assertEqual(resp.status_code, 201)
+        trail_id = resp.json()['maproute']['id']
+
+        url = f'/users/{self.user_id}/trails/{trail_id}/'
+        resp = self.client.get(url)
+        self.assertEqual(resp.json()['maproute']['coordinates'], [[-121, 36.5], [-122, 37]])
+        self.assertEqual(resp.json()['maproute']['distance'],
+                         Trail.stats_values([[-121, 36.5], [-122, 37]])['distance'])
+
+        resp = self.client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.client.get(f'/users/{self.user_id + 1}/trails/{trail_id}/')
+                         .status_code, 404)
+
+        resp = self.client.post(f'/users/{self.user_id}/trails', json={
+            "name": "badtrail", "coordinates": [[-500, 36.5], [-122, 37]]})
+        self.assertEqual(resp.status_code, 400)
+
+    def testNotes(self):
+        trail = Trail(name="asyncnotes", coordinates=[[-121, 36.5], [-122, 37]],
+                      user_id=self.user_id)
+        trail.update_stats()
+        db.session.add(trail)
+        db.session.commit()
+        url = f'/users/{self.user_id}/trails/{trail.id}/notes'
+
+        note_ids = [self.client.post(url, json={"comment": f"note{i}"}).json()['note']['id']
+                    for i in range(3)]
+        resp = self.client.delete(f'{url}/{note_ids[1]}')
+        self.assertEqual(resp.status_code, 200)
+
+        first = self.client.get(url + '?limit=1').json()
+        second = self.client.get(url + f"?limit=1&after={first['next']}").json()
+        self.assertEqual([n['comment'] for n in first['notes'] + second['notes']],
+                         ['note0', 'note2'])
+        self.assertIsNone(second['next'])
+        self.assertEqual(UserStats.query.get(self.user_id).note_count, 2)
+
+    def testReadAfterWrite(self):
+        # the test database stands in for its own replica
+        app.config['DB_REPLICA_URIS'] = [app.config['SQLALCHEMY_DATABASE_URI']]
+        self.addCleanup(app.config.update, DB_REPLICA_URIS=[])
+        self.addCleanup(asgi._replica_sessions.clear)
+        trail = Trail(name="asyncreplica", coordinates=[[-121, 36.5], [-122, 37]],
+                      user_id=self.user_id)
+        trail.update_stats()
+        db.session.add(trail)
+        db.session.commit()
+        url = f'/users/{self.user_id}/trails/{trail.id}/notes'
+
+        with patch.object(ReplicaSet, 'measure', return_value=0), \
+                patch('asgi.pick_replica', wraps=asgi.pick_replica) as pick:
+            self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(pick.call_count, 1)
+            self.assertEqual(len(asgi._replica_sessions), 1)
+
+            self.client.post(url, json={"comment": "fresh"})
+            # the Flask session cookie says so, for @read_only views too
+            cookie = self.client.cookies[app.session_cookie_name]
+            wrote = app.session_interface.get_signing_serializer(app).loads(cookie)
+            self.assertAlmostEqual(wrote[WROTE_AT_KEY], time.time(), delta=5)
+
+            resp = self.client.get(url)
+            self.assertEqual([n['comment'] for n in resp.json()['notes']], ['fresh'])
+            self.assertEqual(pick.call_count, 1)
+
+    def testFlaskFallback(self):
+        resp = self.client.get('/')
+
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,202 @@
+import math
+import struct
+import numpy as np
+
+# Mapbox Vector Tile (MVT 2.1) rendering of trail lines
+#
+# Only what trails need is implemented: one layer of LINESTRING
+# features with int/float/string properties, encoded straight to
+# protobuf bytes. See https://github.com/mapbox/vector-tile-spec
+
+EXTENT = 4096
+# extra tile units drawn past each edge so lines join across tiles
+BUFFER = 64
+MAX_ZOOM = 22
+MIME_TYPE = 'application/vnd.mapbox-vector-tile'
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bbox(z, x, y, buffer=0):
+    ''' (min_lng, min_lat, max_lng, max_lat) covered by a tile
+        buffer - extra tile units to include on every side
+    '''
+    n = 2 ** z
+    pad = buffer / EXTENT
+
+    def lng(tx):
+        return tx / n * 360 - 180
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return (lng(x - pad), lat(y + 1 + pad), lng(x + 1 + pad), lat(y - pad))
+
+
+def project(coords, z, x, y):
+    '''[lng, lat] pairs to web mercator tile units as an (n, 2) array'''
+    pts = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    n = 2 ** z
+    lat = np.radians(np.clip(pts[:, 1], -85.0511, 85.0511))
+    px = ((pts[:, 0] + 180) / 360 * n - x) * EXTENT
+    py = ((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n - y) * EXTENT
+    return np.column_stack([px, py])
+
+
+def _clip_segment(x0, y0, x1, y1, lo, hi):
+    '''Liang-Barsky: (t0, t1) of the segment inside lo..hi, or None'''
+    dx, dy = x1 - x0, y1 - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - lo), (dx, hi - x0), (-dy, y0 - lo), (dy, hi - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return t0, t1
+
+
+def clip_line(points, lo, hi):
+    '''Split a projected line into its parts inside the square lo..hi'''
+    parts = []
+    current = []
+    for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+        clipped = _clip_segment(x0, y0, x1, y1, lo, hi)
+        if clipped is None:
+            if current:
+                parts.append(current)
+                current = []
+            continue
+
+        t0, t1 = clipped
+        if not current or t0 > 0:
+            if current:
+                parts.append(current)
+            current = [(x0 + t0 * (x1 - x0), y0 + t0 * (y1 - y0))]
+        current.append((x0 + t1 * (x1 - x0), y0 + t1 * (y1 - y0)))
+        if t1 < 1:
+            parts.append(current)
+            current = []
+    if current:
+        parts.append(current)
+    return parts
+
+
+def tile_parts(coords, z, x, y):
+    '''Trail coordinates as integer line parts inside tile z/x/y'''
+    pts = project(coords, z, x, y)
+    lo, hi = -BUFFER, EXTENT + BUFFER
+    if np.all((pts >= lo) & (pts <= hi)):
+        parts = [pts.tolist()]
+    else:
+        parts = clip_line(pts.tolist(), lo, hi)
+
+    out = []
+    for part in parts:
+        line = []
+        for px, py in part:
+            point = (int(round(px)), int(round(py)))
+            if not line or line[-1] != point:
+                line.append(point)
+        if len(line) > 1:
+            out.append(line)
+    return out
+
+
+##############################################################
+#              protobuf encoding                             #
+##############################################################
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _uint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+def _bytes_field(number, data):
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _packed_field(number, values):
+    return _bytes_field(number, b''.join(_varint(v) for v in values))
+
+
+def _value(value):
+    '''Encode a property value as an MVT Value message'''
+    if isinstance(value, bool):
+        return _uint_field(7, int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _uint_field(5, value)
+        return _uint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _varint(3 << 3 | 1) + struct.pack('<d', value)
+    return _bytes_field(1, str(value).encode('utf8'))
+
+
+def _geometry(parts):
+    '''MoveTo/LineTo command stream for line parts'''
+    commands = []
+    cx = cy = 0
+    for part in parts:
+        x, y = part[0]
+        commands += [1 | 1 << 3, _zigzag(x - cx), _zigzag(y - cy)]
+        cx, cy = x, y
+        commands.append(2 | (len(part) - 1) << 3)
+        for x, y in part[1:]:
+            commands += [_zigzag(x - cx), _zigzag(y - cy)]
+            cx, cy = x, y
+    return commands
+
+
+def encode_tile(layer_name, features):
+    ''' Encode a single layer tile
+        features - iterable of (id, properties dict, line parts)
+        Returns b'' for a tile with no features
+    '''
+    keys, values = {}, {}
+    body = bytearray()
+    for feature_id, properties, parts in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(_value(value), len(values)))
+        feature = (_uint_field(1, feature_id)
+                   + _packed_field(2, tags)
+                   + _uint_field(3, 2)  # LINESTRING
+                   + _packed_field(4, _geometry(parts)))
+        body += _bytes_field(2, feature)
+
+    if not body:
+        return b''
+
+    layer = (_uint_field(15, 2)
+             + _bytes_field(1, layer_name.encode('utf8'))
+             + bytes(body)
+             + b''.join(_bytes_field(3, key.encode('utf8')) for key in keys)
+             + b''.join(_bytes_field(4, value) for value in values)
+             + _uint_field(5, EXTENT))
+    return _bytes_field(3, layer)
@@ -0,0 +1,284 @@
+from xml.etree.ElementTree import iterparse, ParseError
+import io
+import json
+from sqlalchemy.exc import IntegrityError
+from models import db, Trail, User, UserStats
+
+# Streaming import of GPX / GeoJSON / NDJSON files into trails
+#
+# Files are parsed a trail at a time and written in batches of rows
+# with a single executemany per batch, so a device dump with
+# thousands of tracks is a handful of transactions.
+
+FORMATS = ('gpx', 'geojson', 'ndjson')
+CHUNK_SIZE = 64 * 1024
+
+
+class ImportItemError(ValueError):
+    '''A single imported trail is unusable, the rest carry on'''
+
+
+def guess_format(filename):
+    '''Import format from a file name, None if unknown'''
+    ext = (filename or '').rsplit('.', 1)[-1].lower()
+    if ext in ('json', 'geojson'):
+        return 'geojson'
+    if ext in FORMATS:
+        return ext
+    return None
+
+
+##############################################################
+#              parsers, all yield (name, coordinates)        #
+#   coordinates is an ImportItemError for an unusable trail, #
+#   a broken file raises and ends the import                 #
+##############################################################
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_gpx(stream):
+    '''Tracks and routes from a GPX file, one per trail'''
+    coords = []
+    name = None
+    path = []
+    for event, elem in iterparse(stream, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            path.append(tag)
+            if tag in ('trk', 'rte'):
+                coords = []
+                name = None
+            continue
+
+        path.pop()
+        if tag in ('trkpt', 'rtept'):
+            if not isinstance(coords, ImportItemError):
+                try:
+                    coords.append([float(elem.get('lon')), float(elem.get('lat'))])
+                except (TypeError, ValueError):
+                    coords = ImportItemError('Point without a valid lat/lon')
+            elem.clear()
+        elif tag == 'name' and path and path[-1] in ('trk', 'rte'):
+            name = (elem.text or '').strip() or None
+        elif tag in ('trk', 'rte'):
+            yield name, coords
+            elem.clear()
+
+
+def _feature_coords(feature):
+    '''[lng, lat] list from a GeoJSON Feature or geometry'''
+    geometry = feature.get('geometry', feature) or {}
+    kind = geometry.get('type')
+    if kind == 'LineString':
+        lines = [geometry.get('coordinates') or []]
+    elif kind == 'MultiLineString':
+        lines = geometry.get('coordinates') or []
+    else:
+        raise ImportItemError(f'Unsupported geometry {kind}')
+    # drop elevation/time if present
+    return [[float(point[0]), float(point[1])] for line in lines for point in line]
+
+
+def _feature_name(feature):
+    return (feature.get('properties') or {}).get('name')
+
+
+def _iter_feature_collection(stream):
+    ''' Feature objects from a GeoJSON FeatureCollection, decoded one
+        at a time from its top level "features" array without reading
+        it all. A file that is one Feature or geometry yields just that.
+    '''
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+
+    def peek():
+        '''Next non blank character, '' at the end of the file'''
+        nonlocal buf, eof
+        while True:
+            buf = buf.lstrip()
+            if buf or eof:
+                return buf[:1]
+            chunk = stream.read(CHUNK_SIZE)
+            eof = not chunk
+            buf += chunk
+
+    def take(char):
+        nonlocal buf
+        if peek() != char:
+            raise ValueError(f'Expected {char!r} in GeoJSON')
+        buf = buf[1:]
+
+    def decode():
+        '''Next JSON value, reading more only while it is truncated'''
+        nonlocal buf, eof
+        last = None
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf)
+                buf = buf[end:]
+                return value
+            except json.JSONDecodeError as err:
+                # a syntax error stays where it is as data is added,
+                # don't buffer the rest of the file to find that out
+                stuck = (err.pos, err.msg) == last and not err.msg.startswith('Unterminated')
+                if eof or stuck:
+                    raise
+                last = err.pos, err.msg
+                chunk = stream.read(CHUNK_SIZE)
+                eof = not chunk
+                buf += chunk
+
+    if peek() != '{':
+        yield decode()
+        return
+    take('{')
+    # top level members before "features", a Feature if it has none
+    members = {}
+    while peek() != '}':
+        key = decode()
+        take(':')
+        if key == 'features':
+            break
+        members[key] = decode()
+        if peek() == ',':
+            take(',')
+    else:
+        yield members
+        return
+
+    take('[')
+    while peek() != ']':
+        yield decode()
+        if peek() == ',':
+            take(',')
+
+
+def _feature_item(feature):
+    try:
+        return _feature_name(feature), _feature_coords(feature)
+    except (AttributeError, IndexError, TypeError, ValueError) as err:
+        if not isinstance(err, ImportItemError):
+            err = ImportItemError(f'Bad feature: {err}')
+        return None, err
+
+
+def parse_geojson(stream):
+    '''Features of a GeoJSON FeatureCollection (or one Feature)'''
+    for feature in _iter_feature_collection(stream):
+        yield _feature_item(feature)
+
+
+def parse_ndjson(stream):
+    '''One GeoJSON Feature per line, as written by export.py'''
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            feature = json.loads(line)
+        except json.JSONDecodeError as err:
+            yield None, ImportItemError(f'Line {number}: bad JSON, {err.msg}')
+            continue
+        yield _feature_item(feature)
+
+
+def read_items(stream, format):
+    ''' (name, coordinates) for each trail in an uploaded file
+        stream - binary file object
+    '''
+    if format == 'gpx':
+        return parse_gpx(stream)
+    text = io.TextIOWrapper(stream, encoding='utf8')
+    if format == 'ndjson':
+        return parse_ndjson(text)
+    return parse_geojson(text)
+
+
+##############################################################
+#              batched inserts                               #
+##############################################################
+
+def _row(user_id, index, name, coords):
+    if len(coords) < 2:
+        raise ImportItemError('A trail needs at least 2 points')
+    if not all(-180 <= lng <= 180 and -90 <= lat <= 90 for lng, lat in coords):
+        raise ImportItemError('Coordinates out of range')
+    name = (str(name) if name else f'Imported trail {index + 1}')[:100]
+    return Trail.row_for_insert(name, coords, user_id)
+
+
+def _insert_batch(rows, errors):
+    ''' Insert (index, row) pairs in one executemany, falling back to
+        one savepoint per row if a constraint fails. Returns rows added.
+    '''
+    # names are unique, report clashes instead of failing the batch
+    taken = Trail.existing_names([row['name'] for _, row in rows])
+    seen = set()
+    good = []
+    for index, row in rows:
+        if row['name'] in taken or row['name'] in seen:
+            errors.append({"item": index, "name": row['name'],
+                           "error": "Trail name already taken"})
+        else:
+            seen.add(row['name'])
+            good.append((index, row))
+    if not good:
+        return 0
+
+    try:
+        Trail.insert_many([row for _, row in good])
+        db.session.commit()
+        return len(good)
+    except IntegrityError:
+        db.session.rollback()
+
+    added = 0
+    for index, row in good:
+        try:
+            with db.session.begin_nested():
+                Trail.insert_many([row])
+            added += 1
+        except IntegrityError as err:
+            errors.append({"item": index, "name": row['name'],
+                           "error": str(err.orig).strip()})
+    db.session.commit()
+    return added
+
+
+def import_trails(user_id, items, batch_size=500):
+    ''' Insert trails from (name, coordinates) items for user_id
+
+        Items that cannot be stored are reported in errors and skipped,
+        a file that stops parsing part way keeps what came before it.
+        Returns {"imported": n, "errors": [{item, name, error}, ...]}
+    '''
+    imported = 0
+    errors = []
+    batch = []
+    try:
+        for index, (name, coords) in enumerate(items):
+            try:
+                if isinstance(coords, ImportItemError):
+                    raise coords
+                batch.append((index, _row(user_id, index, name, coords)))
+            except ImportItemError as err:
+                errors.append({"item": index, "name": name, "error": str(err)})
+
+            if len(batch) >= batch_size:
+                imported += _insert_batch(batch, errors)
+                batch = []
+    except (ValueError, ParseError) as err:
+        # unreadable file, keep what was read before the error
+        errors.append({"item": None, "name": None, "error": f'Could not read file: {err}'})
+
+    if batch:
+        imported += _insert_batch(batch, errors)
+    if imported:
+        # one aggregate for the whole import, not one update per batch
+        UserStats.rebuild(user_id)
+        User.bump_version(user_id)
+        db.session.commit()
+    return {"imported": imported, "errors": errors}